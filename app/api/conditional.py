@@ -0,0 +1,95 @@
+"""
+Conditional GET support (ETag / Last-Modified) for dashboard and data endpoints.
+
+Validators are derived from the dashboard documents alone. Ingest keeps each field's
+last_update and the dashboard's data_modified_at current, so a dashboard document
+changes whenever its data does and an unchanged poll can be answered with 304
+before data_points is queried.
+"""
+import hashlib
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Iterable, Optional
+import bson
+from fastapi import Request, Response
+
+def _as_utc(ts: datetime) -> datetime:
+    if ts.tzinfo is None:
+        return ts.replace(tzinfo=timezone.utc)
+    return ts.astimezone(timezone.utc)
+
+def dashboards_etag(request: Request, dashboards: Iterable[dict], viewer: str = "") -> str:
+    """
+    Weak ETag over the dashboard documents plus the query string and Accept header that shape the
+    response, and the viewer (user id and role) for responses that depend on who is asking
+    """
+    digest = hashlib.sha1()
+    digest.update(request.url.path.encode())
+    digest.update(b"?" + request.url.query.encode())
+    digest.update(b"|" + request.headers.get("accept", "").encode())
+    digest.update(b"|" + viewer.encode())
+    for dashboard in dashboards:
+        digest.update(bson.encode(dashboard))
+    return f'W/"{digest.hexdigest()}"'
+
+def dashboards_last_modified(dashboards: Iterable[dict]) -> Optional[datetime]:
+    """Newest of updated_at, data_modified_at and every field's last_update"""
+    latest = None
+    for dashboard in dashboards:
+        candidates = [dashboard.get("updated_at"), dashboard.get("data_modified_at")]
+        candidates.extend(field.get("last_update") for field in dashboard.get("fields", []))
+        for ts in candidates:
+            if isinstance(ts, datetime):
+                ts = _as_utc(ts)
+                if latest is None or ts > latest:
+                    latest = ts
+    return latest
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    if if_none_match.strip() == "*":
+        return True
+    # Weak comparison: W/ prefixes are ignored
+    opaque = etag[2:] if etag.startswith("W/") else etag
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == opaque:
+            return True
+    return False
+
+def is_not_modified(request: Request, etag: str, last_modified: Optional[datetime]) -> bool:
+    """Evaluate If-None-Match, or If-Modified-Since when no If-None-Match is sent"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return _etag_matches(if_none_match, etag)
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and last_modified is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        # HTTP dates have one-second precision
+        return _as_utc(last_modified).replace(microsecond=0) <= _as_utc(since)
+    return False
+
+def validator_headers(etag: str, last_modified: Optional[datetime]) -> dict:
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if last_modified is not None:
+        headers["Last-Modified"] = format_datetime(_as_utc(last_modified), usegmt=True)
+    return headers
+
+def conditional_response(request: Request, response: Response, dashboards: Iterable[dict], viewer: str = "") -> Optional[Response]:
+    """
+    Attach ETag/Last-Modified for the given dashboards to the response. Returns a 304 response
+    to send instead when the client's copy is current, otherwise None. Pass viewer when the
+    response differs by user, so one user's ETag never validates another user's copy.
+    """
+    dashboards = list(dashboards)
+    etag = dashboards_etag(request, dashboards, viewer)
+    last_modified = dashboards_last_modified(dashboards)
+    headers = validator_headers(etag, last_modified)
+    if is_not_modified(request, etag, last_modified):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return None
@@ -1,11 +1,21 @@
-from typing import List, Any
-from fastapi import APIRouter, Depends, HTTPException, Request
-from app.schemas.dashboard import Dashboard, DashboardCreate, DashboardUpdate, DashboardData
+from typing import Any, Dict, List, Optional, Tuple
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from pydantic import ValidationError
+from app.schemas.dashboard import Dashboard, DashboardCreate, DashboardUpdate, DashboardData, DashboardRetention
 from app.schemas.user import User
-from app.api.deps import get_current_user
+from app.api.deps import get_current_admin_user, get_current_user
+from app.api.conditional import conditional_response
+from app.api.serialization import json_response, to_ist_fields
 from app.db.mongodb import mongodb
 from app.services.email_service import email_service
+from app.services.dashboard_purge import dashboard_purger
+from app.services.dashboard_registry import dashboard_registry
+from app.services.bucket_storage import store_data_points
+from app.services.response_cache import response_cache
+from app.services.retention import retention_compactor
+from app.services.timeseries import latest_timestamps
 import random
+import re
 import string
 from datetime import datetime, timezone, timedelta
 import json
@@ -16,11 +26,45 @@ IST_TIMEZONE = timezone(timedelta(hours=5, minutes=30))
 
 router = APIRouter(prefix="/dashboards", tags=["dashboards"])
 
+# Largest page GET /dashboards/ serves when paginating
+MAX_DASHBOARD_PAGE_SIZE = 500
+
+# Projections of GET /dashboards/ by view; summary leaves out widget configs and the device api key
+DASHBOARD_VIEWS = {
+    "full": None,
+    "summary": {
+        "name": 1, "description": 1, "is_public": 1, "created_by": 1,
+        "assigned_users": 1, "created_at": 1, "updated_at": 1,
+        "fields.name": 1, "fields.type": 1, "fields.unit": 1, "fields.last_value": 1, "fields.last_update": 1,
+    },
+}
+
+def can_view_api_key(dashboard: dict, user: User) -> bool:
+    """The api key is the device write credential: only the dashboard's creator and admins see it"""
+    return user.is_admin or str(dashboard.get("created_by")) == str(user.id)
+
+def viewer_key(user: User) -> str:
+    """Who is asking, for validators of responses that depend on it (see can_view_api_key)"""
+    return f"{user.id}:{'admin' if user.is_admin else 'user'}"
+
 def datetime_handler(obj):
     if isinstance(obj, datetime):
         return obj.isoformat()
     raise TypeError(f"Object of type {type(obj)} is not JSON serializable")
 
+async def fetch_last_updates(dashboards: List[dict]) -> Dict[Tuple[str, str], datetime]:
+    """
+    Latest data point timestamp of the dashboards' fields without a stored last_update,
+    fetched with one aggregation for the whole listing
+    """
+    series = [
+        (str(dashboard["_id"]), field["name"])
+        for dashboard in dashboards
+        for field in dashboard.get("fields", [])
+        if not field.get("last_update")
+    ]
+    return await latest_timestamps(series)
+
 @router.post("/")
 async def create_dashboard(
     request: Request,
@@ -106,6 +150,14 @@ async def create_dashboard(
         
         print("Parsed request data:", json.dumps(data, indent=2))
         
+        # Optional per-dashboard retention policy (see app/services/retention.py)
+        if data.get("retention") is not None:
+            try:
+                retention = DashboardRetention(**data["retention"]).dict()
+                retention_compactor.check_policy(retention)
+            except (TypeError, ValueError, ValidationError) as e:
+                raise HTTPException(status_code=400, detail=f"Invalid retention: {str(e)}")
+        
         # Check for duplicate dashboard name (case-insensitive)
         existing_dashboard = await mongodb.get_collection("dashboards").find_one({"name": {"$regex": f"^{data['name']}$", "$options": "i"}})
         if existing_dashboard:
@@ -158,21 +210,25 @@ async def create_dashboard(
             "created_at": now,
             "updated_at": now
         }
+        if data.get("retention") is not None:
+            dashboard_data["retention"] = retention
         
         # Insert dashboard and get its ID
         dashboard_result = await mongodb.get_collection("dashboards").insert_one(dashboard_data)
         dashboard_data["_id"] = str(dashboard_result.inserted_id)
+        dashboard_registry.invalidate(dashboard_id=dashboard_data["_id"], api_key=api_key)
         
         # Insert initial data points for each field if value is not None (including zero)
         for field in dashboard_data.get("fields", []):
             if "value" in field and field["value"] is not None:
-                await mongodb.get_collection("data_points").insert_one({
+                data_point = {
                     "dashboard_id": str(dashboard_data["_id"]),
                     "field_name": field["name"],
                     "value": field["value"],
                     "timestamp": now,
                     "metadata": {"source": "dashboard_creation"}
-                })
+                }
+                await store_data_points([data_point])
         
         # Convert datetime objects to ISO format strings for JSON response
         response_data = {
@@ -202,6 +258,8 @@ async def create_dashboard(
                 # Don't fail the dashboard creation if email sending fails
         
         return response_data
+    except HTTPException:
+        raise
     except Exception as e:
         print("Error creating dashboard:", str(e))
         print("Error type:", type(e))
@@ -214,79 +272,65 @@ async def create_dashboard(
 
 @router.get("/")
 async def get_dashboards(
+    response: Response,
+    limit: Optional[int] = Query(default=None, ge=1, le=MAX_DASHBOARD_PAGE_SIZE, description="Page size; default returns every matching dashboard"),
+    cursor: Optional[str] = Query(default=None, description="X-Next-Cursor value of the previous page, to fetch the next page"),
+    name: Optional[str] = Query(default=None, description="Only dashboards whose name contains this text (case-insensitive)"),
+    owner: Optional[str] = Query(default=None, description="Only dashboards created by this user id"),
+    is_public: Optional[bool] = Query(default=None, description="Only public (true) or private (false) dashboards"),
+    assigned_user: Optional[str] = Query(default=None, description="Only dashboards assigned to this user id"),
+    view: str = Query(default="full", description="full, or summary for just the fields the list view needs (no widgets)"),
     current_user: User = Depends(get_current_user)
 ):
-    """Get all dashboards"""
+    """
+    Get all dashboards, optionally filtered and paged.
+    Pages are ordered by creation (_id); when more dashboards match, the X-Next-Cursor
+    response header holds the cursor for the next page. api_key is only included in the
+    full view, for dashboards the user created or when the user is an admin.
+    """
     try:
         print("Getting dashboards for user:", str(current_user.id))
-        
-        # Get all dashboards
-        cursor = mongodb.get_collection("dashboards").find({})
-        dashboards = await cursor.to_list(length=None)
+        if view not in DASHBOARD_VIEWS:
+            raise HTTPException(status_code=400, detail=f"Invalid view, expected one of {', '.join(DASHBOARD_VIEWS)}")
+
+        query: dict = {}
+        if name:
+            query["name"] = {"$regex": re.escape(name), "$options": "i"}
+        if owner:
+            query["created_by"] = owner
+        if is_public is not None:
+            query["is_public"] = is_public
+        if assigned_user:
+            query["assigned_users"] = assigned_user
+        if cursor:
+            try:
+                query["_id"] = {"$gt": ObjectId(cursor)}
+            except Exception:
+                raise HTTPException(status_code=400, detail="Invalid cursor")
+
+        find = mongodb.get_collection("dashboards").find(query, DASHBOARD_VIEWS[view]).sort("_id", 1)
+        if limit is not None:
+            # One extra document tells whether another page follows
+            find = find.limit(limit + 1)
+        dashboards = await find.to_list(length=None)
+        if limit is not None and len(dashboards) > limit:
+            dashboards = dashboards[:limit]
+            response.headers["X-Next-Cursor"] = str(dashboards[-1]["_id"])
         print("Found dashboards:", len(dashboards))
+        latest_updates = await fetch_last_updates(dashboards)
         
-        result = []
-        # Convert ObjectId to string for each dashboard
+        # Datetimes and ObjectIds are converted while the response is encoded
         for dashboard in dashboards:
-            print("Processing dashboard:", dashboard.get("name"))
-            print("Original _id:", dashboard.get("_id"))
-            print("Original _id type:", type(dashboard.get("_id")))
-            
-            # Keep the _id field as is, just convert to string
-            if "_id" in dashboard:
-                dashboard["_id"] = str(dashboard["_id"])
-                print("Converted _id:", dashboard["_id"])
-            else:
-                print("Warning: Dashboard missing _id:", dashboard.get("name"))
-                continue  # Skip dashboards without _id
-            
-            # Convert created_at and updated_at to IST ISO strings
-            if "created_at" in dashboard:
-                ts = dashboard["created_at"]
-                if ts.tzinfo is None:
-                    ts = ts.replace(tzinfo=timezone.utc).astimezone(IST_TIMEZONE)
-                else:
-                    ts = ts.astimezone(IST_TIMEZONE)
-                dashboard["created_at"] = ts.isoformat()
-            if "updated_at" in dashboard:
-                ts = dashboard["updated_at"]
-                if ts.tzinfo is None:
-                    ts = ts.replace(tzinfo=timezone.utc).astimezone(IST_TIMEZONE)
-                else:
-                    ts = ts.astimezone(IST_TIMEZONE)
-                dashboard["updated_at"] = ts.isoformat()
-            
-            # Ensure last_update is included for each field
-            if "fields" in dashboard:
-                for field in dashboard["fields"]:
-                    # If last_update is missing or None, fetch from latest data point
-                    if not field.get("last_update"):
-                        latest_dp = await mongodb.get_collection("data_points").find({
-                            "dashboard_id": str(dashboard["_id"]),
-                            "field_name": field["name"]
-                        }).sort("timestamp", -1).limit(1).to_list(length=1)
-                        if latest_dp:
-                            ts = latest_dp[0]["timestamp"]
-                            if hasattr(ts, "tzinfo") and ts.tzinfo is None:
-                                ts = ts.replace(tzinfo=timezone.utc).astimezone(IST_TIMEZONE)
-                            elif hasattr(ts, "tzinfo"):
-                                ts = ts.astimezone(IST_TIMEZONE)
-                            field["last_update"] = ts.isoformat()
-                        else:
-                            field["last_update"] = None
-                    else:
-                        ts = field["last_update"]
-                        if ts and hasattr(ts, "tzinfo"):
-                            if ts.tzinfo is None:
-                                ts = ts.replace(tzinfo=timezone.utc).astimezone(IST_TIMEZONE)
-                            else:
-                                ts = ts.astimezone(IST_TIMEZONE)
-                            field["last_update"] = ts.isoformat()
-            
-            result.append(dashboard)
+            if not can_view_api_key(dashboard, current_user):
+                dashboard.pop("api_key", None)
+            for field in dashboard.get("fields", []):
+                if not field.get("last_update"):
+                    field["last_update"] = latest_updates.get((str(dashboard["_id"]), field["name"]))
         
-        print("Returning dashboards:", len(result))
-        return result
+        print("Returning dashboards:", len(dashboards))
+        return json_response(dashboards, response)
+    except HTTPException:
+        raise
     except Exception as e:
         print("Error getting dashboards:", str(e))
         raise HTTPException(
@@ -296,6 +340,8 @@ async def get_dashboards(
 
 @router.get("/my-dashboards")
 async def get_my_dashboards(
+    request: Request,
+    response: Response,
     current_user: User = Depends(get_current_user)
 ):
     """Get dashboards assigned to the current user (public dashboards + assigned dashboards)"""
@@ -312,74 +358,25 @@ async def get_my_dashboards(
         })
         dashboards = await cursor.to_list(length=None)
         print("Found dashboards for user:", len(dashboards))
+
+        # Unchanged since the client's last poll: skip the per-field lookups and serialization
+        not_modified = conditional_response(request, response, dashboards, viewer_key(current_user))
+        if not_modified is not None:
+            return not_modified
+        latest_updates = await fetch_last_updates(dashboards)
         
-        result = []
-        # Convert ObjectId to string for each dashboard
+        # Datetimes and ObjectIds are converted while the response is encoded
         for dashboard in dashboards:
-            print("Processing dashboard:", dashboard.get("name"))
-            
-            # Keep the _id field as is, just convert to string
-            if "_id" in dashboard:
-                dashboard["_id"] = str(dashboard["_id"])
-            else:
-                print("Warning: Dashboard missing _id:", dashboard.get("name"))
-                continue  # Skip dashboards without _id
-            
-            # Process fields to map last_value to value for frontend
-            if "fields" in dashboard:
-                for field in dashboard["fields"]:
-                    if "last_value" in field and field["last_value"] is not None:
-                        field["value"] = field["last_value"]
-                    else:
-                        field["value"] = None
-            
-            # Convert created_at and updated_at to IST ISO strings
-            if "created_at" in dashboard:
-                ts = dashboard["created_at"]
-                if ts.tzinfo is None:
-                    ts = ts.replace(tzinfo=timezone.utc).astimezone(IST_TIMEZONE)
-                else:
-                    ts = ts.astimezone(IST_TIMEZONE)
-                dashboard["created_at"] = ts.isoformat()
-            if "updated_at" in dashboard:
-                ts = dashboard["updated_at"]
-                if ts.tzinfo is None:
-                    ts = ts.replace(tzinfo=timezone.utc).astimezone(IST_TIMEZONE)
-                else:
-                    ts = ts.astimezone(IST_TIMEZONE)
-                dashboard["updated_at"] = ts.isoformat()
-            
-            # Ensure last_update is included for each field
-            if "fields" in dashboard:
-                for field in dashboard["fields"]:
-                    # If last_update is missing or None, fetch from latest data point
-                    if not field.get("last_update"):
-                        latest_dp = await mongodb.get_collection("data_points").find({
-                            "dashboard_id": str(dashboard["_id"]),
-                            "field_name": field["name"]
-                        }).sort("timestamp", -1).limit(1).to_list(length=1)
-                        if latest_dp:
-                            ts = latest_dp[0]["timestamp"]
-                            if hasattr(ts, "tzinfo") and ts.tzinfo is None:
-                                ts = ts.replace(tzinfo=timezone.utc).astimezone(IST_TIMEZONE)
-                            elif hasattr(ts, "tzinfo"):
-                                ts = ts.astimezone(IST_TIMEZONE)
-                            field["last_update"] = ts.isoformat()
-                        else:
-                            field["last_update"] = None
-                    else:
-                        ts = field["last_update"]
-                        if ts and hasattr(ts, "tzinfo"):
-                            if ts.tzinfo is None:
-                                ts = ts.replace(tzinfo=timezone.utc).astimezone(IST_TIMEZONE)
-                            else:
-                                ts = ts.astimezone(IST_TIMEZONE)
-                            field["last_update"] = ts.isoformat()
-            
-            result.append(dashboard)
+            if not can_view_api_key(dashboard, current_user):
+                dashboard.pop("api_key", None)
+            for field in dashboard.get("fields", []):
+                # The frontend reads the latest reading as value
+                field["value"] = field.get("last_value")
+                if not field.get("last_update"):
+                    field["last_update"] = latest_updates.get((str(dashboard["_id"]), field["name"]))
         
-        print("Returning user dashboards:", len(result))
-        return result
+        print("Returning user dashboards:", len(dashboards))
+        return json_response(dashboards, response)
     except Exception as e:
         print("Error getting user dashboards:", str(e))
         raise HTTPException(
@@ -387,9 +384,37 @@ async def get_my_dashboards(
             detail=f"Failed to get user dashboards: {str(e)}"
         )
 
+@router.get("/purges")
+async def get_purge_jobs(
+    status: Optional[str] = Query(default=None, description="Only jobs in this state: pending, running, completed or failed"),
+    limit: int = Query(default=50, ge=1, le=500, description="Maximum number of jobs to return, newest first"),
+    current_user: User = Depends(get_current_admin_user)
+):
+    """Background data purges of deleted dashboards, with per-collection progress (admin only)"""
+    try:
+        return json_response(await dashboard_purger.list_jobs(status, limit))
+    except Exception as e:
+        print("Error getting purge jobs:", str(e))
+        raise HTTPException(status_code=500, detail=f"Failed to get purge jobs: {str(e)}")
+
+@router.get("/purges/{job_id}")
+async def get_purge_job(
+    job_id: str,
+    current_user: User = Depends(get_current_admin_user)
+):
+    """Progress of one dashboard data purge (admin only)"""
+    if not ObjectId.is_valid(job_id):
+        raise HTTPException(status_code=400, detail="Invalid purge job ID format")
+    job = await dashboard_purger.get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Purge job not found")
+    return json_response(job)
+
 @router.get("/{dashboard_id}", response_model=Dashboard)
 async def get_dashboard(
     dashboard_id: str,
+    request: Request,
+    response: Response,
     current_user: User = Depends(get_current_user)
 ):
     """Get a specific dashboard"""
@@ -409,6 +434,12 @@ async def get_dashboard(
             str(current_user.id) not in dashboard["assigned_users"] and 
             not dashboard["is_public"]):
             raise HTTPException(status_code=403, detail="Not authorized to access this dashboard")
+
+        not_modified = conditional_response(request, response, [dashboard], viewer_key(current_user))
+        if not_modified is not None:
+            return not_modified
+        if not can_view_api_key(dashboard, current_user):
+            dashboard.pop("api_key", None)
         
         # Process fields to map last_value to value for frontend
         if "fields" in dashboard:
@@ -418,48 +449,8 @@ async def get_dashboard(
                 else:
                     field["value"] = None
         
-        # Convert created_at and updated_at to IST ISO strings
-        if "created_at" in dashboard:
-            ts = dashboard["created_at"]
-            if ts.tzinfo is None:
-                ts = ts.replace(tzinfo=timezone.utc).astimezone(IST_TIMEZONE)
-            else:
-                ts = ts.astimezone(IST_TIMEZONE)
-            dashboard["created_at"] = ts.isoformat()
-        if "updated_at" in dashboard:
-            ts = dashboard["updated_at"]
-            if ts.tzinfo is None:
-                ts = ts.replace(tzinfo=timezone.utc).astimezone(IST_TIMEZONE)
-            else:
-                ts = ts.astimezone(IST_TIMEZONE)
-            dashboard["updated_at"] = ts.isoformat()
-        
-        # Ensure last_update is included for each field
-        if "fields" in dashboard:
-            for field in dashboard["fields"]:
-                # If last_update is missing or None, fetch from latest data point
-                if not field.get("last_update"):
-                    latest_dp = await mongodb.get_collection("data_points").find({
-                        "dashboard_id": str(dashboard["_id"]),
-                        "field_name": field["name"]
-                    }).sort("timestamp", -1).limit(1).to_list(length=1)
-                    if latest_dp:
-                        ts = latest_dp[0]["timestamp"]
-                        if hasattr(ts, "tzinfo") and ts.tzinfo is None:
-                            ts = ts.replace(tzinfo=timezone.utc).astimezone(IST_TIMEZONE)
-                        elif hasattr(ts, "tzinfo"):
-                            ts = ts.astimezone(IST_TIMEZONE)
-                        field["last_update"] = ts.isoformat()
-                    else:
-                        field["last_update"] = None
-                else:
-                    ts = field["last_update"]
-                    if ts and hasattr(ts, "tzinfo"):
-                        if ts.tzinfo is None:
-                            ts = ts.replace(tzinfo=timezone.utc).astimezone(IST_TIMEZONE)
-                        else:
-                            ts = ts.astimezone(IST_TIMEZONE)
-                        field["last_update"] = ts.isoformat()
+        # Field last_update is not part of the Dashboard model; only the dashboard's own timestamps need IST
+        to_ist_fields(dashboard, "created_at", "updated_at")
         
         return Dashboard(**{**dashboard, "_id": str(dashboard["_id"])})
     except HTTPException:
@@ -498,6 +489,11 @@ async def update_dashboard(
         # Update dashboard
         update_data = dashboard_update.dict(exclude_unset=True)
         update_data["updated_at"] = datetime.now(IST_TIMEZONE)
+        if update_data.get("retention") is not None:
+            try:
+                retention_compactor.check_policy(update_data["retention"])
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=f"Invalid retention: {str(e)}")
         
         # Ensure last_value and last_update are updated for all fields with a value
         if "fields" in update_data:
@@ -515,13 +511,14 @@ async def update_dashboard(
                         new_field["last_value"] = new_field["value"]
                         new_field["last_update"] = now
                         print(f"Inserting data point for field: {new_field['name']} with value: {new_field['value']}")
-                        await mongodb.get_collection("data_points").insert_one({
+                        data_point = {
                             "dashboard_id": str(object_id),
                             "field_name": new_field["name"],
                             "value": new_field["value"],
                             "timestamp": now,
                             "metadata": {"source": "dashboard_update"}
-                        })
+                        }
+                        await store_data_points([data_point])
                     else:
                         new_field["last_value"] = current_value
                         new_field["last_update"] = current_last_update
@@ -535,6 +532,8 @@ async def update_dashboard(
             {"_id": object_id},
             {"$set": update_data}
         )
+        dashboard_registry.invalidate(dashboard_id=dashboard_id, api_key=dashboard.get("api_key"))
+        response_cache.invalidate(dashboard_id)
         
         # Check for new assigned users and send emails
         new_assigned_users = set(update_data.get("assigned_users", [])) - current_assigned_users
@@ -562,37 +561,7 @@ async def update_dashboard(
                 # Don't fail the update if email sending fails
         
         updated_dashboard = await mongodb.get_collection("dashboards").find_one({"_id": object_id})
-        # Convert created_at and updated_at to IST ISO strings
-        if "created_at" in updated_dashboard:
-            ts = updated_dashboard["created_at"]
-            if ts.tzinfo is None:
-                ts = ts.replace(tzinfo=timezone.utc).astimezone(IST_TIMEZONE)
-            else:
-                ts = ts.astimezone(IST_TIMEZONE)
-            updated_dashboard["created_at"] = ts.isoformat()
-        if "updated_at" in updated_dashboard:
-            ts = updated_dashboard["updated_at"]
-            if ts.tzinfo is None:
-                ts = ts.replace(tzinfo=timezone.utc).astimezone(IST_TIMEZONE)
-            else:
-                ts = ts.astimezone(IST_TIMEZONE)
-            updated_dashboard["updated_at"] = ts.isoformat()
-        # Ensure last_update is included for each field using latest data point
-        if "fields" in updated_dashboard:
-            for field in updated_dashboard["fields"]:
-                latest_dp = await mongodb.get_collection("data_points").find({
-                    "dashboard_id": str(updated_dashboard["_id"]),
-                    "field_name": field["name"]
-                }).sort("timestamp", -1).limit(1).to_list(length=1)
-                if latest_dp:
-                    ts = latest_dp[0]["timestamp"]
-                    if hasattr(ts, "tzinfo") and ts.tzinfo is None:
-                        ts = ts.replace(tzinfo=timezone.utc).astimezone(IST_TIMEZONE)
-                    elif hasattr(ts, "tzinfo"):
-                        ts = ts.astimezone(IST_TIMEZONE)
-                    field["last_update"] = ts.isoformat()
-                else:
-                    field["last_update"] = None
+        to_ist_fields(updated_dashboard, "created_at", "updated_at")
         
         return Dashboard(**{**updated_dashboard, "_id": str(updated_dashboard["_id"])})
     except HTTPException:
@@ -636,12 +605,22 @@ async def delete_dashboard(
         
         # Delete from both collections
         await mongodb.get_collection("dashboards").delete_one({"_id": object_id})
+        dashboard_registry.invalidate(dashboard_id=dashboard_id, api_key=dashboard.get("api_key"))
+        response_cache.invalidate(dashboard_id)
         
         # Also delete from channels collection if it exists
         await mongodb.get_collection("channels").delete_one({"api_key": dashboard.get("api_key")})
         
+        # Its data points, buckets and rollups are deleted in the background, in small chunks
+        purge_job_id = None
+        try:
+            purge_job_id = await dashboard_purger.schedule(dashboard_id, dashboard.get("name"), str(current_user.id))
+        except Exception as e:
+            # The dashboard is gone either way; python -m app.cli purge-orphans picks its data up later
+            print("Error scheduling data purge:", str(e))
+        
         print("Dashboard deleted successfully")
-        return {"message": "Dashboard deleted successfully"}
+        return {"message": "Dashboard deleted successfully", "purge_job_id": purge_job_id}
     except HTTPException:
         raise
     except Exception as e:
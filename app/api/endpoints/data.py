@@ -1,12 +1,26 @@
 # app/api/endpoints/data.py
 
+import asyncio
 from datetime import datetime, timedelta, timezone
-from typing import List, Optional
-from fastapi import APIRouter, Depends, HTTPException, Query, Request, status, Body
+from typing import List, Optional, Tuple
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response, status, Body
+from fastapi.responses import StreamingResponse
+from pydantic import TypeAdapter
 from app.db.mongodb import mongodb
 from app.models.data import DataPointResponse, DataPointCreate
 from app.api.deps import get_current_user
+from app.api.conditional import conditional_response
+from app.api.serialization import cached_response, render_json
 from app.models.user import User
+from app.services.bucket_storage import store_data_points
+from app.services.last_value_coalescer import last_value_coalescer
+from app.services.response_cache import response_cache
+from app.services.timeseries import (
+    parse_interval, validate_bucket_request, fetch_buckets, fetch_page, decode_cursor, count_samples, fetch_raw_points, epoch_ms, columnar_series, to_ist,
+    MAX_DOWNSAMPLE_SOURCE_POINTS, COLUMNAR_FORMAT, COLUMNAR_MEDIA_TYPE
+)
+from app.services.downsampling import DOWNSAMPLE_METHODS, downsample_points
+from app.services.export import EXPORT_FORMATS, stream_export
 from bson import ObjectId
 # Removed BaseModel import as DeviceIngestRequest is moved
 # Removed DeviceIngestRequest import as it's moved
@@ -16,16 +30,34 @@ IST_TIMEZONE = timezone(timedelta(hours=5, minutes=30))
 
 router = APIRouter()
 
+# Renders data point lists exactly as response_model=List[DataPointResponse] would
+DATA_POINT_LIST = TypeAdapter(List[DataPointResponse])
+
 @router.get("/dashboard/{dashboard_id}/field/{field_name}/data", response_model=List[DataPointResponse])
 async def get_field_data(
     dashboard_id: str,
     field_name: str,
+    request: Request,
+    response: Response,
     hours: int = Query(default=24, description="Number of hours to fetch data for"),
     limit: int = Query(default=100, description="Maximum number of data points to return"),
+    interval: Optional[str] = Query(default=None, description="Aggregate into time buckets of this size (e.g. 5m, 1h, 1d); limit is ignored"),
+    agg: str = Query(default="avg", description="Bucket aggregation: avg, min, max, last or count"),
+    max_points: Optional[int] = Query(default=None, ge=3, description="Downsample the raw series in the range to at most this many points; limit is ignored"),
+    downsample: str = Query(default="lttb", description="Downsampling method for max_points: lttb or minmax"),
+    cursor: Optional[str] = Query(default=None, description="X-Next-Cursor value of the previous page, to fetch the next older page"),
+    format: Optional[str] = Query(default=None, description="Set to columnar for a compact {t: [epoch_ms...], v: [values...]} response"),
+    delta: bool = Query(default=False, description="Columnar format only: delta-encode the timestamps"),
     current_user: User = Depends(get_current_user)
 ):
     """
-    Get time-series data for a specific field in a dashboard
+    Get time-series data for a specific field in a dashboard.
+    With interval set, returns one aggregated point per time bucket instead of raw points.
+    With max_points set, returns a shape-preserving downsample of the raw points in the range.
+    Raw points come in pages of `limit`; when older points remain, the X-Next-Cursor response
+    header holds the cursor for the next page.
+    With format=columnar (or Accept: application/vnd.bluedrop.columnar+json) the series is returned
+    as parallel timestamp and value arrays instead of one object per point.
     """
     try:
         # Validate dashboard exists and user has access
@@ -42,44 +74,92 @@ async def get_field_data(
         if not field_exists:
             raise HTTPException(status_code=404, detail="Field not found in dashboard")
 
+        # No new readings since the client's copy: answer 304 without touching data_points
+        not_modified = conditional_response(request, response, [dashboard])
+        if not_modified is not None:
+            return not_modified
+
         # Calculate time range
         end_time = datetime.now(IST_TIMEZONE)
         start_time = end_time - timedelta(hours=hours)
 
-        # Fetch data points
-        cursor = mongodb.get_collection("data_points").find({
-            "dashboard_id": dashboard_id,
-            "field_name": field_name,
-            "timestamp": {"$gte": start_time, "$lte": end_time}
-        }).sort("timestamp", -1).limit(limit)
-
-        data_points = []
-        try:
-            async for doc in cursor:
-                # Convert timestamp to IST and serialize as ISO string
-                ts = doc["timestamp"]
-                if ts.tzinfo is None:
-                    # Treat naive datetime as UTC, then convert to IST
-                    ts = ts.replace(tzinfo=timezone.utc).astimezone(IST_TIMEZONE)
-                data_points.append(DataPointResponse(
+        if format is not None and format != COLUMNAR_FORMAT:
+            raise HTTPException(status_code=400, detail=f"Invalid format '{format}', expected {COLUMNAR_FORMAT}")
+        columnar = format == COLUMNAR_FORMAT or COLUMNAR_MEDIA_TYPE in request.headers.get("accept", "")
+        media_type = COLUMNAR_MEDIA_TYPE if columnar else "application/json"
+
+        if interval:
+            try:
+                interval_ms = parse_interval(interval)
+                validate_bucket_request(start_time, end_time, interval_ms, agg)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+        elif max_points and downsample not in DOWNSAMPLE_METHODS:
+            raise HTTPException(status_code=400, detail=f"Invalid downsample method '{downsample}', expected one of {', '.join(DOWNSAMPLE_METHODS)}")
+        elif cursor:
+            try:
+                decode_cursor(cursor)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+
+        async def load() -> Tuple[bytes, Optional[str]]:
+            """Query and render the series; returns the JSON body and the next page cursor"""
+            # Aggregated mode: one point per time bucket, computed in MongoDB
+            if interval:
+                buckets = await fetch_buckets(dashboard_id, field_name, start_time, end_time, interval_ms, agg)
+                if columnar:
+                    series = columnar_series(
+                        [bucket["bucket_ms"] for bucket in buckets],
+                        [bucket["value"] for bucket in buckets],
+                        delta,
+                        counts=[bucket["count"] for bucket in buckets]
+                    )
+                    return render_json(series), None
+                return DATA_POINT_LIST.dump_json([
+                    DataPointResponse(
+                        id=f"{field_name}:{bucket['bucket_ms']}",
+                        dashboard_id=dashboard_id,
+                        field_name=field_name,
+                        value=bucket["value"],
+                        timestamp=bucket["timestamp"],
+                        metadata={"aggregation": agg, "interval": interval, "count": bucket["count"]}
+                    )
+                    for bucket in buckets
+                ]), None
+
+            # Downsampled mode: the whole raw series in the range reduced to max_points,
+            # otherwise one page of data points, newest first, continuing from the cursor if given
+            next_cursor = None
+            if max_points:
+                points = downsample_points(
+                    await fetch_raw_points(dashboard_id, field_name, start_time, end_time, MAX_DOWNSAMPLE_SOURCE_POINTS),
+                    max_points,
+                    downsample
+                )
+            else:
+                points, next_cursor = await fetch_page(dashboard_id, field_name, start_time, end_time, limit, cursor, with_metadata=not columnar)
+            if columnar:
+                series = columnar_series([epoch_ms(doc["timestamp"]) for doc in points], [doc["value"] for doc in points], delta)
+                return render_json(series), next_cursor
+
+            data_points = [
+                DataPointResponse(
                     id=str(doc["_id"]),
-                    dashboard_id=doc["dashboard_id"],
-                    field_name=doc["field_name"],
+                    dashboard_id=dashboard_id,
+                    field_name=field_name,
                     value=doc["value"],
-                    timestamp=ts.isoformat(),
+                    timestamp=to_ist(doc["timestamp"]),
                     metadata=doc.get("metadata")
-                ))
-        except Exception as cursor_error:
-            print(f"Error iterating cursor for dashboard {dashboard_id}, field {field_name}: {cursor_error}")
-            # If there's an issue with data, it's better to return an empty array
-            # or raise a more specific error, rather than a generic 500 if data is malformed.
-            # For now, returning empty array as per original logic.
-            return []
-
-        # Reverse to get chronological order (oldest first)
-        data_points.reverse()
+                )
+                for doc in points
+            ]
+            return DATA_POINT_LIST.dump_json(data_points), next_cursor
 
-        return data_points
+        # Identical requests against the same dashboard version share one query and rendering
+        body, next_cursor = await response_cache.get_or_load(dashboard_id, response.headers["etag"], load)
+        if next_cursor:
+            response.headers["X-Next-Cursor"] = next_cursor
+        return cached_response(body, media_type, response)
 
     except HTTPException as http_exc:
         # Re-raise HTTPException directly
@@ -93,12 +173,20 @@ async def get_field_data(
 @router.get("/dashboard/{dashboard_id}/data", response_model=dict)
 async def get_dashboard_data(
     dashboard_id: str,
+    request: Request,
+    response: Response,
     hours: int = Query(default=24, description="Number of hours to fetch data for"),
     limit: int = Query(default=100, description="Maximum number of data points per field"),
+    interval: Optional[str] = Query(default=None, description="Aggregate into time buckets of this size (e.g. 5m, 1h, 1d); limit is ignored"),
+    agg: str = Query(default="avg", description="Bucket aggregation: avg, min, max, last or count"),
+    max_points: Optional[int] = Query(default=None, ge=3, description="Downsample the raw series in the range to at most this many points; limit is ignored"),
+    downsample: str = Query(default="lttb", description="Downsampling method for max_points: lttb or minmax"),
     current_user: User = Depends(get_current_user)
 ):
     """
-    Get time-series data for all fields in a dashboard
+    Get time-series data for all fields in a dashboard.
+    With interval set, returns one aggregated point per time bucket instead of raw points.
+    With max_points set, returns a shape-preserving downsample of the raw points in the range.
     """
     try:
         # Validate dashboard exists and user has access
@@ -110,53 +198,73 @@ async def get_dashboard_data(
         if not dashboard.get("is_public", False) and str(current_user.id) not in dashboard.get("assigned_users", []):
             raise HTTPException(status_code=403, detail="Access denied to this dashboard")
 
+        # No new readings since the client's copy: answer 304 without touching data_points
+        not_modified = conditional_response(request, response, [dashboard])
+        if not_modified is not None:
+            return not_modified
+
         # Calculate time range
         end_time = datetime.now(IST_TIMEZONE)
         start_time = end_time - timedelta(hours=hours)
 
-        # Get all fields in the dashboard
-        fields = dashboard.get("fields", [])
-        result = {}
-
-        for field in fields:
-            field_name = field["name"]
-
-            # Fetch data points for this field
-            cursor = mongodb.get_collection("data_points").find({
+        if interval:
+            try:
+                interval_ms = parse_interval(interval)
+                validate_bucket_request(start_time, end_time, interval_ms, agg)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+        elif max_points and downsample not in DOWNSAMPLE_METHODS:
+            raise HTTPException(status_code=400, detail=f"Invalid downsample method '{downsample}', expected one of {', '.join(DOWNSAMPLE_METHODS)}")
+
+        async def load_field(field_name: str) -> List[dict]:
+            # Aggregated mode: one point per time bucket, computed in MongoDB
+            if interval:
+                buckets = await fetch_buckets(dashboard_id, field_name, start_time, end_time, interval_ms, agg)
+                return [
+                    {
+                        "id": f"{field_name}:{bucket['bucket_ms']}",
+                        "value": bucket["value"],
+                        "timestamp": bucket["timestamp"],
+                        "metadata": {"aggregation": agg, "interval": interval, "count": bucket["count"]}
+                    }
+                    for bucket in buckets
+                ]
+
+            # Downsampled mode: the whole raw series in the range reduced to max_points,
+            # otherwise the newest `limit` raw points (already in chronological order)
+            if max_points:
+                points = await fetch_raw_points(dashboard_id, field_name, start_time, end_time, MAX_DOWNSAMPLE_SOURCE_POINTS)
+                points = downsample_points(points, max_points, downsample)
+            else:
+                points = await fetch_raw_points(dashboard_id, field_name, start_time, end_time, limit, with_metadata=True)
+
+            # Timestamps and ObjectIds are converted by render_json while encoding
+            return [
+                {"id": doc["_id"], "value": doc["value"], "timestamp": doc["timestamp"], "metadata": doc.get("metadata")}
+                for doc in points
+            ]
+
+        async def load() -> bytes:
+            # Query all fields concurrently, so latency follows the slowest field rather than the sum
+            field_names = [field["name"] for field in dashboard.get("fields", [])]
+            field_results = await asyncio.gather(*(load_field(field_name) for field_name in field_names))
+            result = dict(zip(field_names, field_results))
+
+            return render_json({
                 "dashboard_id": dashboard_id,
-                "field_name": field_name,
-                "timestamp": {"$gte": start_time, "$lte": end_time}
-            }).sort("timestamp", -1).limit(limit)
-
-            field_data = []
-            async for doc in cursor:
-                # Convert timestamp to IST and serialize as ISO string
-                ts = doc["timestamp"]
-                if ts.tzinfo is None:
-                    ts = ts.replace(tzinfo=timezone.utc).astimezone(IST_TIMEZONE)
-                else:
-                    ts = ts.astimezone(IST_TIMEZONE)
-                field_data.append({
-                    "id": str(doc["_id"]),
-                    "value": doc["value"],
-                    "timestamp": ts.isoformat(),
-                    "metadata": doc.get("metadata")
-                })
-
-            # Reverse to get chronological order (oldest first)
-            field_data.reverse()
-            result[field_name] = field_data
+                "dashboard_name": dashboard["name"],
+                "time_range": {
+                    "start": start_time,
+                    "end": end_time,
+                    "hours": hours
+                },
+                "aggregation": {"interval": interval, "agg": agg} if interval else None,
+                "fields": result
+            })
 
-        return {
-            "dashboard_id": dashboard_id,
-            "dashboard_name": dashboard["name"],
-            "time_range": {
-                "start": start_time.isoformat(),
-                "end": end_time.isoformat(),
-                "hours": hours
-            },
-            "fields": result
-        }
+        # Identical requests against the same dashboard version share one query and rendering
+        body = await response_cache.get_or_load(dashboard_id, response.headers["etag"], load)
+        return cached_response(body, "application/json", response)
 
     except HTTPException as http_exc:
         # Re-raise HTTPException directly
@@ -167,6 +275,61 @@ async def get_dashboard_data(
         print(f"Traceback: {traceback.format_exc()}")
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"An unexpected error occurred while fetching dashboard data: {str(e)}")
 
+@router.get("/dashboard/{dashboard_id}/export")
+async def export_dashboard_data(
+    dashboard_id: str,
+    format: str = Query(default="csv", description="Export format: csv or ndjson"),
+    field: Optional[List[str]] = Query(default=None, description="Only export these fields (repeatable); default is every field"),
+    start: Optional[datetime] = Query(default=None, description="Only export points at or after this time (IST when no offset is given)"),
+    end: Optional[datetime] = Query(default=None, description="Only export points at or before this time (IST when no offset is given)"),
+    gzip: bool = Query(default=False, description="Gzip the export (downloaded as .gz)"),
+    current_user: User = Depends(get_current_user)
+):
+    """
+    Export a dashboard's data points, oldest first, streamed straight from the database cursor
+    so exports of any size run in constant memory.
+    """
+    try:
+        # Validate dashboard exists and user has access
+        dashboard = await mongodb.get_collection("dashboards").find_one({"_id": ObjectId(dashboard_id)})
+        if not dashboard:
+            raise HTTPException(status_code=404, detail="Dashboard not found")
+
+        # Check if user has access to this dashboard
+        if not dashboard.get("is_public", False) and str(current_user.id) not in dashboard.get("assigned_users", []):
+            raise HTTPException(status_code=403, detail="Access denied to this dashboard")
+
+        if format not in EXPORT_FORMATS:
+            raise HTTPException(status_code=400, detail=f"Invalid export format '{format}', expected one of {', '.join(EXPORT_FORMATS)}")
+
+        # Check that requested fields exist in dashboard
+        if field:
+            known_fields = {dashboard_field["name"] for dashboard_field in dashboard.get("fields", [])}
+            unknown_fields = [field_name for field_name in field if field_name not in known_fields]
+            if unknown_fields:
+                raise HTTPException(status_code=404, detail=f"Field not found in dashboard: {', '.join(unknown_fields)}")
+
+        filename = f"dashboard_{dashboard_id}.{format}"
+        media_type = EXPORT_FORMATS[format]
+        if gzip:
+            filename += ".gz"
+            media_type = "application/gzip"
+
+        return StreamingResponse(
+            stream_export(dashboard_id, format, field, start, end, compress=gzip),
+            media_type=media_type,
+            headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+        )
+
+    except HTTPException as http_exc:
+        # Re-raise HTTPException directly
+        raise http_exc
+    except Exception as e:
+        import traceback
+        print(f"CRITICAL ERROR exporting data for dashboard {dashboard_id}: {str(e)}")
+        print(f"Traceback: {traceback.format_exc()}")
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"An unexpected error occurred while exporting dashboard data: {str(e)}")
+
 @router.post("/dashboard/{dashboard_id}/field/{field_name}/data")
 async def add_data_point(
     dashboard_id: str,
@@ -201,36 +364,17 @@ async def add_data_point(
             "metadata": {"source": "manual", "user_id": str(current_user.id)}
         }
 
-        # Store in database
-        result = await mongodb.get_collection("data_points").insert_one(data_point)
-
-        # Update dashboard field with latest value if the timestamp is newer
-        field_info = next((f for f in dashboard.get("fields", []) if f["name"] == field_name), None)
-        if field_info is not None:
-            last_update = field_info.get("last_update")
-            payload_ts = payload.timestamp
-            from datetime import timezone
-            # Ensure both are timezone-aware (UTC)
-            if last_update:
-                if hasattr(last_update, 'tzinfo') and last_update.tzinfo is None:
-                    last_update = last_update.replace(tzinfo=timezone.utc)
-                if hasattr(payload_ts, 'tzinfo') and payload_ts.tzinfo is None:
-                    payload_ts = payload_ts.replace(tzinfo=timezone.utc)
-            if not last_update or payload_ts > last_update:
-        await mongodb.get_collection("dashboards").update_one(
-            {"_id": ObjectId(dashboard_id), "fields.name": field_name},
-            {
-                "$set": {
-                            "fields.$.last_value": float(payload.value),
-                            "fields.$.last_update": payload.timestamp,
-                            "updated_at": payload.timestamp
-                }
-            }
-        )
+        # Store in database and fold the (possibly backfilled) point into the rollup buckets it falls in
+        if not await store_data_points([data_point]):
+            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Could not store data point")
+        response_cache.invalidate(dashboard_id)
+
+        # Update dashboard field with latest value; the coalescer only applies it if the timestamp is newer
+        last_value_coalescer.offer(dashboard_id, field_name, float(payload.value), payload.timestamp)
 
         return {
             "message": "Data point added successfully",
-            "data_point_id": str(result.inserted_id),
+            "data_point_id": str(data_point["_id"]),
             "value": payload.value,
             "timestamp": payload.timestamp.isoformat()
         }
@@ -265,7 +409,7 @@ async def test_dashboard_data(
         # Check data points for each field
         data_counts = {}
         for field_name in field_names:
-            count = await mongodb.get_collection("data_points").count_documents({
+            count = await count_samples({
                 "dashboard_id": dashboard_id,
                 "field_name": field_name
             })
@@ -276,7 +420,7 @@ async def test_dashboard_data(
             "dashboard_name": dashboard.get("name"),
             "fields": field_names,
             "data_counts": data_counts,
-            "total_data_points": await mongodb.get_collection("data_points").count_documents({
+            "total_data_points": await count_samples({
                 "dashboard_id": dashboard_id
             })
         }
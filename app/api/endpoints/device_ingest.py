@@ -1,11 +1,21 @@
 # app/api/endpoints/device_ingest.py
 
 from datetime import datetime, timedelta, timezone
-from fastapi import APIRouter, HTTPException, Request, status
+from fastapi import APIRouter, Depends, HTTPException, Request, status
 from pydantic import BaseModel
-from app.db.mongodb import mongodb
-from bson import ObjectId
-from typing import Optional
+from app.core.config import settings
+from app.services.dashboard_registry import dashboard_registry
+from app.services.ingest_buffer import ingest_buffer
+from app.services.bucket_storage import bucket_storage
+from app.services.dashboard_purge import dashboard_purger
+from app.services.last_value_coalescer import last_value_coalescer
+from app.services.response_cache import response_cache
+from app.services.retention import retention_compactor
+from app.services.rollups import rollup_service
+from app.services.mqtt_service import mqtt_service
+from app.api.deps import get_current_admin_user
+from app.schemas.user import User
+from typing import List, Optional
 
 # IST timezone (UTC+5:30) - Define here as it's used in this module
 IST_TIMEZONE = timezone(timedelta(hours=5, minutes=30))
@@ -18,6 +28,15 @@ class DeviceIngestRequest(BaseModel):
     value: float
     timestamp: Optional[datetime] = None  # Allow optional timestamp
 
+class DeviceIngestEntry(BaseModel):
+    field_name: str
+    value: float
+    timestamp: Optional[datetime] = None
+
+class DeviceIngestBatchRequest(BaseModel):
+    dashboard_id: str
+    entries: List[DeviceIngestEntry]
+
 @router.post("/device-ingest")
 async def device_ingest(
     request: Request,
@@ -34,24 +53,24 @@ async def device_ingest(
         if not api_key:
             raise HTTPException(status_code=401, detail="Missing API key")
 
-        # 2. Find dashboard with this API key
-        dashboard = await mongodb.get_collection("dashboards").find_one({"api_key": api_key})
+        # 2. Find dashboard with this API key (served from the in-memory registry)
+        dashboard = await dashboard_registry.get_by_api_key(api_key)
         if not dashboard:
             raise HTTPException(status_code=403, detail="Invalid API key or dashboard not found for this key")
 
         # 3. Check dashboard_id matches the one associated with the API key
-        if str(dashboard["_id"]) != payload.dashboard_id:
+        if dashboard.dashboard_id != payload.dashboard_id:
             raise HTTPException(status_code=403, detail="Provided dashboard ID does not match the API key's associated dashboard.")
 
         # 4. Check if the field exists in the dashboard's configuration
-        field_exists = any(field["name"] == payload.field_name for field in dashboard.get("fields", []))
-        if not field_exists:
+        dashboard = await dashboard_registry.ensure_fields(dashboard, [payload.field_name])
+        if not dashboard.has_field(payload.field_name):
             raise HTTPException(status_code=404, detail=f"Field '{payload.field_name}' not found in dashboard '{payload.dashboard_id}'.")
 
         # 5. Determine timestamp logic
         use_custom_timestamp = False
         # Check if dashboard has is_admin flag (or check user if you have user collection)
-        is_admin_dashboard = dashboard.get("is_admin", False)
+        is_admin_dashboard = dashboard.is_admin
         # Only allow custom timestamp if dashboard is admin
         if payload.timestamp is not None:
             if is_admin_dashboard:
@@ -72,23 +91,13 @@ async def device_ingest(
             "timestamp": timestamp_to_use,
             "metadata": {"source": "device", "api_key_used": api_key, "custom_timestamp": use_custom_timestamp}
         }
-        result = await mongodb.get_collection("data_points").insert_one(data_point)
-
-        # 7. Update the dashboard's field with the latest value and update timestamp if newer
-        await mongodb.get_collection("dashboards").update_one(
-            {"_id": ObjectId(payload.dashboard_id), "fields.name": payload.field_name},
-            {
-                "$set": {
-                    "fields.$.last_value": float(payload.value),
-                    "fields.$.last_update": timestamp_to_use,
-                    "updated_at": timestamp_to_use
-                }
-            }
-        )
+        data_point_id = await ingest_buffer.put(data_point)
+
+        # 7. The field's last value is updated by the coalescer once the buffer has written the point
 
         return {
             "message": "Data point ingested successfully",
-            "data_point_id": str(result.inserted_id),
+            "data_point_id": str(data_point_id),
             "value": payload.value,
             "timestamp": timestamp_to_use.isoformat(),
             "custom_timestamp": use_custom_timestamp
@@ -104,3 +113,123 @@ async def device_ingest(
         traceback.print_exc() # Print full traceback for debugging
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"An unexpected error occurred during data ingestion: {e}")
 
+@router.post("/device-ingest/batch")
+async def device_ingest_batch(
+    request: Request,
+    payload: DeviceIngestBatchRequest
+):
+    """
+    Batch endpoint for device data ingestion.
+    Accepts many readings, for one or more fields, in a single request.
+    The API key is checked once, accepted readings are written with one insert_many
+    and the last value of every touched field is updated with one bulk_write by the coalescer.
+    Each entry is reported back as accepted or rejected.
+    """
+    try:
+        # 1. Get API key from header
+        api_key = request.headers.get("X-API-KEY")
+        if not api_key:
+            raise HTTPException(status_code=401, detail="Missing API key")
+
+        if not payload.entries:
+            raise HTTPException(status_code=400, detail="Batch contains no entries")
+        if len(payload.entries) > settings.DEVICE_INGEST_MAX_BATCH:
+            raise HTTPException(
+                status_code=413,
+                detail=f"Batch contains {len(payload.entries)} entries, the maximum is {settings.DEVICE_INGEST_MAX_BATCH}."
+            )
+
+        # 2. Find dashboard with this API key (once for the whole batch)
+        dashboard = await dashboard_registry.get_by_api_key(api_key)
+        if not dashboard:
+            raise HTTPException(status_code=403, detail="Invalid API key or dashboard not found for this key")
+
+        # 3. Check dashboard_id matches the one associated with the API key
+        if dashboard.dashboard_id != payload.dashboard_id:
+            raise HTTPException(status_code=403, detail="Provided dashboard ID does not match the API key's associated dashboard.")
+
+        dashboard = await dashboard_registry.ensure_fields(dashboard, {entry.field_name for entry in payload.entries})
+        is_admin_dashboard = dashboard.is_admin
+        now = datetime.now(IST_TIMEZONE)
+
+        # 4. Validate every entry, collecting accepted data points and per-entry results
+        results = []
+        data_points = []
+        accepted_indexes = []
+        for index, entry in enumerate(payload.entries):
+            if not dashboard.has_field(entry.field_name):
+                results.append({
+                    "index": index,
+                    "field_name": entry.field_name,
+                    "status": "rejected",
+                    "detail": f"Field '{entry.field_name}' not found in dashboard '{payload.dashboard_id}'."
+                })
+                continue
+            if entry.timestamp is not None and not is_admin_dashboard:
+                results.append({
+                    "index": index,
+                    "field_name": entry.field_name,
+                    "status": "rejected",
+                    "detail": "Only admin dashboards can set a custom timestamp."
+                })
+                continue
+
+            use_custom_timestamp = entry.timestamp is not None
+            timestamp_to_use = entry.timestamp if use_custom_timestamp else now
+            data_points.append({
+                "dashboard_id": payload.dashboard_id,
+                "field_name": entry.field_name,
+                "value": float(entry.value),
+                "timestamp": timestamp_to_use,
+                "metadata": {"source": "device_batch", "api_key_used": api_key, "custom_timestamp": use_custom_timestamp}
+            })
+            accepted_indexes.append(len(results))
+            results.append({
+                "index": index,
+                "field_name": entry.field_name,
+                "status": "accepted",
+                "value": entry.value,
+                "timestamp": timestamp_to_use.isoformat(),
+                "custom_timestamp": use_custom_timestamp
+            })
+
+        # 5. Hand all accepted data points to the ingest buffer, written with insert_many
+        if data_points:
+            inserted_ids = await ingest_buffer.put_many(data_points)
+            for result_index, inserted_id in zip(accepted_indexes, inserted_ids):
+                results[result_index]["data_point_id"] = str(inserted_id)
+
+        # 6. Last values of all touched fields are written by the coalescer in one bulk_write per window
+
+        return {
+            "message": "Batch ingested",
+            "accepted": len(data_points),
+            "rejected": len(results) - len(data_points),
+            "results": results
+        }
+
+    except HTTPException as http_exc:
+        # Re-raise HTTPException directly as they are intended client errors
+        raise http_exc
+    except Exception as e:
+        import traceback
+        print(f"CRITICAL ERROR during batch device data ingestion: {e}")
+        traceback.print_exc()
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"An unexpected error occurred during batch data ingestion: {e}")
+
+@router.get("/ingest/stats")
+async def ingest_stats(
+    current_user: User = Depends(get_current_admin_user)
+):
+    """Ingest pipeline statistics: queue depths, message counters, flush sizes and latencies (admin only)"""
+    return {
+        "ingest_buffer": ingest_buffer.stats(),
+        "last_value_coalescer": last_value_coalescer.stats(),
+        "dashboard_purger": dashboard_purger.stats(),
+        "retention_compactor": retention_compactor.stats(),
+        "bucket_storage": bucket_storage.stats(),
+        "rollups": rollup_service.stats(),
+        "response_cache": response_cache.stats(),
+        "mqtt": mqtt_service.work_queue.stats(),
+        "dashboard_registry": dashboard_registry.stats()
+    }
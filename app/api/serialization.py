@@ -0,0 +1,57 @@
+"""
+JSON rendering shared by the API endpoints.
+
+Responses are encoded with orjson in a single pass: datetimes (naive BSON values are UTC)
+come out as IST ISO strings and ObjectIds as strings while encoding, so endpoints can
+return MongoDB documents as they are instead of converting them field by field first.
+"""
+from datetime import datetime
+from typing import Any, Optional
+import orjson
+from bson import ObjectId
+from fastapi import Response
+from fastapi.responses import JSONResponse
+from app.services.timeseries import to_ist
+
+# Headers set on the injected response that must be carried over when a response is returned directly
+PASSTHROUGH_HEADERS = ("etag", "last-modified", "cache-control", "x-next-cursor")
+
+JSON_OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+def _default(obj: Any) -> Any:
+    if isinstance(obj, datetime):
+        return to_ist(obj).isoformat()
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+def render_json(content: Any) -> bytes:
+    return orjson.dumps(content, default=_default, option=JSON_OPTIONS)
+
+def to_ist_fields(doc: dict, *names: str) -> dict:
+    """Convert the named datetime values of a document to IST in place, for responses rendered by pydantic models"""
+    for name in names:
+        if isinstance(doc.get(name), datetime):
+            doc[name] = to_ist(doc[name])
+    return doc
+
+class FastJSONResponse(JSONResponse):
+    """Default response class of the app; renders with render_json"""
+
+    def render(self, content: Any) -> bytes:
+        return render_json(content)
+
+def json_response(content: Any, response: Optional[Response] = None, status_code: int = 200) -> FastJSONResponse:
+    """
+    Render content directly, skipping FastAPI's jsonable_encoder pass, and keep the validator
+    and paging headers set on the injected response
+    """
+    headers = None
+    if response is not None:
+        headers = {name: response.headers[name] for name in PASSTHROUGH_HEADERS if name in response.headers}
+    return FastJSONResponse(content=content, status_code=status_code, headers=headers)
+
+def cached_response(body: bytes, media_type: str, response: Response) -> Response:
+    """Send an already rendered body, keeping the validator and paging headers set on the injected response"""
+    headers = {name: response.headers[name] for name in PASSTHROUGH_HEADERS if name in response.headers}
+    return Response(content=body, media_type=media_type, headers=headers)
@@ -0,0 +1,102 @@
+"""
+Maintenance commands.
+
+    python -m app.cli rebuild-rollups [--dashboard-id ID]
+    python -m app.cli migrate-buckets [--dashboard-id ID]
+    python -m app.cli ensure-indexes
+    python -m app.cli index-report
+    python -m app.cli purge-orphans [--run]
+    python -m app.cli compact
+"""
+import argparse
+import asyncio
+import json
+import logging
+from app.db.indexes import ensure_indexes, index_report
+from app.db.mongodb import mongodb
+from app.services.bucket_storage import bucket_storage
+from app.services.dashboard_purge import dashboard_purger
+from app.services.retention import retention_compactor
+from app.services.rollups import rollup_service
+
+logger = logging.getLogger(__name__)
+
+async def rebuild_rollups(args):
+    rebuilt = await rollup_service.rebuild(dashboard_id=args.dashboard_id)
+    for resolution, buckets in rebuilt.items():
+        print(f"{resolution}: {buckets} buckets")
+
+async def migrate_buckets(args):
+    buckets = await bucket_storage.migrate(dashboard_id=args.dashboard_id)
+    print(f"{buckets} buckets of {bucket_storage.span_seconds}s")
+
+async def ensure_indexes_command(args):
+    result = await ensure_indexes()
+    for outcome in ("created", "existing", "conflicts", "failed"):
+        print(f"{outcome}: {', '.join(result[outcome]) or '-'}")
+
+async def index_report_command(args):
+    report = await index_report()
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    for collection_name, entry in report.items():
+        print(f"{collection_name}: missing={entry['missing'] or '-'} undeclared={entry['undeclared'] or '-'} unused={entry['unused'] or '-'}")
+
+async def purge_orphans(args):
+    job_ids = await dashboard_purger.schedule_orphans()
+    print(f"Scheduled {len(job_ids)} purge jobs for data of deleted dashboards")
+    if args.run:
+        # Run every waiting job here instead of leaving them to the API and ingest workers
+        while await dashboard_purger.run_next():
+            pass
+        print(f"Deleted {dashboard_purger.deleted} documents")
+
+async def compact(args):
+    report = await retention_compactor.run_once()
+    print(json.dumps(report, indent=2))
+
+COMMANDS = {
+    "rebuild-rollups": rebuild_rollups,
+    "migrate-buckets": migrate_buckets,
+    "ensure-indexes": ensure_indexes_command,
+    "index-report": index_report_command,
+    "purge-orphans": purge_orphans,
+    "compact": compact,
+}
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m app.cli", description="BlueDrop maintenance commands")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    rebuild = subparsers.add_parser("rebuild-rollups", help="Recompute the 1m/1h/1d rollups from the raw data; rollups whose raw data has expired under retention are kept as they are")
+    rebuild.add_argument("--dashboard-id", help="Only rebuild this dashboard (default: all dashboards)")
+
+    migrate = subparsers.add_parser("migrate-buckets", help="Copy data_points into the bucketed layout (data_buckets)")
+    migrate.add_argument("--dashboard-id", help="Only migrate this dashboard (default: all dashboards)")
+
+    subparsers.add_parser("ensure-indexes", help="Create the indexes declared in app/db/indexes.py that are missing")
+
+    report = subparsers.add_parser("index-report", help="List missing, undeclared and unused indexes")
+    report.add_argument("--json", action="store_true", help="Print the full report, including per-index usage, as JSON")
+
+    orphans = subparsers.add_parser("purge-orphans", help="Schedule purges of data left behind by deleted dashboards")
+    orphans.add_argument("--run", action="store_true", help="Run the purge jobs in this process and wait for them")
+
+    subparsers.add_parser("compact", help="Apply retention now: summarise and delete expired raw data and summaries, and report reclaimed space")
+
+    return parser
+
+async def run(args):
+    await mongodb.connect_to_mongodb()
+    try:
+        await COMMANDS[args.command](args)
+    finally:
+        await mongodb.close_mongodb_connection()
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    asyncio.run(run(build_parser().parse_args()))
+
+if __name__ == "__main__":
+    main()
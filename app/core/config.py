@@ -9,6 +9,7 @@ class Settings(BaseSettings):
     
     # MongoDB Configuration
     MONGODB_URI: str = os.getenv("MONGODB_URI", "mongodb://localhost:27017/bluedrop_cloudflare")
+    ENSURE_INDEXES_ON_STARTUP: bool = os.getenv("ENSURE_INDEXES_ON_STARTUP", "True").lower() == "true"  # see app/db/indexes.py
     
     # JWT Configuration
     SECRET_KEY: str = os.getenv("JWT_SECRET", "your_jwt_secret_key_here")
@@ -34,6 +35,51 @@ class Settings(BaseSettings):
     MQTT_PORT: int = int(os.getenv("MQTT_PORT", "1883"))      # Default to 1883 for local dev
     MQTT_USERNAME: str = os.getenv("MQTT_USERNAME", "mqtt_user")
     MQTT_PASSWORD: str = os.getenv("MQTT_PASSWORD", "mqtt_password")
+    MQTT_ENABLED: bool = os.getenv("MQTT_ENABLED", "True").lower() == "true"  # false when a separate ingest worker consumes MQTT
+    MQTT_PROTOCOL: str = os.getenv("MQTT_PROTOCOL", "5")  # "5" or "3.1.1"
+    MQTT_SHARED_GROUP: str = os.getenv("MQTT_SHARED_GROUP", "tankmanage-ingest")  # empty disables shared subscriptions
+    MQTT_CLIENT_ID_PREFIX: str = os.getenv("MQTT_CLIENT_ID_PREFIX", "bluedrop-ingest")
+    MQTT_QUEUE_MAX_SIZE: int = int(os.getenv("MQTT_QUEUE_MAX_SIZE", "5000"))
+    MQTT_WORKERS: int = int(os.getenv("MQTT_WORKERS", "4"))
+    MQTT_OVERFLOW_POLICY: str = os.getenv("MQTT_OVERFLOW_POLICY", "drop_oldest")  # block, drop_oldest or spill
+    MQTT_BLOCK_TIMEOUT_MS: int = int(os.getenv("MQTT_BLOCK_TIMEOUT_MS", "1000"))
+    MQTT_SPILL_PATH: str = os.getenv("MQTT_SPILL_PATH", "/tmp/mqtt_spill.jsonl")  # each process spills to this path with its host and pid added
+    
+    # Device Ingest Configuration
+    DEVICE_INGEST_MAX_BATCH: int = int(os.getenv("DEVICE_INGEST_MAX_BATCH", "1000"))
+    DASHBOARD_REGISTRY_TTL_SECONDS: int = int(os.getenv("DASHBOARD_REGISTRY_TTL_SECONDS", "300"))
+    
+    # Ingest Buffer Configuration (write-behind to data_points)
+    INGEST_BUFFER_MAX_SIZE: int = int(os.getenv("INGEST_BUFFER_MAX_SIZE", "10000"))
+    INGEST_FLUSH_BATCH_SIZE: int = int(os.getenv("INGEST_FLUSH_BATCH_SIZE", "500"))
+    INGEST_FLUSH_INTERVAL_MS: int = int(os.getenv("INGEST_FLUSH_INTERVAL_MS", "200"))
+    LAST_VALUE_FLUSH_INTERVAL_MS: int = int(os.getenv("LAST_VALUE_FLUSH_INTERVAL_MS", "1000"))
+
+    # Storage Layout Configuration: "documents" (one data_points document per reading) or
+    # "buckets" (per-field time buckets in data_buckets; migrate with python -m app.cli migrate-buckets)
+    STORAGE_LAYOUT: str = os.getenv("STORAGE_LAYOUT", "documents")
+    BUCKET_SPAN_SECONDS: int = int(os.getenv("BUCKET_SPAN_SECONDS", "3600"))
+
+    # Rollup Configuration (1m / 1h / 1d summaries maintained on write, used by bucketed queries)
+    ROLLUPS_ENABLED: bool = os.getenv("ROLLUPS_ENABLED", "True").lower() == "true"
+    ROLLUP_REPAIR_INTERVAL_SECONDS: float = float(os.getenv("ROLLUP_REPAIR_INTERVAL_SECONDS", "30"))
+
+    # Response Cache Configuration (rendered data endpoint responses, per process)
+    RESPONSE_CACHE_ENABLED: bool = os.getenv("RESPONSE_CACHE_ENABLED", "True").lower() == "true"
+    RESPONSE_CACHE_MAX_ENTRIES: int = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1000"))
+    RESPONSE_CACHE_TTL_SECONDS: float = float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "10"))
+    
+    # Dashboard Purge Configuration (background deletion of a deleted dashboard's data)
+    PURGE_CHUNK_SIZE: int = int(os.getenv("PURGE_CHUNK_SIZE", "1000"))
+    PURGE_CHUNK_DELAY_MS: int = int(os.getenv("PURGE_CHUNK_DELAY_MS", "200"))
+    PURGE_POLL_INTERVAL_SECONDS: float = float(os.getenv("PURGE_POLL_INTERVAL_SECONDS", "30"))
+    
+    # Retention Configuration (defaults for dashboards without their own retention; 0 keeps data forever).
+    # Expiring raw readings are summarised into the rollups before the compactor deletes them,
+    # in PURGE_CHUNK_SIZE chunks.
+    RETENTION_RAW_DAYS: int = int(os.getenv("RETENTION_RAW_DAYS", "0"))
+    RETENTION_SUMMARY_DAYS: int = int(os.getenv("RETENTION_SUMMARY_DAYS", "0"))
+    RETENTION_COMPACT_INTERVAL_SECONDS: float = float(os.getenv("RETENTION_COMPACT_INTERVAL_SECONDS", "3600"))
     
     # Frontend Configuration
     FRONTEND_URL: str = os.getenv("VITE_API_URL", "http://localhost:8000")
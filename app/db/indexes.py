@@ -0,0 +1,128 @@
+"""
+Indexes the application's queries rely on, declared in one place.
+
+ensure_indexes() creates any that are missing (at startup, or with
+`python -m app.cli ensure-indexes`); index_report() lists declared indexes that
+are missing, indexes nobody declared, and indexes with no recorded use.
+"""
+import logging
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+from app.db.mongodb import mongodb
+
+logger = logging.getLogger(__name__)
+
+# Server error codes for an index that exists with the same keys or name but different options
+INDEX_CONFLICT_CODES = (85, 86)
+
+class IndexSpec(NamedTuple):
+    collection: str
+    keys: List[Tuple[str, int]]
+    options: Dict[str, Any] = {}
+    reason: str = ""
+
+    @property
+    def name(self) -> str:
+        return "_".join(f"{field}_{direction}" for field, direction in self.keys)
+
+REQUIRED_INDEXES: List[IndexSpec] = [
+    # Users: login/registration lookups and token links from emails
+    IndexSpec("users", [("username", ASCENDING)], {"unique": True}, "login, registration"),
+    IndexSpec("users", [("email", ASCENDING)], {"unique": True}, "registration, password reset"),
+    IndexSpec("users", [("verification_token", ASCENDING)], {"sparse": True}, "email verification"),
+    IndexSpec("users", [("reset_token", ASCENDING)], {"sparse": True}, "password reset"),
+
+    # Dashboards: device api keys and the per-user listing ($or over the three clauses)
+    IndexSpec("dashboards", [("api_key", ASCENDING)], {"unique": True}, "device ingest"),
+    IndexSpec("dashboards", [("assigned_users", ASCENDING)], {}, "my-dashboards, dashboard listing filter, user deletion"),
+    IndexSpec("dashboards", [("created_by", ASCENDING)], {}, "my-dashboards, dashboard listing filter"),
+    IndexSpec("dashboards", [("is_public", ASCENDING)], {}, "my-dashboards, dashboard listing filter"),
+
+    IndexSpec("channels", [("api_key", ASCENDING)], {}, "dashboard deletion"),
+
+    # Data points: per-field range scans and keyset pages, per-dashboard exports
+    IndexSpec(
+        "data_points",
+        [("dashboard_id", ASCENDING), ("field_name", ASCENDING), ("timestamp", DESCENDING), ("_id", DESCENDING)],
+        {},
+        "field data, pagination, buckets, latest value",
+    ),
+    IndexSpec("data_points", [("dashboard_id", ASCENDING), ("timestamp", ASCENDING)], {}, "export, dashboard purge"),
+
+    # Bucketed layout and rollups: unique per series and bucket, targeted by upserts
+    IndexSpec("data_buckets", [("dashboard_id", ASCENDING), ("field_name", ASCENDING), ("start", ASCENDING)], {"unique": True}, "bucket appends and reads"),
+    IndexSpec("data_buckets", [("dashboard_id", ASCENDING), ("start", ASCENDING)], {}, "bucketed export"),
+    IndexSpec("data_rollups_1m", [("dashboard_id", ASCENDING), ("field_name", ASCENDING), ("bucket", ASCENDING)], {"unique": True}, "rollups"),
+    IndexSpec("data_rollups_1h", [("dashboard_id", ASCENDING), ("field_name", ASCENDING), ("bucket", ASCENDING)], {"unique": True}, "rollups"),
+    IndexSpec("data_rollups_1d", [("dashboard_id", ASCENDING), ("field_name", ASCENDING), ("bucket", ASCENDING)], {"unique": True}, "rollups"),
+
+    IndexSpec("rollup_repairs", [("dashboard_id", ASCENDING), ("day", ASCENDING)], {"unique": True}, "rollup repair queue"),
+    IndexSpec("purge_jobs", [("status", ASCENDING), ("created_at", ASCENDING)], {}, "dashboard purge claims and listing"),
+]
+
+def _key_pattern(keys: Iterable) -> Tuple[Tuple[str, Any], ...]:
+    return tuple((field, int(direction) if isinstance(direction, (int, float)) else direction) for field, direction in keys)
+
+def _specs(collections: Optional[Iterable[str]]) -> List[IndexSpec]:
+    if collections is None:
+        return REQUIRED_INDEXES
+    collections = set(collections)
+    return [spec for spec in REQUIRED_INDEXES if spec.collection in collections]
+
+async def ensure_indexes(collections: Optional[Iterable[str]] = None) -> Dict[str, List[str]]:
+    """
+    Create the declared indexes (optionally only for some collections) that do not exist yet.
+    An index that exists with the same keys but other options is reported as a conflict, not replaced.
+    """
+    result: Dict[str, List[str]] = {"created": [], "existing": [], "conflicts": [], "failed": []}
+    existing_by_collection: Dict[str, set] = {}
+    for spec in _specs(collections):
+        if spec.collection not in existing_by_collection:
+            info = await mongodb.get_collection(spec.collection).index_information()
+            existing_by_collection[spec.collection] = {_key_pattern(index["key"]) for index in info.values()}
+        label = f"{spec.collection}.{spec.name}"
+        if _key_pattern(spec.keys) in existing_by_collection[spec.collection]:
+            result["existing"].append(label)
+            continue
+        try:
+            await mongodb.get_collection(spec.collection).create_index(spec.keys, name=spec.name, **spec.options)
+            existing_by_collection[spec.collection].add(_key_pattern(spec.keys))
+            result["created"].append(label)
+            logger.info(f"Created index {label}")
+        except OperationFailure as e:
+            if e.code in INDEX_CONFLICT_CODES:
+                result["conflicts"].append(label)
+                logger.warning(f"Index {label} conflicts with an existing index: {e}")
+            else:
+                # e.g. duplicate keys in existing data for a unique index; keep going with the rest
+                result["failed"].append(label)
+                logger.error(f"Could not create index {label}: {e}")
+    return result
+
+async def index_report() -> Dict[str, Dict[str, Any]]:
+    """
+    Per collection: declared indexes that are missing, existing indexes that are not declared,
+    and indexes with no recorded use since the server started (from $indexStats).
+    """
+    report: Dict[str, Dict[str, Any]] = {}
+    for collection_name in sorted({spec.collection for spec in REQUIRED_INDEXES}):
+        collection = mongodb.get_collection(collection_name)
+        declared = {_key_pattern(spec.keys): spec.name for spec in REQUIRED_INDEXES if spec.collection == collection_name}
+        info = await collection.index_information()
+        present = {_key_pattern(index["key"]): name for name, index in info.items()}
+
+        usage = {}
+        try:
+            async for stats in collection.aggregate([{"$indexStats": {}}]):
+                usage[stats["name"]] = {"ops": stats["accesses"]["ops"], "since": stats["accesses"]["since"].isoformat()}
+        except OperationFailure as e:
+            logger.warning(f"Could not read index usage for {collection_name}: {e}")
+
+        report[collection_name] = {
+            "missing": [name for key, name in declared.items() if key not in present],
+            "undeclared": [name for key, name in present.items() if key not in declared and name != "_id_"],
+            "unused": [name for name, stats in usage.items() if stats["ops"] == 0 and name != "_id_"],
+            "usage": usage,
+        }
+    return report
@@ -0,0 +1,96 @@
+"""
+Standalone ingest worker: runs the MQTT consumer and the ingest buffers without the HTTP API.
+
+    python -m app.ingest
+
+Run the API server with MQTT_ENABLED=false next to one or more of these so ingest and
+dashboard queries scale (and can be pinned to cores or containers) independently.
+"""
+import asyncio
+import logging
+import signal
+from app.core.config import settings
+from app.db.indexes import ensure_indexes
+from app.db.mongodb import mongodb
+from app.services.dashboard_purge import dashboard_purger
+from app.services.dashboard_registry import dashboard_registry
+from app.services.ingest_buffer import ingest_buffer
+from app.services.last_value_coalescer import last_value_coalescer
+from app.services.mqtt_service import start_mqtt_service, stop_mqtt_service
+from app.services.retention import retention_compactor
+from app.services.rollups import rollup_service
+
+logger = logging.getLogger(__name__)
+
+async def start_ingest_pipeline(with_mqtt: bool, require_mqtt: bool = False):
+    """
+    Ensure indexes, then start the ingest buffers, the dashboard purger, the retention compactor
+    and, optionally, the MQTT consumer (MongoDB must be connected). With require_mqtt, a consumer
+    that cannot start is raised instead of logged, for processes that exist only to consume MQTT.
+    """
+    # Warm the api_key -> dashboard registry used by the ingest paths
+    try:
+        await dashboard_registry.warm()
+    except Exception as e:
+        logger.warning(f"Could not warm dashboard registry: {e}")
+
+    # Create any missing indexes the queries, rollup upserts and bucket appends rely on
+    if settings.ENSURE_INDEXES_ON_STARTUP:
+        try:
+            result = await ensure_indexes()
+            if result["conflicts"] or result["failed"]:
+                logger.warning(f"Indexes not created (run python -m app.cli index-report): {result['conflicts'] + result['failed']}")
+        except Exception as e:
+            logger.warning(f"Could not ensure indexes: {e}")
+
+    # Start the write-behind ingest buffer and last value coalescer before anything can produce readings
+    await last_value_coalescer.start()
+    await ingest_buffer.start()
+
+    # Recompute rollup days whose incremental updates failed
+    await rollup_service.start()
+    # Background purges of deleted dashboards' data (resumes jobs left unfinished by a restart)
+    await dashboard_purger.start()
+    # Retention: summarise, then delete, raw data and summaries past each dashboard's retention
+    await retention_compactor.start()
+
+    if with_mqtt:
+        try:
+            start_mqtt_service(asyncio.get_running_loop())
+        except Exception as e:
+            if require_mqtt:
+                raise
+            logger.warning(f"Could not start MQTT service: {e}")
+
+async def stop_ingest_pipeline():
+    """Stop consuming, then drain buffered readings while the database connection is still open"""
+    await retention_compactor.stop()
+    await dashboard_purger.stop()
+    await rollup_service.stop()
+    await stop_mqtt_service()
+    await ingest_buffer.stop()
+    await last_value_coalescer.stop()
+
+async def run():
+    await mongodb.connect_to_mongodb()
+    # Without its consumer this worker would sit idle while device data is lost: exit non-zero
+    # so the supervisor (restart: unless-stopped in docker-compose) starts it again
+    await start_ingest_pipeline(with_mqtt=True, require_mqtt=True)
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    logger.info("Ingest worker running")
+    await stop_event.wait()
+
+    logger.info("Ingest worker shutting down")
+    await stop_ingest_pipeline()
+    await mongodb.close_mongodb_connection()
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    asyncio.run(run())
+
+if __name__ == "__main__":
+    main()
@@ -5,8 +5,9 @@ from fastapi.middleware.cors import CORSMiddleware
 from app.core.config import settings
 from app.db.mongodb import mongodb
 from app.api import deps
+from app.api.serialization import FastJSONResponse
 from app.core.security import get_password_hash
-from app.services.mqtt_service import start_mqtt_service, stop_mqtt_service
+from app.ingest import start_ingest_pipeline, stop_ingest_pipeline
 import secrets
 import string
 from datetime import datetime, timezone, timedelta
@@ -18,7 +19,8 @@ IST_TIMEZONE = timezone(timedelta(hours=5, minutes=30))
 app = FastAPI(
     title=settings.PROJECT_NAME,
     version=settings.VERSION,
-    openapi_url=f"{settings.API_V1_STR}/openapi.json"
+    openapi_url=f"{settings.API_V1_STR}/openapi.json",
+    default_response_class=FastJSONResponse
 )
 
 # CORS middleware
@@ -36,6 +38,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "ETag", "Last-Modified"],
 )
 
 # Get the current directory
@@ -67,17 +70,13 @@ async def startup_db_client():
         }
         await mongodb.get_collection("users").insert_one(admin_user)
     
-    # Start MQTT service
-    try:
-        start_mqtt_service()
-    except Exception as e:
-        print(f"Warning: Could not start MQTT service: {e}")
+    # Start the ingest buffers, and the MQTT consumer unless a separate ingest worker runs it
+    await start_ingest_pipeline(with_mqtt=settings.MQTT_ENABLED)
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    await stop_ingest_pipeline()
     await mongodb.close_mongodb_connection()
-    # Stop MQTT service
-    stop_mqtt_service()
 
 def generate_api_key(length: int = 12) -> str:
     """Generate a random API key"""
@@ -1,4 +1,4 @@
-from typing import List, Optional, Any
+from typing import Any, Dict, List, Optional
 from pydantic import BaseModel, Field
 from datetime import datetime
 
@@ -20,12 +20,20 @@ class Widget(BaseModel):
     axisLabels: Optional[dict] = None
     rules: Optional[list] = None
 
+class DashboardRetention(BaseModel):
+    # Days to keep raw readings / 1m-1h-1d summaries; None uses the server default, 0 keeps them forever
+    raw_days: Optional[int] = Field(default=None, ge=0)
+    summary_days: Optional[int] = Field(default=None, ge=0)
+    # Per-resolution overrides of summary_days, e.g. {"1m": 30, "1h": 365, "1d": 730}
+    summary_days_by_resolution: Optional[Dict[str, int]] = None
+
 class DashboardBase(BaseModel):
     name: str
     description: Optional[str] = ""
     fields: List[DashboardField] = []
     widgets: List[Widget] = []
     assigned_users: List[str] = []
+    retention: Optional[DashboardRetention] = None
 
 class DashboardCreate(DashboardBase):
     is_public: bool = False
@@ -37,11 +45,13 @@ class DashboardUpdate(BaseModel):
     fields: Optional[List[DashboardField]] = None
     widgets: Optional[List[Widget]] = None
     assigned_users: Optional[List[str]] = None
+    retention: Optional[DashboardRetention] = None
 
 class Dashboard(DashboardBase):
     id: str = Field(alias="_id")
     created_by: str
-    api_key: str
+    # Only returned to the dashboard's creator and admins
+    api_key: Optional[str] = None
     created_at: datetime
     updated_at: datetime
 
@@ -0,0 +1,286 @@
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from app.core.config import settings
+from app.db.indexes import ensure_indexes
+from app.db.mongodb import mongodb
+from app.services.rollups import rollup_service
+from app.services.timeseries import bucket_start_expression, floor_to_bucket
+
+logger = logging.getLogger(__name__)
+
+BUCKET_COLLECTION = "data_buckets"
+
+STORAGE_LAYOUTS = ("documents", "buckets")
+
+# Stages turning bucket documents into one {dashboard_id, field_name, i, timestamp, value} document per sample
+UNWIND_SAMPLE_STAGES = [
+    {"$project": {"dashboard_id": 1, "field_name": 1, "sample": {"$zip": {"inputs": ["$t", "$v"]}}}},
+    {"$unwind": {"path": "$sample", "includeArrayIndex": "i"}},
+    {"$project": {
+        "dashboard_id": 1,
+        "field_name": 1,
+        "i": 1,
+        "timestamp": {"$arrayElemAt": ["$sample", 0]},
+        "value": {"$arrayElemAt": ["$sample", 1]},
+    }},
+]
+
+def _naive_utc(ts: datetime) -> datetime:
+    """BSON datetimes come back naive UTC; normalise bounds so they can be compared"""
+    if ts.tzinfo is None:
+        return ts
+    return ts.astimezone(timezone.utc).replace(tzinfo=None)
+
+def sample_id(bucket_id, index: int) -> str:
+    """Id of a sample in the bucketed layout: its bucket's _id and position"""
+    return f"{bucket_id}:{index}"
+
+def parse_sample_id(point_id: str) -> Tuple[str, int]:
+    bucket_id, _, index = point_id.rpartition(":")
+    return bucket_id, int(index)
+
+class BucketStorage:
+    """
+    Bucketed layout for data points: one document per (dashboard_id, field_name, time bucket)
+    holding parallel arrays of sample timestamps (t) and values (v) plus count/min/max,
+    instead of one document per reading. Buckets are IST-aligned and span_seconds long.
+    Sample metadata is not kept in this layout.
+    """
+
+    def __init__(self, layout: str, span_seconds: int):
+        if layout not in STORAGE_LAYOUTS:
+            raise ValueError(f"Unknown storage layout {layout!r}, expected one of {STORAGE_LAYOUTS}")
+        self.enabled = layout == "buckets"
+        self.span_seconds = span_seconds
+        self.appended = 0
+        self.failed = 0
+        self.writes = 0
+        self.last_append_latency_ms = 0.0
+
+    @property
+    def span_ms(self) -> int:
+        return self.span_seconds * 1000
+
+    def bucket_start(self, ts: datetime) -> datetime:
+        return floor_to_bucket(ts, self.span_ms)
+
+    async def ensure_indexes(self):
+        # Appends and $merge rely on the unique (dashboard_id, field_name, start) index
+        await ensure_indexes([BUCKET_COLLECTION])
+
+    async def append(self, data_points: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Append data points to their buckets with one upsert per bucket. Returns the points that were stored.
+        Appends are not idempotent, so unlike document inserts a failed batch is not retried.
+        """
+        if not data_points:
+            return []
+        started = time.perf_counter()
+        groups: Dict[Tuple[str, str, datetime], List[Dict[str, Any]]] = {}
+        for data_point in data_points:
+            key = (data_point["dashboard_id"], data_point["field_name"], self.bucket_start(data_point["timestamp"]))
+            groups.setdefault(key, []).append(data_point)
+
+        operations = []
+        for (dashboard_id, field_name, start), points in groups.items():
+            values = [point["value"] for point in points]
+            operations.append(UpdateOne(
+                {"dashboard_id": dashboard_id, "field_name": field_name, "start": start},
+                {
+                    "$push": {
+                        "t": {"$each": [point["timestamp"] for point in points]},
+                        "v": {"$each": values},
+                    },
+                    "$inc": {"count": len(points)},
+                    "$min": {"min": min(values)},
+                    "$max": {"max": max(values)},
+                },
+                upsert=True,
+            ))
+
+        stored = data_points
+        try:
+            await mongodb.get_collection(BUCKET_COLLECTION).bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            # Unordered: every bucket except the reported ones was written
+            failed_indexes = {error["index"] for error in e.details.get("writeErrors", [])}
+            stored = [point for index, points in enumerate(groups.values()) if index not in failed_indexes for point in points]
+            logger.error(f"Bucket append had {len(failed_indexes)} write errors out of {len(operations)} buckets")
+        except Exception as e:
+            stored = []
+            logger.error(f"Bucket append dropped {len(data_points)} data points: {e}")
+
+        self.appended += len(stored)
+        self.failed += len(data_points) - len(stored)
+        self.writes += len(operations)
+        self.last_append_latency_ms = (time.perf_counter() - started) * 1000
+        return stored
+
+    def sample_stages(self, match: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """
+        Aggregation stages yielding the samples that match a data_points-style query on
+        dashboard_id, field_name and timestamp. Only buckets overlapping the range are unwound.
+        """
+        bucket_match = {key: match[key] for key in ("dashboard_id", "field_name") if key in match}
+        time_range = match.get("timestamp")
+        if time_range:
+            start_range = {}
+            lower = time_range.get("$gte", time_range.get("$gt"))
+            if lower is not None:
+                start_range["$gt"] = lower - timedelta(seconds=self.span_seconds)
+            if "$lte" in time_range:
+                start_range["$lte"] = time_range["$lte"]
+            if "$lt" in time_range:
+                start_range["$lt"] = time_range["$lt"]
+            bucket_match["start"] = start_range
+        stages = [{"$match": bucket_match}, *UNWIND_SAMPLE_STAGES]
+        if time_range:
+            stages.append({"$match": {"timestamp": time_range}})
+        return stages
+
+    async def iter_samples(self, dashboard_id: str, field_name: str, start_time: datetime, end_time: datetime, newest_first: bool = True, before: Optional[Tuple[datetime, str]] = None) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Samples of one field in [start_time, end_time] as {_id, timestamp, value} dicts, in time order.
+        With before=(timestamp, sample id), only samples that sort before it (newest first) are returned.
+        """
+        start_time, end_time = _naive_utc(start_time), _naive_utc(end_time)
+        before_bucket, before_index = None, None
+        if before is not None:
+            end_time = min(end_time, _naive_utc(before[0]))
+            before_bucket, before_index = parse_sample_id(before[1])
+        cursor = mongodb.get_collection(BUCKET_COLLECTION).find(
+            {
+                "dashboard_id": dashboard_id,
+                "field_name": field_name,
+                "start": {"$gt": start_time - timedelta(seconds=self.span_seconds), "$lte": end_time},
+            },
+            {"t": 1, "v": 1}
+        ).sort("start", -1 if newest_first else 1)
+        async for bucket in cursor:
+            bucket_id = str(bucket["_id"])
+            samples = [
+                (ts, index, value)
+                for index, (ts, value) in enumerate(zip(bucket["t"], bucket["v"]))
+                if start_time <= ts <= end_time
+            ]
+            if before is not None:
+                # Buckets never overlap, so only the cursor's own bucket can hold samples at its timestamp
+                if bucket_id == before_bucket:
+                    samples = [sample for sample in samples if (sample[0], sample[1]) < (end_time, before_index)]
+                else:
+                    samples = [sample for sample in samples if sample[0] < end_time]
+            samples.sort(reverse=newest_first)
+            for ts, index, value in samples:
+                yield {"_id": sample_id(bucket_id, index), "timestamp": ts, "value": value}
+
+    async def iter_dashboard_samples(self, dashboard_id: str, field_names: Optional[List[str]], start_time: Optional[datetime], end_time: Optional[datetime]) -> AsyncIterator[Dict[str, Any]]:
+        """Samples of a dashboard (optionally some fields) as {timestamp, field_name, value} dicts, oldest first"""
+        query: Dict[str, Any] = {"dashboard_id": dashboard_id}
+        if field_names:
+            query["field_name"] = {"$in": field_names}
+        start_range = {}
+        if start_time is not None:
+            start_time = _naive_utc(start_time)
+            start_range["$gt"] = start_time - timedelta(seconds=self.span_seconds)
+        if end_time is not None:
+            end_time = _naive_utc(end_time)
+            start_range["$lte"] = end_time
+        if start_range:
+            query["start"] = start_range
+
+        def in_range(ts: datetime) -> bool:
+            return (start_time is None or ts >= start_time) and (end_time is None or ts <= end_time)
+
+        # Buckets of different fields share start times; merge each time slot before emitting it
+        pending: List[Tuple[datetime, str, float]] = []
+        pending_start = None
+        cursor = mongodb.get_collection(BUCKET_COLLECTION).find(query, {"field_name": 1, "start": 1, "t": 1, "v": 1}).sort("start", 1)
+        async for bucket in cursor:
+            if bucket["start"] != pending_start:
+                pending.sort(key=lambda sample: sample[0])
+                for ts, field_name, value in pending:
+                    yield {"timestamp": ts, "field_name": field_name, "value": value}
+                pending, pending_start = [], bucket["start"]
+            pending.extend((ts, bucket["field_name"], value) for ts, value in zip(bucket["t"], bucket["v"]) if in_range(ts))
+        pending.sort(key=lambda sample: sample[0])
+        for ts, field_name, value in pending:
+            yield {"timestamp": ts, "field_name": field_name, "value": value}
+
+    async def migrate(self, dashboard_id: Optional[str] = None) -> int:
+        """
+        Rebuild the buckets of one dashboard (or all of them) from data_points, replacing existing buckets.
+        Run it with ingest stopped, before switching STORAGE_LAYOUT to buckets.
+        """
+        await self.ensure_indexes()
+        scope = {"dashboard_id": dashboard_id} if dashboard_id else {}
+        await mongodb.get_collection(BUCKET_COLLECTION).delete_many(scope)
+        pipeline = [
+            {"$match": scope},
+            {"$sort": {"timestamp": 1}},
+            {"$group": {
+                "_id": {
+                    "dashboard_id": "$dashboard_id",
+                    "field_name": "$field_name",
+                    "start": bucket_start_expression(self.span_ms),
+                },
+                "t": {"$push": "$timestamp"},
+                "v": {"$push": "$value"},
+                "count": {"$sum": 1},
+                "min": {"$min": "$value"},
+                "max": {"$max": "$value"},
+            }},
+            {"$project": {
+                "_id": 0,
+                "dashboard_id": "$_id.dashboard_id",
+                "field_name": "$_id.field_name",
+                "start": {"$toDate": "$_id.start"},
+                "t": 1, "v": 1, "count": 1, "min": 1, "max": 1,
+            }},
+            {"$merge": {
+                "into": BUCKET_COLLECTION,
+                "on": ["dashboard_id", "field_name", "start"],
+                "whenMatched": "replace",
+                "whenNotMatched": "insert",
+            }},
+        ]
+        async for _ in mongodb.get_collection("data_points").aggregate(pipeline, allowDiskUse=True):
+            pass
+        buckets = await mongodb.get_collection(BUCKET_COLLECTION).count_documents(scope)
+        logger.info(f"Migrated data points into {buckets} buckets")
+        return buckets
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "span_seconds": self.span_seconds,
+            "appended": self.appended,
+            "failed": self.failed,
+            "bucket_writes": self.writes,
+            "last_append_latency_ms": round(self.last_append_latency_ms, 2),
+        }
+
+# Global bucket storage instance
+bucket_storage = BucketStorage(
+    layout=settings.STORAGE_LAYOUT,
+    span_seconds=settings.BUCKET_SPAN_SECONDS,
+)
+
+async def store_data_points(data_points: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Write data points straight to storage in the configured layout (bypassing the ingest buffer)
+    and fold them into the rollups. Returns the stored points, which all have an _id.
+    """
+    for data_point in data_points:
+        data_point.setdefault("_id", ObjectId())
+    if bucket_storage.enabled:
+        stored = await bucket_storage.append(data_points)
+    else:
+        await mongodb.get_collection("data_points").insert_many(data_points)
+        stored = data_points
+    await rollup_service.apply(stored)
+    return stored
@@ -0,0 +1,249 @@
+import asyncio
+import logging
+import os
+import socket
+from datetime import datetime, timedelta, timezone
+from typing import Any, AsyncIterator, Dict, List, Optional
+from bson import ObjectId
+from pymongo import ReturnDocument
+from app.core.config import settings
+from app.db.mongodb import mongodb
+from app.services.bucket_storage import BUCKET_COLLECTION
+from app.services.rollups import ROLLUP_RESOLUTIONS, rollup_collection_name
+
+logger = logging.getLogger(__name__)
+
+PURGE_JOBS_COLLECTION = "purge_jobs"
+
+# Collections holding per-dashboard data, purged in this order. Both storage layouts are
+# purged whichever is configured, since a dashboard may have data in either after a migration.
+PURGE_COLLECTIONS = ["data_points", BUCKET_COLLECTION, *(rollup_collection_name(resolution) for resolution in ROLLUP_RESOLUTIONS)]
+
+# A running job whose worker has not reported progress for this long is taken over by another worker
+PURGE_LEASE_SECONDS = 300
+
+# Extra wait on top of the dashboard registry TTL before a purge's final pass, covering readings
+# still in an ingest buffer when the last process's registry entry expired
+PURGE_SETTLE_SECONDS = 30
+
+async def delete_in_chunks(collection_name: str, query: Dict[str, Any], chunk_size: int, chunk_delay_ms: int) -> AsyncIterator[int]:
+    """
+    Delete the documents matching query at most chunk_size at a time, pausing chunk_delay_ms
+    between chunks. Yields the number deleted by each chunk; the caller may stop at any point.
+    """
+    collection = mongodb.get_collection(collection_name)
+    while True:
+        chunk = await collection.find(query, {"_id": 1}).limit(chunk_size).to_list(length=chunk_size)
+        if not chunk:
+            return
+        result = await collection.delete_many({"_id": {"$in": [doc["_id"] for doc in chunk]}})
+        yield result.deleted_count
+        if len(chunk) < chunk_size:
+            return
+        await asyncio.sleep(chunk_delay_ms / 1000)
+
+class DashboardPurger:
+    """
+    Deletes the stored data of deleted dashboards in the background.
+    Jobs are kept in purge_jobs, so any API or ingest process can pick them up and a job
+    interrupted by a restart resumes where it stopped. Each job deletes at most chunk_size
+    documents per round trip and pauses chunk_delay_ms between chunks, so a large purge
+    never competes with live ingest for more than one small delete at a time.
+    Other processes (API workers, the ingest service) may keep accepting readings for the
+    dashboard until their registry entry expires, so a job is only completed by a pass that
+    starts after the registry TTL has run out; an earlier pass puts it back to wait until then.
+    """
+
+    def __init__(self, chunk_size: int, chunk_delay_ms: int, poll_interval_seconds: float):
+        self.chunk_size = chunk_size
+        self.chunk_delay_ms = chunk_delay_ms
+        self.poll_interval_seconds = poll_interval_seconds
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._task: Optional[asyncio.Task] = None
+        self._stopping: Optional[asyncio.Event] = None
+        self._wake: Optional[asyncio.Event] = None
+        self.jobs_completed = 0
+        self.jobs_failed = 0
+        self.deleted = 0
+        self.chunks = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def schedule(self, dashboard_id: str, dashboard_name: Optional[str] = None, requested_by: Optional[str] = None) -> str:
+        """Record a purge job for a deleted dashboard and wake the worker; returns the job id"""
+        now = datetime.now(timezone.utc)
+        job = {
+            "dashboard_id": str(dashboard_id),
+            "dashboard_name": dashboard_name,
+            "requested_by": requested_by,
+            "status": "pending",
+            "created_at": now,
+            "updated_at": now,
+            "finished_at": None,
+            "deleted": {collection_name: 0 for collection_name in PURGE_COLLECTIONS},
+            "error": None,
+        }
+        result = await mongodb.get_collection(PURGE_JOBS_COLLECTION).insert_one(job)
+        if self._wake is not None:
+            self._wake.set()
+        return str(result.inserted_id)
+
+    async def schedule_orphans(self) -> List[str]:
+        """Schedule purges for dashboard ids that still have data points but no dashboard (deleted before purging existed)"""
+        existing = {str(doc["_id"]) for doc in await mongodb.get_collection("dashboards").find({}, {"_id": 1}).to_list(length=None)}
+        queued = set(await mongodb.get_collection(PURGE_JOBS_COLLECTION).distinct("dashboard_id", {"status": {"$in": ["pending", "running"]}}))
+        orphans = set()
+        for collection_name in ("data_points", BUCKET_COLLECTION):
+            orphans.update(await mongodb.get_collection(collection_name).distinct("dashboard_id"))
+        job_ids = []
+        for dashboard_id in sorted(orphans - existing - queued):
+            job_ids.append(await self.schedule(dashboard_id, requested_by="purge-orphans"))
+        return job_ids
+
+    async def start(self):
+        if self.running:
+            return
+        self._stopping = asyncio.Event()
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Dashboard purger started (chunk_size={self.chunk_size}, chunk_delay={self.chunk_delay_ms}ms)")
+
+    async def stop(self):
+        """Stop after the current chunk; an unfinished job goes back to pending for the next worker"""
+        if self.running:
+            self._stopping.set()
+            self._wake.set()
+            await self._task
+            self._task = None
+
+    async def _run(self):
+        while not self._stopping.is_set():
+            try:
+                while not self._stopping.is_set() and await self.run_next():
+                    pass
+            except Exception as e:
+                logger.error(f"Error running dashboard purge: {e}")
+            # Jobs scheduled by other processes are picked up on the next poll
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.poll_interval_seconds)
+            except asyncio.TimeoutError:
+                pass
+
+    def settled_at(self, job: Dict[str, Any]) -> datetime:
+        """When no process can still accept readings for the job's dashboard"""
+        created_at = job["created_at"]
+        if created_at.tzinfo is None:
+            created_at = created_at.replace(tzinfo=timezone.utc)
+        return created_at + timedelta(seconds=settings.DASHBOARD_REGISTRY_TTL_SECONDS + PURGE_SETTLE_SECONDS)
+
+    async def _claim(self) -> Optional[Dict[str, Any]]:
+        now = datetime.now(timezone.utc)
+        return await mongodb.get_collection(PURGE_JOBS_COLLECTION).find_one_and_update(
+            {"$or": [
+                {"status": "pending", "not_before": {"$not": {"$gt": now}}},
+                {"status": "running", "lease_until": {"$lt": now}},
+            ]},
+            {
+                "$set": {
+                    "status": "running",
+                    "worker": self.worker_id,
+                    "lease_until": now + timedelta(seconds=PURGE_LEASE_SECONDS),
+                    "updated_at": now,
+                },
+                # Set on first claim only; a resumed job keeps its original start
+                "$min": {"started_at": now},
+            },
+            sort=[("created_at", 1)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    async def run_next(self) -> bool:
+        """Claim and run one purge job; returns False when none is waiting"""
+        job = await self._claim()
+        if job is None:
+            return False
+        jobs = mongodb.get_collection(PURGE_JOBS_COLLECTION)
+        dashboard_id = job["dashboard_id"]
+        settled_at = self.settled_at(job)
+        final_pass = datetime.now(timezone.utc) >= settled_at
+        logger.info(f"Purging data of deleted dashboard {dashboard_id} (job {job['_id']})")
+        try:
+            for collection_name in PURGE_COLLECTIONS:
+                if not await self._purge_collection(job["_id"], collection_name, dashboard_id):
+                    # Stopping: hand the job back so the next worker resumes it right away
+                    await jobs.update_one(
+                        {"_id": job["_id"]},
+                        {"$set": {"status": "pending", "updated_at": datetime.now(timezone.utc)}, "$unset": {"lease_until": "", "worker": ""}},
+                    )
+                    return False
+        except Exception as e:
+            self.jobs_failed += 1
+            await jobs.update_one(
+                {"_id": job["_id"]},
+                {"$set": {"status": "failed", "error": str(e), "updated_at": datetime.now(timezone.utc)}},
+            )
+            logger.error(f"Purge of dashboard {dashboard_id} failed: {e}")
+            return True
+
+        now = datetime.now(timezone.utc)
+        if not final_pass:
+            # Readings accepted by stale registries may still arrive; purge again once they cannot
+            await jobs.update_one(
+                {"_id": job["_id"]},
+                {"$set": {"status": "pending", "not_before": settled_at, "updated_at": now}, "$unset": {"lease_until": "", "worker": ""}},
+            )
+            logger.info(f"Purged data of deleted dashboard {dashboard_id}; final pass after {settled_at.isoformat()}")
+            return True
+        await jobs.update_one(
+            {"_id": job["_id"]},
+            {"$set": {"status": "completed", "finished_at": now, "updated_at": now}, "$unset": {"lease_until": ""}},
+        )
+        self.jobs_completed += 1
+        logger.info(f"Purged data of deleted dashboard {dashboard_id}")
+        return True
+
+    async def _purge_collection(self, job_id: ObjectId, collection_name: str, dashboard_id: str) -> bool:
+        """Delete one collection's documents of the dashboard chunk by chunk; returns False if stopped midway"""
+        async for deleted in delete_in_chunks(collection_name, {"dashboard_id": dashboard_id}, self.chunk_size, self.chunk_delay_ms):
+            now = datetime.now(timezone.utc)
+            await mongodb.get_collection(PURGE_JOBS_COLLECTION).update_one(
+                {"_id": job_id},
+                {
+                    "$inc": {f"deleted.{collection_name}": deleted},
+                    "$set": {"lease_until": now + timedelta(seconds=PURGE_LEASE_SECONDS), "updated_at": now},
+                },
+            )
+            self.deleted += deleted
+            self.chunks += 1
+            if self._stopping is not None and self._stopping.is_set():
+                return False
+        return True
+
+    async def list_jobs(self, status: Optional[str] = None, limit: int = 50) -> List[Dict[str, Any]]:
+        query = {"status": status} if status else {}
+        return await mongodb.get_collection(PURGE_JOBS_COLLECTION).find(query).sort("created_at", -1).limit(limit).to_list(length=limit)
+
+    async def get_job(self, job_id: str) -> Optional[Dict[str, Any]]:
+        return await mongodb.get_collection(PURGE_JOBS_COLLECTION).find_one({"_id": ObjectId(job_id)})
+
+    def stats(self) -> dict:
+        return {
+            "running": self.running,
+            "worker": self.worker_id,
+            "chunk_size": self.chunk_size,
+            "chunk_delay_ms": self.chunk_delay_ms,
+            "jobs_completed": self.jobs_completed,
+            "jobs_failed": self.jobs_failed,
+            "deleted": self.deleted,
+            "chunks": self.chunks,
+        }
+
+# Global dashboard purger instance
+dashboard_purger = DashboardPurger(
+    chunk_size=settings.PURGE_CHUNK_SIZE,
+    chunk_delay_ms=settings.PURGE_CHUNK_DELAY_MS,
+    poll_interval_seconds=settings.PURGE_POLL_INTERVAL_SECONDS,
+)
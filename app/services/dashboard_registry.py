@@ -0,0 +1,151 @@
+import logging
+import threading
+import time
+from typing import Dict, FrozenSet, Optional
+from bson import ObjectId
+from app.core.config import settings
+from app.db.mongodb import mongodb
+
+logger = logging.getLogger(__name__)
+
+# Only the parts of a dashboard document that ingest needs
+REGISTRY_PROJECTION = {"api_key": 1, "fields.name": 1, "is_admin": 1}
+
+# Minimum age of an entry before an unknown field triggers a reload
+MISSING_FIELD_REFRESH_SECONDS = 5
+
+class DashboardEntry:
+    """Ingest view of a dashboard: id, api key, field names and flags"""
+    __slots__ = ("dashboard_id", "api_key", "field_names", "is_admin", "loaded_at")
+
+    def __init__(self, dashboard_id: str, api_key: Optional[str], field_names: FrozenSet[str], is_admin: bool):
+        self.dashboard_id = dashboard_id
+        self.api_key = api_key
+        self.field_names = field_names
+        self.is_admin = is_admin
+        self.loaded_at = time.monotonic()
+
+    @classmethod
+    def from_document(cls, dashboard: dict) -> "DashboardEntry":
+        return cls(
+            dashboard_id=str(dashboard["_id"]),
+            api_key=dashboard.get("api_key"),
+            field_names=frozenset(field["name"] for field in dashboard.get("fields", []) if "name" in field),
+            is_admin=dashboard.get("is_admin", False),
+        )
+
+    def has_field(self, field_name: str) -> bool:
+        return field_name in self.field_names
+
+class DashboardRegistry:
+    """
+    Process-local cache of dashboards keyed by api_key and by dashboard id.
+    Entries are invalidated explicitly when a dashboard changes and expire after a TTL as a backstop.
+    Invalidation only reaches this process, so the TTL also bounds how long another process keeps
+    accepting readings for a deleted dashboard; dashboard purges wait it out before their final pass.
+    """
+
+    def __init__(self, ttl_seconds: int):
+        self.ttl_seconds = ttl_seconds
+        self._by_api_key: Dict[str, DashboardEntry] = {}
+        self._by_id: Dict[str, DashboardEntry] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _is_fresh(self, entry: DashboardEntry) -> bool:
+        return time.monotonic() - entry.loaded_at < self.ttl_seconds
+
+    def _lookup(self, index: Dict[str, DashboardEntry], key: str) -> Optional[DashboardEntry]:
+        with self._lock:
+            entry = index.get(key)
+            if entry is not None and self._is_fresh(entry):
+                self.hits += 1
+                return entry
+            self.misses += 1
+            return None
+
+    def _store(self, entry: DashboardEntry) -> DashboardEntry:
+        with self._lock:
+            # Drop any stale entry still reachable through the old api key
+            previous = self._by_id.get(entry.dashboard_id)
+            if previous is not None and previous.api_key and previous.api_key != entry.api_key:
+                self._by_api_key.pop(previous.api_key, None)
+            self._by_id[entry.dashboard_id] = entry
+            if entry.api_key:
+                self._by_api_key[entry.api_key] = entry
+        return entry
+
+    async def warm(self) -> int:
+        """Load every dashboard into the registry"""
+        count = 0
+        async for dashboard in mongodb.get_collection("dashboards").find({}, REGISTRY_PROJECTION):
+            self._store(DashboardEntry.from_document(dashboard))
+            count += 1
+        logger.info(f"Dashboard registry warmed with {count} dashboards")
+        return count
+
+    async def get_by_api_key(self, api_key: str) -> Optional[DashboardEntry]:
+        entry = self._lookup(self._by_api_key, api_key)
+        if entry is not None:
+            return entry
+        dashboard = await mongodb.get_collection("dashboards").find_one({"api_key": api_key}, REGISTRY_PROJECTION)
+        if not dashboard:
+            return None
+        return self._store(DashboardEntry.from_document(dashboard))
+
+    async def get_by_id(self, dashboard_id: str) -> Optional[DashboardEntry]:
+        entry = self._lookup(self._by_id, dashboard_id)
+        if entry is not None:
+            return entry
+        if not ObjectId.is_valid(dashboard_id):
+            return None
+        dashboard = await mongodb.get_collection("dashboards").find_one({"_id": ObjectId(dashboard_id)}, REGISTRY_PROJECTION)
+        if not dashboard:
+            return None
+        return self._store(DashboardEntry.from_document(dashboard))
+
+    async def ensure_fields(self, entry: DashboardEntry, field_names) -> DashboardEntry:
+        """
+        Reload an entry that lacks one of the given fields, in case the field was added by
+        another process (whose invalidation this registry never sees). Reloads at most once
+        every MISSING_FIELD_REFRESH_SECONDS per dashboard.
+        """
+        if all(entry.has_field(field_name) for field_name in field_names):
+            return entry
+        if time.monotonic() - entry.loaded_at < MISSING_FIELD_REFRESH_SECONDS:
+            return entry
+        dashboard = await mongodb.get_collection("dashboards").find_one({"_id": ObjectId(entry.dashboard_id)}, REGISTRY_PROJECTION)
+        if not dashboard:
+            self.invalidate(dashboard_id=entry.dashboard_id)
+            return entry
+        return self._store(DashboardEntry.from_document(dashboard))
+
+    def invalidate(self, dashboard_id: Optional[str] = None, api_key: Optional[str] = None):
+        """Forget a dashboard so the next lookup reloads it from MongoDB"""
+        with self._lock:
+            if dashboard_id is not None:
+                entry = self._by_id.pop(str(dashboard_id), None)
+                if entry is not None and entry.api_key:
+                    self._by_api_key.pop(entry.api_key, None)
+            if api_key is not None:
+                entry = self._by_api_key.pop(api_key, None)
+                if entry is not None:
+                    self._by_id.pop(entry.dashboard_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._by_api_key.clear()
+            self._by_id.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "dashboards": len(self._by_id),
+                "hits": self.hits,
+                "misses": self.misses,
+                "ttl_seconds": self.ttl_seconds,
+            }
+
+# Global dashboard registry instance
+dashboard_registry = DashboardRegistry(ttl_seconds=settings.DASHBOARD_REGISTRY_TTL_SECONDS)
@@ -0,0 +1,92 @@
+from datetime import datetime, timezone
+from typing import Any, Dict, List
+import numpy as np
+
+DOWNSAMPLE_METHODS = ("lttb", "minmax")
+
+def lttb_indices(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    """
+    Largest-Triangle-Three-Buckets: pick n_out indices of (x, y) that preserve the visual shape.
+    x must be sorted ascending. The first and last points are always kept.
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    x = x.astype(np.float64)
+    y = y.astype(np.float64)
+
+    # Bucket boundaries for the n - 2 interior points split into n_out - 2 buckets
+    edges = np.floor(np.linspace(1, n - 1, n_out - 1)).astype(np.int64)
+    starts = edges[:-1]
+    ends = edges[1:]
+
+    # Average point of every bucket (the "next bucket" term), computed for all buckets at once;
+    # the point after the last bucket is the final point itself
+    counts = np.diff(np.append(starts, n - 1))
+    avg_x = np.append(np.add.reduceat(x[:-1], starts) / counts, x[-1])
+    avg_y = np.append(np.add.reduceat(y[:-1], starts) / counts, y[-1])
+
+    selected = np.empty(n_out, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+    a = 0
+    for i in range(len(starts)):
+        start, end = starts[i], ends[i]
+        next_x = avg_x[i + 1]
+        next_y = avg_y[i + 1]
+        bx = x[start:end]
+        by = y[start:end]
+        # Twice the triangle area between the previous pick, each candidate and the next bucket's average
+        areas = np.abs((x[a] - next_x) * (by - y[a]) - (x[a] - bx) * (next_y - y[a]))
+        a = start + int(np.argmax(areas))
+        selected[i + 1] = a
+    return selected
+
+def minmax_indices(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    """
+    Min/max per pixel: keep the first and last points and split the series into (n_out - 2) // 2
+    equal buckets, keeping each bucket's minimum and maximum, so every spike survives.
+    Returns at most n_out sorted, de-duplicated indices.
+    """
+    n = len(x)
+    if n_out >= n:
+        return np.arange(n)
+    buckets = (n_out - 2) // 2
+    if buckets < 1:
+        return np.array([0, n - 1])
+
+    size = int(np.ceil(n / buckets))
+    padded = np.full(buckets * size, np.nan)
+    padded[:n] = y.astype(np.float64)
+    grid = padded.reshape(buckets, size)
+    # Buckets past the end of the series are all-NaN; drop them before taking argmin/argmax
+    valid = ~np.all(np.isnan(grid), axis=1)
+    offsets = np.arange(buckets)[valid] * size
+    grid = grid[valid]
+    mins = offsets + np.nanargmin(grid, axis=1)
+    maxs = offsets + np.nanargmax(grid, axis=1)
+    return np.unique(np.concatenate([mins, maxs, [0, n - 1]]))
+
+def downsample_indices(x: np.ndarray, y: np.ndarray, n_out: int, method: str = "lttb") -> np.ndarray:
+    if method == "minmax":
+        indices = minmax_indices(x, y, n_out)
+    else:
+        indices = lttb_indices(x, y, n_out)
+    # Below 3 points LTTB returns the series unchanged; the API requires max_points >= 3
+    if n_out >= 3 and len(indices) > n_out:
+        raise ValueError(f"{method} downsampling returned {len(indices)} points for at most {n_out}")
+    return indices
+
+def _epoch_ms(ts: datetime) -> float:
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    return ts.timestamp() * 1000
+
+def downsample_points(points: List[Dict[str, Any]], max_points: int, method: str = "lttb") -> List[Dict[str, Any]]:
+    """Reduce chronologically ordered data point documents to at most max_points"""
+    if len(points) <= max_points:
+        return points
+    x = np.fromiter((_epoch_ms(point["timestamp"]) for point in points), dtype=np.float64, count=len(points))
+    y = np.fromiter((point["value"] for point in points), dtype=np.float64, count=len(points))
+    return [points[i] for i in downsample_indices(x, y, max_points, method)]
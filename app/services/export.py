@@ -0,0 +1,88 @@
+import csv
+import io
+import json
+import zlib
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, List, Optional
+from app.db.mongodb import mongodb
+from app.services.bucket_storage import bucket_storage
+from app.services.timeseries import IST_TIMEZONE, to_ist
+
+EXPORT_FORMATS = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+}
+
+CSV_COLUMNS = ("timestamp", "field_name", "value")
+
+# Rows are encoded in chunks of roughly this many bytes before being handed to the response
+EXPORT_CHUNK_BYTES = 64 * 1024
+
+# Documents fetched from MongoDB per cursor round trip
+EXPORT_CURSOR_BATCH_SIZE = 5000
+
+def _as_ist(ts: Optional[datetime]) -> Optional[datetime]:
+    """Read a naive user-given bound as IST, like every other data endpoint"""
+    if ts is not None and ts.tzinfo is None:
+        return ts.replace(tzinfo=IST_TIMEZONE)
+    return ts
+
+def _export_query(dashboard_id: str, field_names: Optional[List[str]], start_time: Optional[datetime], end_time: Optional[datetime]) -> Dict[str, Any]:
+    query: Dict[str, Any] = {"dashboard_id": dashboard_id}
+    if field_names:
+        query["field_name"] = field_names[0] if len(field_names) == 1 else {"$in": field_names}
+    time_range = {}
+    if start_time is not None:
+        time_range["$gte"] = start_time
+    if end_time is not None:
+        time_range["$lte"] = end_time
+    if time_range:
+        query["timestamp"] = time_range
+    return query
+
+def _export_samples(dashboard_id: str, field_names: Optional[List[str]], start_time: Optional[datetime], end_time: Optional[datetime]) -> AsyncIterator[Dict[str, Any]]:
+    """{timestamp, field_name, value} documents of the export, oldest first, from the configured storage layout"""
+    if bucket_storage.enabled:
+        return bucket_storage.iter_dashboard_samples(dashboard_id, field_names, start_time, end_time)
+    return mongodb.get_collection("data_points").find(
+        _export_query(dashboard_id, field_names, start_time, end_time),
+        {"_id": 0, "timestamp": 1, "field_name": 1, "value": 1}
+    ).sort("timestamp", 1).batch_size(EXPORT_CURSOR_BATCH_SIZE)
+
+async def _export_rows(samples: AsyncIterator[Dict[str, Any]], fmt: str) -> AsyncIterator[str]:
+    if fmt == "csv":
+        yield ",".join(CSV_COLUMNS) + "\r\n"
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    async for doc in samples:
+        timestamp = to_ist(doc["timestamp"]).isoformat()
+        if fmt == "csv":
+            writer.writerow((timestamp, doc["field_name"], doc["value"]))
+        else:
+            buffer.write(json.dumps({"timestamp": timestamp, "field_name": doc["field_name"], "value": doc["value"]}))
+            buffer.write("\n")
+        if buffer.tell() >= EXPORT_CHUNK_BYTES:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+async def stream_export(dashboard_id: str, fmt: str, field_names: Optional[List[str]] = None, start_time: Optional[datetime] = None, end_time: Optional[datetime] = None, compress: bool = False) -> AsyncIterator[bytes]:
+    """
+    Stream a dashboard's data points, oldest first, as CSV or NDJSON (optionally gzipped).
+    Memory use is bounded by one cursor batch (one time bucket in the bucketed layout) and one
+    output chunk, whatever the export size. Naive start and end times are taken as IST.
+    """
+    start_time, end_time = _as_ist(start_time), _as_ist(end_time)
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    async for chunk in _export_rows(_export_samples(dashboard_id, field_names, start_time, end_time), fmt):
+        data = chunk.encode("utf-8")
+        if compressor is None:
+            yield data
+            continue
+        data = compressor.compress(data)
+        if data:
+            yield data
+    if compressor is not None:
+        yield compressor.flush()
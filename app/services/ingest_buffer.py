@@ -0,0 +1,206 @@
+import asyncio
+import logging
+import time
+from typing import Any, Dict, List, Optional
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
+from app.core.config import settings
+from app.db.mongodb import mongodb
+from app.services.bucket_storage import bucket_storage, store_data_points
+from app.services.last_value_coalescer import last_value_coalescer
+from app.services.response_cache import response_cache
+from app.services.rollups import rollup_service
+
+logger = logging.getLogger(__name__)
+
+# Marker put on the queue to ask the flush loop to drain and exit
+_STOP = object()
+
+FLUSH_ATTEMPTS = 3
+
+DUPLICATE_KEY_ERROR = 11000
+
+class IngestBuffer:
+    """
+    Write-behind buffer for data points.
+    Readings are queued in memory and written to MongoDB with insert_many(ordered=False)
+    (or appended to their buckets in the bucketed layout) once flush_batch_size readings
+    have accumulated or flush_interval_ms has passed.
+    Written readings are then offered to the last value coalescer, so a field's
+    last_update never points at a reading that is not yet stored, and folded into the rollups.
+    """
+
+    def __init__(self, max_queue_size: int, flush_batch_size: int, flush_interval_ms: int, collection_name: str = "data_points"):
+        self.max_queue_size = max_queue_size
+        self.flush_batch_size = flush_batch_size
+        self.flush_interval_ms = flush_interval_ms
+        self.collection_name = collection_name
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self.enqueued = 0
+        self.written = 0
+        self.failed = 0
+        self.flushes = 0
+        self.last_flush_size = 0
+        self.last_flush_latency_ms = 0.0
+        self.max_flush_latency_ms = 0.0
+        self._total_flush_latency_ms = 0.0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self):
+        """Start the background flush loop on the running event loop"""
+        if self.running:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self._task = asyncio.create_task(self._run())
+        logger.info(
+            f"Ingest buffer started (queue={self.max_queue_size}, batch={self.flush_batch_size}, interval={self.flush_interval_ms}ms)"
+        )
+
+    async def stop(self):
+        """Flush everything still queued and stop the flush loop"""
+        if not self.running:
+            return
+        await self._queue.put(_STOP)
+        await self._task
+        self._task = None
+        logger.info("Ingest buffer drained and stopped")
+
+    async def put(self, data_point: Dict[str, Any]) -> ObjectId:
+        """Queue a data point, waiting for room if the buffer is full. Returns the point's id."""
+        data_point.setdefault("_id", ObjectId())
+        if not self.running:
+            # Buffer not started (e.g. scripts), fall back to a direct write
+            await store_data_points([data_point])
+            last_value_coalescer.offer(data_point["dashboard_id"], data_point["field_name"], data_point["value"], data_point["timestamp"])
+            response_cache.invalidate(data_point["dashboard_id"])
+            return data_point["_id"]
+        await self._queue.put(data_point)
+        self.enqueued += 1
+        return data_point["_id"]
+
+    async def put_many(self, data_points: List[Dict[str, Any]]) -> List[ObjectId]:
+        return [await self.put(data_point) for data_point in data_points]
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        interval = self.flush_interval_ms / 1000
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = loop.time() + interval
+            while len(batch) < self.flush_batch_size:
+                try:
+                    item = self._queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self._queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._flush_safely(batch)
+
+        # Drain anything queued behind the stop marker
+        remaining = []
+        while not self._queue.empty():
+            item = self._queue.get_nowait()
+            if item is not _STOP:
+                remaining.append(item)
+        for start in range(0, len(remaining), self.flush_batch_size):
+            await self._flush_safely(remaining[start:start + self.flush_batch_size])
+
+    async def _flush_safely(self, batch: List[Dict[str, Any]]):
+        """Flush a batch, logging any error instead of letting it end the flush loop"""
+        try:
+            await self._flush(batch)
+        except Exception as e:
+            self.failed += len(batch)
+            logger.error(f"Ingest buffer failed to flush {len(batch)} data points: {e}")
+
+    async def _flush(self, batch: List[Dict[str, Any]]):
+        started = time.perf_counter()
+        collection = mongodb.get_collection(self.collection_name)
+        stored = []
+        if bucket_storage.enabled:
+            # Bucket appends are not idempotent, so they are never retried
+            stored = await bucket_storage.append(batch)
+            self.failed += len(batch) - len(stored)
+        else:
+            for attempt in range(1, FLUSH_ATTEMPTS + 1):
+                try:
+                    await collection.insert_many(batch, ordered=False)
+                    stored = batch
+                    break
+                except BulkWriteError as e:
+                    # Unordered insert: everything except the reported errors was written. On a retry,
+                    # duplicate keys are points the failed attempt already wrote, so they count as stored.
+                    failed_indexes = {
+                        error["index"] for error in e.details.get("writeErrors", [])
+                        if attempt == 1 or error.get("code") != DUPLICATE_KEY_ERROR
+                    }
+                    stored = [data_point for index, data_point in enumerate(batch) if index not in failed_indexes]
+                    self.failed += len(failed_indexes)
+                    if failed_indexes:
+                        logger.error(f"Ingest buffer flush had {len(failed_indexes)} write errors out of {len(batch)} data points")
+                    break
+                except Exception as e:
+                    if attempt == FLUSH_ATTEMPTS:
+                        self.failed += len(batch)
+                        logger.error(f"Ingest buffer dropped {len(batch)} data points after {attempt} attempts: {e}")
+                        break
+                    logger.warning(f"Ingest buffer flush attempt {attempt} failed, retrying: {e}")
+                    await asyncio.sleep(0.5 * attempt)
+
+        self.written += len(stored)
+        for data_point in stored:
+            last_value_coalescer.offer(data_point["dashboard_id"], data_point["field_name"], data_point["value"], data_point["timestamp"])
+        await rollup_service.apply(stored)
+        # Cached responses of these dashboards no longer include their newest readings
+        for dashboard_id in {data_point["dashboard_id"] for data_point in stored}:
+            response_cache.invalidate(dashboard_id)
+
+        latency_ms = (time.perf_counter() - started) * 1000
+        self.flushes += 1
+        self.last_flush_size = len(batch)
+        self.last_flush_latency_ms = latency_ms
+        self.max_flush_latency_ms = max(self.max_flush_latency_ms, latency_ms)
+        self._total_flush_latency_ms += latency_ms
+
+    def stats(self) -> dict:
+        return {
+            "running": self.running,
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "max_queue_size": self.max_queue_size,
+            "flush_batch_size": self.flush_batch_size,
+            "flush_interval_ms": self.flush_interval_ms,
+            "enqueued": self.enqueued,
+            "written": self.written,
+            "failed": self.failed,
+            "flushes": self.flushes,
+            "last_flush_size": self.last_flush_size,
+            "avg_flush_size": round(self.written / self.flushes, 2) if self.flushes else 0,
+            "last_flush_latency_ms": round(self.last_flush_latency_ms, 2),
+            "avg_flush_latency_ms": round(self._total_flush_latency_ms / self.flushes, 2) if self.flushes else 0,
+            "max_flush_latency_ms": round(self.max_flush_latency_ms, 2),
+        }
+
+# Global ingest buffer instance
+ingest_buffer = IngestBuffer(
+    max_queue_size=settings.INGEST_BUFFER_MAX_SIZE,
+    flush_batch_size=settings.INGEST_FLUSH_BATCH_SIZE,
+    flush_interval_ms=settings.INGEST_FLUSH_INTERVAL_MS,
+)
@@ -0,0 +1,153 @@
+import asyncio
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+from bson import ObjectId
+from pymongo import UpdateOne
+from app.core.config import settings
+from app.db.mongodb import mongodb
+
+logger = logging.getLogger(__name__)
+
+def _as_aware(ts: datetime) -> datetime:
+    """Treat naive datetimes as UTC so readings can be compared"""
+    if ts.tzinfo is None:
+        return ts.replace(tzinfo=timezone.utc)
+    return ts
+
+class LastValueCoalescer:
+    """
+    Coalesces dashboard field last_value/last_update writes.
+    Only the newest reading per (dashboard_id, field_name) is kept during a flush window,
+    then every pending field is written with one bulk_write of positional updates.
+    The update filter never lets last_update (or the dashboard's updated_at) move backwards,
+    so late or backfilled readings cannot overwrite a newer value. Every dashboard that received
+    readings also gets its data_modified_at bumped, which conditional GETs use as a change marker.
+    """
+
+    def __init__(self, flush_interval_ms: int):
+        self.flush_interval_ms = flush_interval_ms
+        self._pending: Dict[Tuple[str, str], Tuple[float, datetime]] = {}
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._stopping: Optional[asyncio.Event] = None
+        self.offered = 0
+        self.written = 0
+        self.flushes = 0
+        self.last_flush_size = 0
+        self.last_flush_latency_ms = 0.0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def offer(self, dashboard_id: str, field_name: str, value: float, timestamp: datetime):
+        """Record a reading; it replaces the pending one for the field only if it is newer"""
+        key = (dashboard_id, field_name)
+        with self._lock:
+            self.offered += 1
+            pending = self._pending.get(key)
+            if pending is None or _as_aware(timestamp) >= _as_aware(pending[1]):
+                self._pending[key] = (float(value), timestamp)
+
+    async def start(self):
+        if self.running:
+            return
+        self._stopping = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Last value coalescer started (interval={self.flush_interval_ms}ms)")
+
+    async def stop(self):
+        """Stop the flush loop, writing whatever is still pending"""
+        if self.running:
+            self._stopping.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        interval = self.flush_interval_ms / 1000
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing last values: {e}")
+
+    async def flush(self) -> int:
+        """Write all pending last values in a single bulk_write"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+
+        operations: List[UpdateOne] = []
+        flushed_at = datetime.now(timezone.utc)
+        for dashboard_id in {dashboard_id for dashboard_id, _ in pending}:
+            if ObjectId.is_valid(dashboard_id):
+                operations.append(UpdateOne({"_id": ObjectId(dashboard_id)}, {"$max": {"data_modified_at": flushed_at}}))
+        for (dashboard_id, field_name), (value, timestamp) in pending.items():
+            if not ObjectId.is_valid(dashboard_id):
+                continue
+            operations.append(UpdateOne(
+                {
+                    "_id": ObjectId(dashboard_id),
+                    "fields": {
+                        "$elemMatch": {
+                            "name": field_name,
+                            "$or": [
+                                {"last_update": {"$not": {"$type": "date"}}},
+                                {"last_update": {"$lte": timestamp}}
+                            ]
+                        }
+                    }
+                },
+                {
+                    "$set": {
+                        "fields.$.last_value": value,
+                        "fields.$.last_update": timestamp
+                    },
+                    "$max": {"updated_at": timestamp}
+                }
+            ))
+        if not operations:
+            return 0
+
+        started = time.perf_counter()
+        try:
+            await mongodb.get_collection("dashboards").bulk_write(operations, ordered=False)
+        except Exception:
+            # Put the readings back so the next window retries them, unless newer ones arrived
+            with self._lock:
+                for key, (value, timestamp) in pending.items():
+                    current = self._pending.get(key)
+                    if current is None or _as_aware(timestamp) > _as_aware(current[1]):
+                        self._pending[key] = (value, timestamp)
+            raise
+        self.flushes += 1
+        self.written += len(operations)
+        self.last_flush_size = len(operations)
+        self.last_flush_latency_ms = (time.perf_counter() - started) * 1000
+        return len(operations)
+
+    def stats(self) -> dict:
+        with self._lock:
+            pending = len(self._pending)
+        return {
+            "running": self.running,
+            "pending_fields": pending,
+            "flush_interval_ms": self.flush_interval_ms,
+            "offered": self.offered,
+            "written": self.written,
+            "flushes": self.flushes,
+            "last_flush_size": self.last_flush_size,
+            "last_flush_latency_ms": round(self.last_flush_latency_ms, 2),
+        }
+
+# Global last value coalescer instance
+last_value_coalescer = LastValueCoalescer(flush_interval_ms=settings.LAST_VALUE_FLUSH_INTERVAL_MS)
@@ -2,22 +2,107 @@ import asyncio
 import json
 import logging
 from datetime import datetime, timezone, timedelta
-from typing import Dict, Any
+import re
+from typing import Any, List, Optional, Tuple
 import paho.mqtt.client as mqtt
 from app.core.config import settings
-from app.db.mongodb import mongodb
-from bson import ObjectId
-import motor.motor_asyncio
+from app.services.dashboard_registry import dashboard_registry
+from app.services.ingest_buffer import ingest_buffer
+from app.services.mqtt_work_queue import MQTTMessage, MQTTWorkQueue
 import os
+import socket
 
 logger = logging.getLogger(__name__)
 
 # IST timezone (UTC+5:30)
 IST_TIMEZONE = timezone(timedelta(hours=5, minutes=30))
 
+# Topics consumed by the ingest service
+SUBSCRIPTION_TOPICS = [
+    "tankmanage/+/+",    # tankmanage/dashboard_id/field_name (and tankmanage/dashboard_id/batch)
+    "tankmanage/+/+/+",  # tankmanage/dashboard_id/field_name/data
+]
+
+def build_client_id() -> str:
+    """Client id unique per worker process, so several consumers can share one subscription group"""
+    return f"{settings.MQTT_CLIENT_ID_PREFIX}-{socket.gethostname()}-{os.getpid()}"
+
+def subscription_topic(topic: str) -> str:
+    """Wrap a topic in a shared subscription ($share/<group>/<topic>) when a group is configured"""
+    if settings.MQTT_SHARED_GROUP:
+        return f"$share/{settings.MQTT_SHARED_GROUP}/{topic}"
+    return topic
+
+# Backoff between attempts to (re)connect to the broker, doubling from min to max
+MQTT_RECONNECT_MIN_DELAY_SECONDS = 1
+MQTT_RECONNECT_MAX_DELAY_SECONDS = 60
+
+# Reserved field segment for multi-field messages: tankmanage/{dashboard_id}/batch
+BATCH_TOPIC_SEGMENT = "batch"
+
+def parse_sample_timestamp(raw: Any) -> datetime:
+    """
+    Parse a sample timestamp given as epoch seconds, epoch milliseconds or an ISO 8601 string.
+    An ISO string without an offset is IST wall-clock time, as everywhere else in the app.
+    """
+    if isinstance(raw, (int, float)) or (isinstance(raw, str) and raw.replace('.', '', 1).isdigit()):
+        epoch = float(raw)
+        if epoch > 1e11:  # milliseconds
+            epoch /= 1000
+        return datetime.fromtimestamp(epoch, tz=timezone.utc).astimezone(IST_TIMEZONE)
+    ts = datetime.fromisoformat(str(raw).replace('Z', '+00:00'))
+    if ts.tzinfo is None:
+        return ts.replace(tzinfo=IST_TIMEZONE)
+    return ts.astimezone(IST_TIMEZONE)
+
+def parse_batch_payload(payload: str) -> List[Tuple[str, float, Optional[datetime]]]:
+    """
+    Parse a batch topic payload into (field_name, value, timestamp or None) samples.
+    Accepted forms:
+      {"level": 42.1, "trend": 1}                        one value per field
+      {"level": [[1700000000, 42.1], [1700000010, 42.3]]} timestamped samples per field
+      [{"f": "level", "v": 42.1, "t": 1700000000}, ...]   sample list (also field/value/timestamp)
+      level=42.1,trend=1                                 field=value pairs (',', ';', '&' or newline separated,
+                                                         optional @timestamp suffix on the value)
+    Raises ValueError on malformed payloads.
+    """
+    payload = payload.strip()
+    samples: List[Tuple[str, float, Optional[datetime]]] = []
+    if payload.startswith('{') or payload.startswith('['):
+        data = json.loads(payload)
+        if isinstance(data, dict):
+            for field_name, value in data.items():
+                if isinstance(value, list):
+                    for sample_ts, sample_value in value:
+                        samples.append((field_name, float(sample_value), parse_sample_timestamp(sample_ts)))
+                else:
+                    samples.append((field_name, float(value), None))
+        else:
+            for sample in data:
+                field_name = sample.get("f", sample.get("field"))
+                value = sample.get("v", sample.get("value"))
+                raw_ts = sample.get("t", sample.get("timestamp"))
+                if not field_name or value is None:
+                    raise ValueError(f"Sample without field or value: {sample}")
+                samples.append((field_name, float(value), parse_sample_timestamp(raw_ts) if raw_ts is not None else None))
+        return samples
+
+    for pair in re.split(r'[,;&\n]+', payload):
+        pair = pair.strip()
+        if not pair:
+            continue
+        field_name, sep, value = pair.partition('=')
+        if not sep or not field_name:
+            raise ValueError(f"Expected field=value, got {pair!r}")
+        value, _, raw_ts = value.partition('@')
+        samples.append((field_name.strip(), float(value), parse_sample_timestamp(raw_ts.strip()) if raw_ts else None))
+    return samples
+
 class MQTTService:
     def __init__(self):
-        self.client = mqtt.Client()
+        self.protocol = mqtt.MQTTv5 if settings.MQTT_PROTOCOL == "5" else mqtt.MQTTv311
+        self.client_id = build_client_id()
+        self.client = mqtt.Client(client_id=self.client_id, protocol=self.protocol)
         # Set username and password from environment or settings
         username = getattr(settings, 'MQTT_USERNAME', os.getenv('MQTT_USERNAME', ''))
         password = getattr(settings, 'MQTT_PASSWORD', os.getenv('MQTT_PASSWORD', ''))
@@ -29,18 +114,34 @@ class MQTTService:
         self.client.on_connect = self.on_connect
         self.client.on_message = self.on_message
         self.client.on_disconnect = self.on_disconnect
+        # Bounded queue between the network thread and the processing workers
+        self.work_queue = MQTTWorkQueue(
+            max_size=settings.MQTT_QUEUE_MAX_SIZE,
+            workers=settings.MQTT_WORKERS,
+            overflow_policy=settings.MQTT_OVERFLOW_POLICY,
+            spill_path=settings.MQTT_SPILL_PATH,
+            block_timeout_ms=settings.MQTT_BLOCK_TIMEOUT_MS,
+        )
         
-    def start(self):
-        """Start the MQTT service"""
+    def start(self, loop: asyncio.AbstractEventLoop = None):
+        """Start the MQTT service, processing messages on the given (or current) event loop"""
         try:
+            self.work_queue.start(loop or asyncio.get_event_loop(), self.handle_message)
             # Connect to local Mosquitto broker
             broker = getattr(settings, 'MQTT_BROKER', 'localhost')
             port = getattr(settings, 'MQTT_PORT', 1883)
             
-            self.client.connect(broker, port, 60)
+            # Connect from the network thread, which keeps retrying (with backoff) until the broker
+            # is reachable and reconnects after a lost connection, so a broker that is not up yet
+            # does not leave this process running without a subscription
+            self.client.reconnect_delay_set(min_delay=MQTT_RECONNECT_MIN_DELAY_SECONDS, max_delay=MQTT_RECONNECT_MAX_DELAY_SECONDS)
+            if self.protocol == mqtt.MQTTv5:
+                self.client.connect_async(broker, port, 60, clean_start=True)
+            else:
+                self.client.connect_async(broker, port, 60)
             self.client.loop_start()
             
-            logger.info(f"MQTT service started successfully on {broker}:{port}")
+            logger.info(f"MQTT service started, connecting to {broker}:{port} as {self.client_id}")
         except Exception as e:
             logger.error(f"Failed to start MQTT service: {e}")
             raise
@@ -54,17 +155,16 @@ class MQTTService:
         except Exception as e:
             logger.error(f"Error stopping MQTT service: {e}")
     
-    def on_connect(self, client, userdata, flags, rc):
+    def on_connect(self, client, userdata, flags, rc, properties=None):
         """Callback when connected to MQTT broker"""
         if rc == 0:
             logger.info("Connected to MQTT broker")
-            # Subscribe to TankManage topics
-            client.subscribe("tankmanage/+/+")  # tankmanage/dashboard_id/field_name
-            client.subscribe("tankmanage/+/+/+")  # tankmanage/dashboard_id/field_name/data
+            # Subscribe to TankManage topics, shared across ingest workers when a group is configured
+            client.subscribe([(subscription_topic(topic), 0) for topic in SUBSCRIPTION_TOPICS])
         else:
             logger.error(f"Failed to connect to MQTT broker with code: {rc}")
     
-    def on_disconnect(self, client, userdata, rc):
+    def on_disconnect(self, client, userdata, rc, properties=None):
         """Callback when disconnected from MQTT broker"""
         if rc != 0:
             logger.warning(f"Unexpected disconnection from MQTT broker with code: {rc}")
@@ -72,95 +172,119 @@ class MQTTService:
             logger.info("Disconnected from MQTT broker")
     
     def on_message(self, client, userdata, msg):
-        """Callback when message is received from MQTT broker"""
+        """Callback when message is received from MQTT broker; only queues it for the workers"""
         try:
-            topic = msg.topic
-            payload = msg.payload.decode('utf-8')
-            
-            logger.info(f"Received message on topic {topic}: {payload}")
-            
-            # Parse topic: tankmanage/{dashboard_id}/{field_name}
-            topic_parts = topic.split('/')
-            
-            if len(topic_parts) >= 3 and topic_parts[0] == 'tankmanage':
-                dashboard_id = topic_parts[1]
-                field_name = topic_parts[2]
-                
-                # Try to parse as float value
-                try:
-                    value = float(payload)
-                    # Process data synchronously to avoid event loop issues
-                    self.process_field_data_sync(dashboard_id, field_name, value)
-                except ValueError:
-                    logger.error(f"Invalid payload format: {payload}")
-                    return
-                    
+            self.work_queue.put(MQTTMessage(msg.topic, msg.payload, datetime.now(IST_TIMEZONE)))
         except Exception as e:
-            logger.error(f"Error processing MQTT message: {e}")
+            logger.error(f"Error queueing MQTT message: {e}")
     
-    def process_field_data_sync(self, dashboard_id: str, field_name: str, value: float):
-        """Process data for a single field synchronously"""
-        try:
-            # Use synchronous MongoDB operations
-            from pymongo import MongoClient
+    async def handle_message(self, message: MQTTMessage):
+        """Parse a queued message and process it (runs on a work queue worker)"""
+        topic = message.topic
+        payload = message.payload.decode('utf-8')
+        
+        logger.debug(f"Received message on topic {topic}: {payload}")
+        
+        # Parse topic: tankmanage/{dashboard_id}/{field_name}
+        topic_parts = topic.split('/')
+        
+        if len(topic_parts) == 3 and topic_parts[0] == 'tankmanage' and topic_parts[2] == BATCH_TOPIC_SEGMENT:
+            try:
+                samples = parse_batch_payload(payload)
+            except (ValueError, TypeError, AttributeError) as e:
+                logger.error(f"Invalid batch payload on {topic}: {e}")
+                return
+            await self.process_batch_data(topic_parts[1], samples, message.received_at)
+            return
+        
+        if len(topic_parts) >= 3 and topic_parts[0] == 'tankmanage':
+            dashboard_id = topic_parts[1]
+            field_name = topic_parts[2]
             
-            # Get MongoDB connection string from settings
-            mongo_url = getattr(settings, 'MONGODB_URI', 'mongodb://localhost:27017/thingspeak_clone')
-            client = MongoClient(mongo_url)
-            db = client.thingspeak_clone  # Use the correct database name
+            # Try to parse as float value
+            try:
+                value = float(payload)
+            except ValueError:
+                logger.error(f"Invalid payload format: {payload}")
+                return
             
-            # Validate dashboard and field exist
-            dashboard = db.dashboards.find_one({"_id": ObjectId(dashboard_id)})
+            await self.process_field_data(dashboard_id, field_name, value, message.received_at)
+    
+    async def process_field_data(self, dashboard_id: str, field_name: str, value: float, received_at: datetime):
+        """Process data for a single field on the event loop, using the app's pooled MongoDB client"""
+        try:
+            # Validate dashboard and field exist (served from the in-memory registry)
+            dashboard = await dashboard_registry.get_by_id(dashboard_id)
             if not dashboard:
                 logger.warning(f"Dashboard {dashboard_id} not found")
                 return
             
             # Check if field exists in dashboard
-            field_exists = any(field["name"] == field_name for field in dashboard.get("fields", []))
-            if not field_exists:
+            dashboard = await dashboard_registry.ensure_fields(dashboard, [field_name])
+            if not dashboard.has_field(field_name):
                 logger.warning(f"Field {field_name} not found in dashboard {dashboard_id}")
                 return
             
-            # Create data point with IST timestamp
-            current_time_ist = datetime.now(IST_TIMEZONE)
             data_point = {
                 "dashboard_id": dashboard_id,
                 "field_name": field_name,
                 "value": float(value),
-                "timestamp": current_time_ist,
+                "timestamp": received_at,
                 "metadata": {"source": "mqtt", "topic": f"tankmanage/{dashboard_id}/{field_name}"}
             }
             
-            # Store in database
-            result = db.data_points.insert_one(data_point)
+            # Hand off to the write-behind ingest buffer, which batches the insert
+            # and coalesces the field's last value
+            data_point_id = await ingest_buffer.put(data_point)
             
-            # Update dashboard field with latest value
-            db.dashboards.update_one(
-                {"_id": ObjectId(dashboard_id), "fields.name": field_name},
-                {
-                    "$set": {
-                        "fields.$.last_value": float(value),
-                        "fields.$.last_update": current_time_ist,
-                        "updated_at": current_time_ist
-                    }
-                }
-            )
+            logger.debug(f"Queued data point: {data_point_id} for field {field_name} in dashboard {dashboard_id}")
             
-            logger.info(f"Stored data point: {result.inserted_id} for field {field_name} in dashboard {dashboard_id}")
+        except Exception as e:
+            logger.error(f"Error processing field data: {e}")
+
+    async def process_batch_data(self, dashboard_id: str, samples: List[Tuple[str, float, Optional[datetime]]], received_at: datetime):
+        """Process all samples of a batch message, written through the ingest buffer as one bulk insert"""
+        try:
+            dashboard = await dashboard_registry.get_by_id(dashboard_id)
+            if not dashboard:
+                logger.warning(f"Dashboard {dashboard_id} not found")
+                return
             
-            # Close connection
-            client.close()
+            dashboard = await dashboard_registry.ensure_fields(dashboard, {field_name for field_name, _, _ in samples})
+            
+            topic = f"tankmanage/{dashboard_id}/{BATCH_TOPIC_SEGMENT}"
+            data_points = []
+            for field_name, value, timestamp in samples:
+                if not dashboard.has_field(field_name):
+                    logger.warning(f"Field {field_name} not found in dashboard {dashboard_id}")
+                    continue
+                # Same rule as HTTP ingest: only admin dashboards may set their own timestamps
+                if timestamp is not None and not dashboard.is_admin:
+                    logger.warning(f"Dropping timestamped sample for {field_name}: dashboard {dashboard_id} is not an admin dashboard")
+                    continue
+                data_points.append({
+                    "dashboard_id": dashboard_id,
+                    "field_name": field_name,
+                    "value": value,
+                    "timestamp": timestamp if timestamp is not None else received_at,
+                    "metadata": {"source": "mqtt", "topic": topic, "custom_timestamp": timestamp is not None}
+                })
+            
+            if data_points:
+                await ingest_buffer.put_many(data_points)
+                logger.debug(f"Queued {len(data_points)} data points from batch message for dashboard {dashboard_id}")
             
         except Exception as e:
-            logger.error(f"Error processing field data: {e}")
+            logger.error(f"Error processing batch data: {e}")
 
 # Global MQTT service instance
 mqtt_service = MQTTService()
 
-def start_mqtt_service():
+def start_mqtt_service(loop: asyncio.AbstractEventLoop = None):
     """Start the MQTT service"""
-    mqtt_service.start()
+    mqtt_service.start(loop)
 
-def stop_mqtt_service():
-    """Stop the MQTT service"""
-    mqtt_service.stop() 
\ No newline at end of file
+async def stop_mqtt_service():
+    """Stop the MQTT service and finish processing queued messages"""
+    mqtt_service.stop()
+    await mqtt_service.work_queue.stop() 
\ No newline at end of file
@@ -0,0 +1,308 @@
+import asyncio
+import base64
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from typing import Awaitable, Callable, Deque, List, NamedTuple, Optional
+
+logger = logging.getLogger(__name__)
+
+OVERFLOW_POLICIES = ("block", "drop_oldest", "spill")
+
+class MQTTMessage(NamedTuple):
+    topic: str
+    payload: bytes
+    received_at: datetime
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+class MQTTWorkQueue:
+    """
+    Bounded queue between paho's network thread and a pool of asyncio workers.
+    put() is called from the network thread and never touches the database; when the
+    queue is full the overflow policy decides what happens:
+      - block: wait up to block_timeout_ms for room, then drop the new message
+      - drop_oldest: discard the oldest queued message to make room
+      - spill: append the message to a file on disk, replayed once the queue drains
+
+    Each process spills to its own file (spill_path with the host and pid inserted before the
+    extension). To replay, the file is renamed aside and read in a worker thread, with the read
+    offset kept in a sidecar file, so nothing is replayed twice and the lock is only held for the
+    rename. Spill files left by a process that has since exited on this host are adopted and
+    replayed on the next start.
+    """
+
+    def __init__(self, max_size: int, workers: int, overflow_policy: str, spill_path: str, block_timeout_ms: int):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown MQTT overflow policy {overflow_policy!r}, expected one of {OVERFLOW_POLICIES}")
+        self.max_size = max_size
+        self.workers = workers
+        self.overflow_policy = overflow_policy
+        self.spill_base = spill_path
+        # Dots are reserved as file name separators, so the owner cannot contain any
+        self.owner = f"{socket.gethostname()}-{os.getpid()}".replace(".", "_")
+        stem, self._spill_ext = os.path.splitext(spill_path)
+        self.spill_path = f"{stem}.{self.owner}{self._spill_ext}"
+        self.block_timeout_ms = block_timeout_ms
+        self._items: Deque[MQTTMessage] = deque()
+        self._cond = threading.Condition()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._tasks: List[asyncio.Task] = []
+        self._handler: Optional[Callable[[MQTTMessage], Awaitable[None]]] = None
+        self._stopping = False
+        # Set under the lock when a message is spilled; replay state is only touched by the replaying worker
+        self._spill_pending = False
+        self._adopt_pending = True
+        self._replay_files: Deque[str] = deque()
+        self._replay_lock: Optional[asyncio.Lock] = None
+        self.received = 0
+        self.processed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.in_flight = 0
+
+    def start(self, loop: asyncio.AbstractEventLoop, handler: Callable[[MQTTMessage], Awaitable[None]]):
+        """Start the worker pool on the given event loop (must be called from that loop's thread)"""
+        self._loop = loop
+        self._handler = handler
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+        self._replay_lock = asyncio.Lock()
+        self._tasks = [loop.create_task(self._worker()) for _ in range(self.workers)]
+        # Look for spill files of exited processes once the workers run
+        self._adopt_pending = True
+        self._loop.call_soon(self._wakeup.set)
+        logger.info(f"MQTT work queue started (size={self.max_size}, workers={self.workers}, overflow={self.overflow_policy})")
+
+    async def stop(self):
+        """Let the workers finish the queued messages, then stop them"""
+        if not self._tasks:
+            return
+        self._stopping = True
+        with self._cond:
+            self._cond.notify_all()
+        self._wakeup.set()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        logger.info("MQTT work queue stopped")
+
+    def put(self, message: MQTTMessage) -> bool:
+        """Queue a message from the network thread. Returns False if it was dropped."""
+        with self._cond:
+            self.received += 1
+            if len(self._items) >= self.max_size:
+                if self.overflow_policy == "block":
+                    self._cond.wait_for(lambda: len(self._items) < self.max_size or self._stopping, self.block_timeout_ms / 1000)
+                    if len(self._items) >= self.max_size:
+                        self.dropped += 1
+                        return False
+                elif self.overflow_policy == "drop_oldest":
+                    self._items.popleft()
+                    self.dropped += 1
+                else:
+                    if self._spill(message):
+                        self.spilled += 1
+                        return True
+                    self.dropped += 1
+                    return False
+            self._items.append(message)
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+        return True
+
+    def _take(self) -> Optional[MQTTMessage]:
+        with self._cond:
+            if not self._items:
+                return None
+            message = self._items.popleft()
+            self._cond.notify()
+            return message
+
+    def _has_spilled(self) -> bool:
+        return self._adopt_pending or self._spill_pending or bool(self._replay_files)
+
+    async def _worker(self):
+        while True:
+            message = self._take()
+            if message is None and self._has_spilled():
+                await self._replay()
+                message = self._take()
+            if message is None:
+                if self._stopping:
+                    return
+                self._wakeup.clear()
+                message = self._take()
+                if message is None:
+                    await self._wakeup.wait()
+                    continue
+            self.in_flight += 1
+            try:
+                await self._handler(message)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Error processing MQTT message on {message.topic}: {e}")
+            finally:
+                self.in_flight -= 1
+
+    async def _replay(self):
+        """Move up to half a queue's worth of spilled messages back into memory, reading in a worker thread"""
+        async with self._replay_lock:
+            with self._cond:
+                if self._items:
+                    return
+            messages = await self._loop.run_in_executor(None, self._read_spilled)
+            if messages:
+                with self._cond:
+                    self._items.extend(messages)
+                self._wakeup.set()
+
+    def _new_replay_path(self) -> str:
+        return f"{os.path.splitext(self.spill_base)[0]}.{self.owner}.{time.time_ns()}.replay"
+
+    def _spill_size(self) -> int:
+        try:
+            return os.path.getsize(self.spill_path)
+        except OSError:
+            return 0
+
+    def _spill(self, message: MQTTMessage) -> bool:
+        """Append a message to this process's spill file (called with the lock held)"""
+        try:
+            with open(self.spill_path, "a", encoding="utf-8") as spill_file:
+                spill_file.write(json.dumps({
+                    "topic": message.topic,
+                    "payload": base64.b64encode(message.payload).decode("ascii"),
+                    "received_at": message.received_at.isoformat(),
+                }) + "\n")
+            self._spill_pending = True
+            return True
+        except OSError as e:
+            logger.error(f"Could not spill MQTT message to {self.spill_path}: {e}")
+            return False
+
+    def _adopt_orphans(self):
+        """Take over spill files of processes on this host that are no longer running (worker thread)"""
+        directory, name = os.path.split(self.spill_base)
+        stem = os.path.splitext(name)[0]
+        hostname = socket.gethostname().replace(".", "_")
+        for entry in sorted(os.listdir(directory or ".")):
+            if entry != name:
+                # <stem>.<owner><ext> (spilling) or <stem>.<owner>.<n>.replay (being replayed)
+                if not entry.startswith(f"{stem}.") or not (entry.endswith(self._spill_ext) or entry.endswith(".replay")):
+                    continue
+                owner = entry[len(stem) + 1:].split(".")[0]
+                host, _, pid = owner.rpartition("-")
+                if owner == self.owner or host != hostname or not pid.isdigit() or _process_alive(int(pid)):
+                    continue
+            # The unsuffixed file was written before spill files were per process
+            path = os.path.join(directory, entry)
+            target = self._new_replay_path()
+            try:
+                if os.path.exists(f"{path}.offset"):
+                    os.rename(f"{path}.offset", f"{target}.offset")
+                os.rename(path, target)
+            except FileNotFoundError:
+                # Adopted by another process first
+                continue
+            self._replay_files.append(target)
+            logger.info(f"Replaying MQTT messages spilled by an exited process from {entry}")
+
+    def _read_spilled(self) -> List[MQTTMessage]:
+        """Read the next spilled messages (worker thread, one caller at a time)"""
+        messages: List[MQTTMessage] = []
+        try:
+            if self._adopt_pending:
+                self._adopt_pending = False
+                self._adopt_orphans()
+            if not self._replay_files:
+                # Set the spill file aside; messages spilled from now on start a new one
+                replay_path = self._new_replay_path()
+                with self._cond:
+                    if not self._spill_pending:
+                        return messages
+                    self._spill_pending = False
+                    try:
+                        os.rename(self.spill_path, replay_path)
+                    except FileNotFoundError:
+                        return messages
+                self._replay_files.append(replay_path)
+
+            path = self._replay_files[0]
+            offset_path = f"{path}.offset"
+            try:
+                with open(offset_path, "r", encoding="utf-8") as offset_file:
+                    offset = int(offset_file.read().strip() or 0)
+            except (OSError, ValueError):
+                offset = 0
+            with open(path, "r", encoding="utf-8") as spill_file:
+                spill_file.seek(offset)
+                for _ in range(max(1, self.max_size // 2)):
+                    line = spill_file.readline()
+                    if not line:
+                        break
+                    try:
+                        record = json.loads(line)
+                        messages.append(MQTTMessage(
+                            topic=record["topic"],
+                            payload=base64.b64decode(record["payload"]),
+                            received_at=datetime.fromisoformat(record["received_at"]),
+                        ))
+                    except (ValueError, KeyError) as e:
+                        logger.error(f"Skipping unreadable spilled MQTT message in {path}: {e}")
+                offset = spill_file.tell()
+            if offset >= os.path.getsize(path):
+                # Everything replayed
+                os.remove(path)
+                if os.path.exists(offset_path):
+                    os.remove(offset_path)
+                self._replay_files.popleft()
+            else:
+                with open(offset_path, "w", encoding="utf-8") as offset_file:
+                    offset_file.write(str(offset))
+        except OSError as e:
+            logger.error(f"Could not replay spilled MQTT messages: {e}")
+        return messages
+
+    def _spill_pending_bytes(self) -> int:
+        total = self._spill_size()
+        for path in list(self._replay_files):
+            try:
+                total += os.path.getsize(path)
+                with open(f"{path}.offset", "r", encoding="utf-8") as offset_file:
+                    total -= int(offset_file.read().strip() or 0)
+            except (OSError, ValueError):
+                pass
+        return max(0, total)
+
+    def stats(self) -> dict:
+        with self._cond:
+            depth = len(self._items)
+        return {
+            "workers": self.workers,
+            "overflow_policy": self.overflow_policy,
+            "max_size": self.max_size,
+            "queue_depth": depth,
+            "received": self.received,
+            "processed": self.processed,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "spilled": self.spilled,
+            "spill_path": self.spill_path,
+            "spill_pending_bytes": self._spill_pending_bytes(),
+            "in_flight": self.in_flight,
+        }
@@ -0,0 +1,137 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Set, Tuple
+from app.core.config import settings
+
+class ResponseCache:
+    """
+    Bounded LRU/TTL cache of rendered read responses, keyed by (dashboard_id, key).
+    Callers fold the dashboard's current version into the key (the dashboard ETag), so an
+    ingest seen by any process changes the key; ingest in this process also invalidates the
+    dashboard's entries directly. Concurrent misses for the same key share one load.
+    """
+
+    def __init__(self, enabled: bool, max_entries: int, ttl_seconds: float):
+        self.enabled = enabled
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[Tuple[str, Hashable], Tuple[float, Any]]" = OrderedDict()
+        self._by_dashboard: Dict[str, Set[Tuple[str, Hashable]]] = {}
+        self._in_flight: Dict[Tuple[str, Hashable], asyncio.Future] = {}
+        # invalidate() is called from ingest paths that may run off the event loop thread
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def _get(self, cache_key: Tuple[str, Hashable]):
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if time.monotonic() >= expires_at:
+                self._remove(cache_key)
+                self.expirations += 1
+                return None
+            self._entries.move_to_end(cache_key)
+            return entry
+
+    def _remove(self, cache_key: Tuple[str, Hashable]):
+        """Drop an entry (called with the lock held)"""
+        self._entries.pop(cache_key, None)
+        keys = self._by_dashboard.get(cache_key[0])
+        if keys is not None:
+            keys.discard(cache_key)
+            if not keys:
+                del self._by_dashboard[cache_key[0]]
+
+    def _set(self, cache_key: Tuple[str, Hashable], value: Any):
+        with self._lock:
+            self._entries[cache_key] = (time.monotonic() + self.ttl_seconds, value)
+            self._entries.move_to_end(cache_key)
+            self._by_dashboard.setdefault(cache_key[0], set()).add(cache_key)
+            while len(self._entries) > self.max_entries:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    async def get_or_load(self, dashboard_id: str, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        """Return the cached value for the key, or run loader once for all concurrent callers and cache it"""
+        if not self.enabled:
+            return await loader()
+        cache_key = (dashboard_id, key)
+        entry = self._get(cache_key)
+        if entry is not None:
+            self.hits += 1
+            return entry[1]
+
+        in_flight = self._in_flight.get(cache_key)
+        if in_flight is not None:
+            self.coalesced += 1
+            return await asyncio.shield(in_flight)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[cache_key] = future
+        try:
+            value = await loader()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Waiters see the exception; mark it retrieved so an unshared failure is not logged as unhandled
+            future.exception()
+            raise
+        else:
+            future.set_result(value)
+            self._set(cache_key, value)
+            return value
+        finally:
+            self._in_flight.pop(cache_key, None)
+
+    def invalidate(self, dashboard_id: str):
+        """Forget every cached response of a dashboard"""
+        with self._lock:
+            keys = self._by_dashboard.pop(str(dashboard_id), None)
+            if not keys:
+                return
+            for cache_key in keys:
+                self._entries.pop(cache_key, None)
+            self.invalidations += len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_dashboard.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = len(self._entries)
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "enabled": self.enabled,
+            "entries": entries,
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "hit_ratio": round((self.hits + self.coalesced) / lookups, 4) if lookups else 0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+        }
+
+# Global response cache instance
+response_cache = ResponseCache(
+    enabled=settings.RESPONSE_CACHE_ENABLED,
+    max_entries=settings.RESPONSE_CACHE_MAX_ENTRIES,
+    ttl_seconds=settings.RESPONSE_CACHE_TTL_SECONDS,
+)
@@ -0,0 +1,336 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Optional, Tuple
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from app.core.config import settings
+from app.db.mongodb import mongodb
+from app.services.bucket_storage import BUCKET_COLLECTION, bucket_storage
+from app.services.dashboard_purge import delete_in_chunks
+from app.services.rollups import ROLLUP_RESOLUTIONS, rollup_collection_name, rollup_service
+from app.services.timeseries import floor_to_bucket
+
+logger = logging.getLogger(__name__)
+
+# Per-dashboard compaction progress and lease, kept out of the dashboard documents so
+# compaction does not change their ETags
+RETENTION_STATE_COLLECTION = "retention_state"
+
+DAY_MS = 86400 * 1000
+
+# Raw data is summarised and deleted this many days at a time, bounding each aggregation
+COMPACTION_WINDOW_DAYS = 7
+
+# A compaction whose worker has not reported progress for this long is taken over by another worker
+RETENTION_LEASE_SECONDS = 900
+
+RAW_COLLECTIONS = ("data_points", BUCKET_COLLECTION)
+SUMMARY_COLLECTIONS = tuple(rollup_collection_name(resolution) for resolution in ROLLUP_RESOLUTIONS)
+
+async def collection_sizes(collection_name: str) -> Dict[str, int]:
+    """Document count and data, storage, free (reusable) and index bytes of a collection"""
+    try:
+        stats = await mongodb.database.command("collStats", collection_name)
+    except OperationFailure:
+        return {}
+    return {
+        "count": stats.get("count", 0),
+        "size": stats.get("size", 0),
+        "storage_size": stats.get("storageSize", 0),
+        "free_storage_size": stats.get("freeStorageSize", 0),
+        "index_size": stats.get("totalIndexSize", 0),
+        "avg_obj_size": stats.get("avgObjSize", 0),
+    }
+
+class LeaseLost(Exception):
+    """Another worker took over a dashboard's compaction lease"""
+
+class RetentionCompactor:
+    """
+    Enforces per-dashboard retention. Raw readings older than raw_days are first summarised into
+    the 1m/1h/1d rollups (recomputed from the raw samples, so history written before rollups were
+    enabled is covered too), then deleted in chunks; rollup buckets older than their resolution's
+    summary days (summary_days, or summary_days_by_resolution for 1m/1h/1d separately) are deleted
+    the same way. Cutoffs are aligned to IST days so every summarised bucket is complete.
+    A dashboard's retention overrides the server defaults; 0 keeps forever.
+    """
+
+    def __init__(self, default_raw_days: int, default_summary_days: int, interval_seconds: float, chunk_size: int, chunk_delay_ms: int):
+        self.default_raw_days = default_raw_days
+        self.default_summary_days = default_summary_days
+        self.interval_seconds = interval_seconds
+        self.chunk_size = chunk_size
+        self.chunk_delay_ms = chunk_delay_ms
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._task: Optional[asyncio.Task] = None
+        self._stopping: Optional[asyncio.Event] = None
+        self.runs = 0
+        self.dashboards_compacted = 0
+        self.deleted_raw = 0
+        self.deleted_summaries = 0
+        self.last_report: Optional[Dict[str, Any]] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def policy(self, dashboard: Dict[str, Any]) -> Tuple[int, Dict[str, int]]:
+        """(raw_days, summary days per rollup resolution) of a dashboard; 0 means keep forever"""
+        retention = dashboard.get("retention") or {}
+        raw_days = retention.get("raw_days")
+        summary_days = retention.get("summary_days")
+        if summary_days is None:
+            summary_days = self.default_summary_days
+        by_resolution = retention.get("summary_days_by_resolution") or {}
+        return (
+            self.default_raw_days if raw_days is None else raw_days,
+            {resolution: by_resolution.get(resolution, summary_days) for resolution in ROLLUP_RESOLUTIONS},
+        )
+
+    def check_policy(self, retention: Dict[str, Any]):
+        """
+        Raise ValueError for a retention that would delete summaries while their raw data is kept:
+        bucketed queries read the summaries for every full bucket, so they would return gaps
+        """
+        unknown = set(retention.get("summary_days_by_resolution") or {}) - set(ROLLUP_RESOLUTIONS)
+        if unknown:
+            raise ValueError(f"Unknown rollup resolutions {sorted(unknown)}, expected {list(ROLLUP_RESOLUTIONS)}")
+        raw_days, summary_days = self.policy({"retention": retention})
+        for resolution, days in summary_days.items():
+            if days < 0:
+                raise ValueError(f"{resolution} summary days must not be negative")
+            if days and (not raw_days or days < raw_days):
+                raise ValueError(
+                    f"{resolution} summaries would be deleted after {days} days but raw data is kept "
+                    f"{f'{raw_days} days' if raw_days else 'forever'}; summary days must be 0 or at least raw_days"
+                )
+
+    async def start(self):
+        if self.running:
+            return
+        self._stopping = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Retention compactor started (interval={self.interval_seconds}s)")
+
+    async def stop(self):
+        """Stop after the current chunk; the next run continues from the recorded progress"""
+        if self.running:
+            self._stopping.set()
+            await self._task
+            self._task = None
+
+    def _stopped(self) -> bool:
+        return self._stopping is not None and self._stopping.is_set()
+
+    async def _run(self):
+        while not self._stopping.is_set():
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.error(f"Error compacting expired data: {e}")
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.interval_seconds)
+            except asyncio.TimeoutError:
+                pass
+
+    async def run_once(self) -> Dict[str, Any]:
+        """Compact every dashboard with a retention policy; returns a report including reclaimed space"""
+        started = time.perf_counter()
+        collections = (*RAW_COLLECTIONS, *SUMMARY_COLLECTIONS)
+        sizes_before = {name: await collection_sizes(name) for name in collections}
+
+        deleted: Dict[str, int] = {name: 0 for name in collections}
+        compacted = 0
+        async for dashboard in mongodb.get_collection("dashboards").find({}, {"retention": 1}):
+            if self._stopped():
+                break
+            raw_days, summary_days = self.policy(dashboard)
+            if not raw_days and not any(summary_days.values()):
+                continue
+            try:
+                result = await self.compact_dashboard(str(dashboard["_id"]), raw_days, summary_days)
+            except Exception as e:
+                logger.error(f"Could not compact dashboard {dashboard['_id']}: {e}")
+                continue
+            if result is None:
+                continue
+            compacted += 1
+            for name, count in result.items():
+                deleted[name] += count
+
+        sizes_after = {name: await collection_sizes(name) for name in collections}
+        reclaimed = {}
+        for name in collections:
+            before, after = sizes_before[name], sizes_after[name]
+            if not before or not after:
+                continue
+            # Net size changes also include concurrent ingest; the estimate counts only what was deleted
+            reclaimed[name] = {
+                "deleted": deleted[name],
+                "estimated_bytes": deleted[name] * before["avg_obj_size"],
+                "data_bytes": before["size"] - after["size"],
+                "index_bytes": before["index_size"] - after["index_size"],
+                "free_storage_bytes": after["free_storage_size"],
+                "storage_size": after["storage_size"],
+            }
+
+        self.runs += 1
+        self.dashboards_compacted += compacted
+        self.deleted_raw += sum(deleted[name] for name in RAW_COLLECTIONS)
+        self.deleted_summaries += sum(deleted[name] for name in SUMMARY_COLLECTIONS)
+        self.last_report = {
+            "finished_at": datetime.now(timezone.utc).isoformat(),
+            "duration_ms": round((time.perf_counter() - started) * 1000, 2),
+            "dashboards": compacted,
+            "reclaimed_estimated_bytes": sum(item["estimated_bytes"] for item in reclaimed.values()),
+            "reclaimed_data_bytes": sum(item["data_bytes"] for item in reclaimed.values()),
+            "reclaimed_index_bytes": sum(item["index_bytes"] for item in reclaimed.values()),
+            "collections": reclaimed,
+        }
+        if any(deleted.values()):
+            logger.info(
+                f"Retention compaction deleted {sum(deleted.values())} documents from {compacted} dashboards, "
+                f"reclaiming about {self.last_report['reclaimed_estimated_bytes']} data bytes "
+                f"(net: {self.last_report['reclaimed_data_bytes']} data, {self.last_report['reclaimed_index_bytes']} index bytes)"
+            )
+        return self.last_report
+
+    async def _claim(self, dashboard_id: str) -> Optional[Dict[str, Any]]:
+        """Take the dashboard's compaction lease, so only one worker compacts it at a time"""
+        now = datetime.now(timezone.utc)
+        try:
+            return await mongodb.get_collection(RETENTION_STATE_COLLECTION).find_one_and_update(
+                {"_id": dashboard_id, "$or": [{"lease_until": {"$exists": False}}, {"lease_until": {"$lt": now}}]},
+                {"$set": {"lease_until": now + timedelta(seconds=RETENTION_LEASE_SECONDS), "worker": self.worker_id}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            # The state document exists and another worker holds the lease
+            return None
+
+    async def _oldest_raw_timestamp(self, dashboard_id: str) -> Optional[datetime]:
+        if bucket_storage.enabled:
+            bucket = await mongodb.get_collection(BUCKET_COLLECTION).find_one({"dashboard_id": dashboard_id}, {"start": 1}, sort=[("start", 1)])
+            return bucket["start"] if bucket else None
+        point = await mongodb.get_collection("data_points").find_one({"dashboard_id": dashboard_id}, {"timestamp": 1}, sort=[("timestamp", 1)])
+        return point["timestamp"] if point else None
+
+    async def _renew(self, dashboard_id: str):
+        """Extend this worker's lease; raises LeaseLost if another worker has taken the dashboard over"""
+        result = await mongodb.get_collection(RETENTION_STATE_COLLECTION).update_one(
+            {"_id": dashboard_id, "worker": self.worker_id},
+            {"$set": {"lease_until": datetime.now(timezone.utc) + timedelta(seconds=RETENTION_LEASE_SECONDS)}},
+        )
+        if result.matched_count == 0:
+            raise LeaseLost(dashboard_id)
+
+    async def _delete(self, dashboard_id: str, collection_name: str, query: Dict[str, Any], deleted: Dict[str, int]):
+        """Delete chunk by chunk, adding to deleted as it goes and renewing the lease after every chunk"""
+        async for count in delete_in_chunks(collection_name, query, self.chunk_size, self.chunk_delay_ms):
+            deleted[collection_name] = deleted.get(collection_name, 0) + count
+            await self._renew(dashboard_id)
+            if self._stopped():
+                break
+
+    async def _delete_raw_before(self, dashboard_id: str, cutoff: datetime, deleted: Dict[str, int]):
+        """
+        Delete raw data before the cutoff from the configured layout only, since only that layout
+        is read when summarising; data in the other one waits for a migration or a purge
+        """
+        if bucket_storage.enabled:
+            # Only buckets that end by the cutoff; a bucket straddling it is kept whole
+            query = {"dashboard_id": dashboard_id, "start": {"$lte": cutoff - timedelta(seconds=bucket_storage.span_seconds)}}
+            await self._delete(dashboard_id, BUCKET_COLLECTION, query, deleted)
+        else:
+            await self._delete(dashboard_id, "data_points", {"dashboard_id": dashboard_id, "timestamp": {"$lt": cutoff}}, deleted)
+
+    async def compact_dashboard(self, dashboard_id: str, raw_days: int, summary_days: Dict[str, int]) -> Optional[Dict[str, int]]:
+        """
+        Summarise and delete one dashboard's expired raw data, then delete its expired summaries.
+        Returns the documents deleted per collection, or None if another worker is compacting it.
+        The lease is renewed after every window and chunk; if another worker has taken it over
+        (this one stalled past the lease), compaction stops where it is and leaves it to that worker.
+        """
+        state = await self._claim(dashboard_id)
+        if state is None:
+            return None
+        states = mongodb.get_collection(RETENTION_STATE_COLLECTION)
+        deleted: Dict[str, int] = {}
+        now = datetime.now(timezone.utc)
+        try:
+            if raw_days:
+                cutoff = floor_to_bucket(now - timedelta(days=raw_days), DAY_MS)
+                # Raw data before summarized_until is already in the rollups (and may be partly deleted),
+                # so it is never summarised again
+                window_start = state.get("summarized_until")
+                if window_start is None:
+                    oldest = await self._oldest_raw_timestamp(dashboard_id)
+                    window_start = floor_to_bucket(oldest, DAY_MS) if oldest is not None else cutoff
+                window_start = window_start.replace(tzinfo=timezone.utc) if window_start.tzinfo is None else window_start
+                while window_start < cutoff and not self._stopped():
+                    window_end = min(cutoff, window_start + timedelta(days=COMPACTION_WINDOW_DAYS))
+                    # Confirm the lease is still ours before replacing summaries another worker may be building
+                    await self._renew(dashboard_id)
+                    await rollup_service.rebuild_range(dashboard_id, window_start, window_end)
+                    result = await states.update_one(
+                        {"_id": dashboard_id, "worker": self.worker_id},
+                        {"$set": {
+                            "summarized_until": window_end,
+                            "lease_until": datetime.now(timezone.utc) + timedelta(seconds=RETENTION_LEASE_SECONDS),
+                        }},
+                    )
+                    if result.matched_count == 0:
+                        raise LeaseLost(dashboard_id)
+                    await self._delete_raw_before(dashboard_id, window_end, deleted)
+                    window_start = window_end
+                if window_start >= cutoff and rollup_service.enabled and not self._stopped():
+                    # Points backfilled behind the summarised range since the last run were folded into
+                    # the summaries as they were written. With rollups disabled they never were, and the
+                    # range cannot be rebuilt once its earlier raw data is gone, so they are kept.
+                    await self._delete_raw_before(dashboard_id, cutoff, deleted)
+
+            # Summaries are never deleted while their raw data is kept (e.g. defaults that disagree),
+            # or bucketed queries would find gaps where the raw data still exists
+            for resolution, days in summary_days.items():
+                if not days or not raw_days or self._stopped():
+                    continue
+                summary_cutoff = floor_to_bucket(now - timedelta(days=max(days, raw_days)), DAY_MS)
+                name = rollup_collection_name(resolution)
+                await self._delete(dashboard_id, name, {"dashboard_id": dashboard_id, "bucket": {"$lt": summary_cutoff}}, deleted)
+        except LeaseLost:
+            logger.warning(f"Lost the compaction lease of dashboard {dashboard_id} to another worker; stopping")
+            return deleted
+        finally:
+            # Only release a lease this worker still holds
+            await states.update_one(
+                {"_id": dashboard_id, "worker": self.worker_id},
+                {"$set": {"last_run_at": datetime.now(timezone.utc), "last_deleted": deleted}, "$unset": {"lease_until": "", "worker": ""}},
+            )
+        return deleted
+
+    def stats(self) -> dict:
+        return {
+            "running": self.running,
+            "default_raw_days": self.default_raw_days,
+            "default_summary_days": self.default_summary_days,
+            "interval_seconds": self.interval_seconds,
+            "runs": self.runs,
+            "dashboards_compacted": self.dashboards_compacted,
+            "deleted_raw": self.deleted_raw,
+            "deleted_summaries": self.deleted_summaries,
+            "last_report": self.last_report,
+        }
+
+# Global retention compactor instance
+retention_compactor = RetentionCompactor(
+    default_raw_days=settings.RETENTION_RAW_DAYS,
+    default_summary_days=settings.RETENTION_SUMMARY_DAYS,
+    interval_seconds=settings.RETENTION_COMPACT_INTERVAL_SECONDS,
+    chunk_size=settings.PURGE_CHUNK_SIZE,
+    chunk_delay_ms=settings.PURGE_CHUNK_DELAY_MS,
+)
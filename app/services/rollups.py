@@ -0,0 +1,335 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Set, Tuple
+from pymongo import UpdateOne
+from app.core.config import settings
+from app.db.indexes import ensure_indexes
+from app.db.mongodb import mongodb
+from app.services.timeseries import RAW_SUMMARY_GROUP, bucket_start_expression, floor_to_bucket, sample_source, summarize
+
+logger = logging.getLogger(__name__)
+
+# Rollup resolutions, finest first. Each one is kept in its own collection, data_rollups_<name>.
+ROLLUP_RESOLUTIONS = OrderedDict([
+    ("1m", 60 * 1000),
+    ("1h", 3600 * 1000),
+    ("1d", 86400 * 1000),
+])
+
+# $group accumulators re-bucketing rollup documents into a coarser interval; sorted by bucket
+ROLLUP_SUMMARY_GROUP = {
+    "count": {"$sum": "$count"},
+    "sum": {"$sum": "$sum"},
+    "min": {"$min": "$min"},
+    "max": {"$max": "$max"},
+    "first": {"$first": "$first"},
+    "first_ts": {"$first": "$first_ts"},
+    "last": {"$last": "$last"},
+    "last_ts": {"$last": "$last_ts"},
+}
+
+# (dashboard, IST day) pairs whose rollups missed an update and are recomputed from the raw data
+ROLLUP_REPAIRS_COLLECTION = "rollup_repairs"
+
+DAY_MS = ROLLUP_RESOLUTIONS["1d"]
+
+def rollup_collection_name(resolution: str) -> str:
+    return f"data_rollups_{resolution}"
+
+def _rollup_update(summary: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Pipeline update folding a partial summary into a rollup document (upserted if missing).
+    first/last are compared on their timestamps, so out-of-order and backfilled points land correctly.
+    """
+    missing = lambda name: {"$eq": [{"$type": f"${name}"}, "missing"]}
+    takes_first = {"$or": [missing("first_ts"), {"$lt": [summary["first_ts"], "$first_ts"]}]}
+    takes_last = {"$or": [missing("last_ts"), {"$gte": [summary["last_ts"], "$last_ts"]}]}
+    return [{"$set": {
+        "count": {"$add": [{"$ifNull": ["$count", 0]}, summary["count"]]},
+        "sum": {"$add": [{"$ifNull": ["$sum", 0]}, summary["sum"]]},
+        "min": {"$min": [{"$ifNull": ["$min", summary["min"]]}, summary["min"]]},
+        "max": {"$max": [{"$ifNull": ["$max", summary["max"]]}, summary["max"]]},
+        "first": {"$cond": [takes_first, summary["first"], "$first"]},
+        "first_ts": {"$cond": [takes_first, summary["first_ts"], "$first_ts"]},
+        "last": {"$cond": [takes_last, summary["last"], "$last"]},
+        "last_ts": {"$cond": [takes_last, summary["last_ts"], "$last_ts"]},
+    }}]
+
+class RollupService:
+    """
+    Maintains per-minute, per-hour and per-day summaries (count, sum, min, max, first, last) of every
+    field, updated incrementally as data points are written, and serves bucket queries from them.
+    The incremental updates are not idempotent, so a failed write is never retried: the days it
+    touched are queued in rollup_repairs instead, and a background loop recomputes them from the
+    stored raw data with rebuild_range.
+    """
+
+    def __init__(self, enabled: bool, repair_interval_seconds: float):
+        self.enabled = enabled
+        self.repair_interval_seconds = repair_interval_seconds
+        self.applied_points = 0
+        self.failed_points = 0
+        self.writes = 0
+        self.last_apply_latency_ms = 0.0
+        self.repaired_days = 0
+        self.failed_repairs = 0
+        # Days not yet recorded in rollup_repairs (the database was unreachable); retried by the loop
+        self._unrecorded_repairs: Set[Tuple[str, datetime]] = set()
+        self._task: Optional[asyncio.Task] = None
+        self._stopping: Optional[asyncio.Event] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self):
+        """Start the background repair loop"""
+        if not self.enabled or self.running:
+            return
+        self._stopping = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Rollup repair loop started (interval={self.repair_interval_seconds}s)")
+
+    async def stop(self):
+        if self.running:
+            self._stopping.set()
+            await self._task
+            self._task = None
+
+    async def _run(self):
+        while not self._stopping.is_set():
+            try:
+                await self.repair_pending()
+            except Exception as e:
+                logger.error(f"Error repairing rollups: {e}")
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.repair_interval_seconds)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _record_repairs(self, days: Set[Tuple[str, datetime]]):
+        """Queue (dashboard_id, day) pairs for repair; kept in memory if they cannot be written yet"""
+        self._unrecorded_repairs.update(days)
+        pending = list(self._unrecorded_repairs)
+        operations = [
+            UpdateOne({"dashboard_id": dashboard_id, "day": day}, {"$setOnInsert": {"created_at": datetime.now(timezone.utc)}}, upsert=True)
+            for dashboard_id, day in pending
+        ]
+        try:
+            await mongodb.get_collection(ROLLUP_REPAIRS_COLLECTION).bulk_write(operations, ordered=False)
+        except Exception as e:
+            logger.error(f"Could not queue rollup repairs of {len(pending)} days, keeping them in memory: {e}")
+            return
+        self._unrecorded_repairs.difference_update(pending)
+
+    async def repair_pending(self) -> int:
+        """Recompute every queued day from the raw data; returns the number of days repaired"""
+        if self._unrecorded_repairs:
+            await self._record_repairs(set())
+        repairs = mongodb.get_collection(ROLLUP_REPAIRS_COLLECTION)
+        repaired = 0
+        while self._stopping is None or not self._stopping.is_set():
+            # Taking the entry off the queue first means only one process repairs a day
+            repair = await repairs.find_one_and_delete({}, sort=[("created_at", 1)])
+            if repair is None:
+                break
+            day = repair["day"]
+            day = day.replace(tzinfo=timezone.utc) if day.tzinfo is None else day
+            try:
+                await self.rebuild_range(repair["dashboard_id"], day, day + timedelta(milliseconds=DAY_MS))
+            except Exception as e:
+                self.failed_repairs += 1
+                logger.error(f"Could not repair the rollups of dashboard {repair['dashboard_id']} on {day.date()}: {e}")
+                await self._record_repairs({(repair["dashboard_id"], day)})
+                break
+            repaired += 1
+            self.repaired_days += 1
+        if repaired:
+            logger.info(f"Repaired the rollups of {repaired} dashboard days")
+        return repaired
+
+    @staticmethod
+    def resolution_ms(resolution: str) -> int:
+        return ROLLUP_RESOLUTIONS[resolution]
+
+    @staticmethod
+    def choose_resolution(interval_ms: int) -> Optional[str]:
+        """Coarsest rollup whose buckets tile the requested interval exactly, or None"""
+        chosen = None
+        for resolution, resolution_ms in ROLLUP_RESOLUTIONS.items():
+            if interval_ms >= resolution_ms and interval_ms % resolution_ms == 0:
+                chosen = resolution
+        return chosen
+
+    async def ensure_indexes(self):
+        # Rollup upserts and $merge rely on the unique (dashboard_id, field_name, bucket) index
+        await ensure_indexes(rollup_collection_name(resolution) for resolution in ROLLUP_RESOLUTIONS)
+
+    async def apply(self, data_points: List[Dict[str, Any]]):
+        """Fold newly stored data points into every rollup resolution"""
+        if not self.enabled or not data_points:
+            return
+        started = time.perf_counter()
+
+        # Pre-aggregate in memory so each (series, bucket) costs one upsert per resolution
+        summaries: Dict[str, Dict[Tuple[str, str, datetime], Dict[str, Any]]] = {resolution: {} for resolution in ROLLUP_RESOLUTIONS}
+        for data_point in data_points:
+            ts = data_point["timestamp"]
+            ts = ts.replace(tzinfo=timezone.utc) if ts.tzinfo is None else ts.astimezone(timezone.utc)
+            value = data_point["value"]
+            for resolution, resolution_ms in ROLLUP_RESOLUTIONS.items():
+                key = (data_point["dashboard_id"], data_point["field_name"], floor_to_bucket(ts, resolution_ms))
+                summary = summaries[resolution].get(key)
+                if summary is None:
+                    summaries[resolution][key] = {
+                        "count": 1, "sum": value, "min": value, "max": value,
+                        "first": value, "first_ts": ts, "last": value, "last_ts": ts,
+                    }
+                    continue
+                summary["count"] += 1
+                summary["sum"] += value
+                summary["min"] = min(summary["min"], value)
+                summary["max"] = max(summary["max"], value)
+                if ts < summary["first_ts"]:
+                    summary["first"], summary["first_ts"] = value, ts
+                if ts >= summary["last_ts"]:
+                    summary["last"], summary["last_ts"] = value, ts
+
+        for resolution, by_key in summaries.items():
+            operations = [
+                UpdateOne(
+                    {"dashboard_id": dashboard_id, "field_name": field_name, "bucket": bucket},
+                    _rollup_update(summary),
+                    upsert=True,
+                )
+                for (dashboard_id, field_name, bucket), summary in by_key.items()
+            ]
+            try:
+                await mongodb.get_collection(rollup_collection_name(resolution)).bulk_write(operations, ordered=False)
+                self.writes += len(operations)
+            except Exception as e:
+                # Possibly partly applied, so not retried; the affected days are recomputed from raw data instead
+                self.failed_points += len(data_points)
+                logger.error(f"Could not update {resolution} rollups for {len(data_points)} data points, queueing a repair: {e}")
+                await self._record_repairs({
+                    (dashboard_id, floor_to_bucket(bucket, DAY_MS)) for dashboard_id, _, bucket in by_key
+                })
+                return
+
+        self.applied_points += len(data_points)
+        self.last_apply_latency_ms = (time.perf_counter() - started) * 1000
+
+    async def summarize(self, resolution: str, dashboard_id: str, field_name: str, start_time: datetime, end_time: datetime, interval_ms: int) -> Dict[int, Dict[str, Any]]:
+        """Summaries of the rollup buckets in [start_time, end_time), re-bucketed to interval_ms"""
+        match = {
+            "dashboard_id": dashboard_id,
+            "field_name": field_name,
+            "bucket": {"$gte": start_time, "$lt": end_time},
+        }
+        return await summarize(rollup_collection_name(resolution), [{"$match": match}], "bucket", interval_ms, ROLLUP_SUMMARY_GROUP)
+
+    async def _merge_from_samples(self, resolution: str, match: Dict[str, Any]):
+        """Recompute the rollup buckets of the samples matching a data_points query and replace them in place"""
+        source_collection, source_stages = sample_source(match)
+        pipeline = [
+            *source_stages,
+            {"$sort": {"timestamp": 1}},
+            {"$group": {
+                "_id": {
+                    "dashboard_id": "$dashboard_id",
+                    "field_name": "$field_name",
+                    "bucket": bucket_start_expression(ROLLUP_RESOLUTIONS[resolution]),
+                },
+                **RAW_SUMMARY_GROUP,
+            }},
+            {"$project": {
+                "_id": 0,
+                "dashboard_id": "$_id.dashboard_id",
+                "field_name": "$_id.field_name",
+                "bucket": {"$toDate": "$_id.bucket"},
+                **{name: 1 for name in RAW_SUMMARY_GROUP},
+            }},
+            {"$merge": {
+                "into": rollup_collection_name(resolution),
+                "on": ["dashboard_id", "field_name", "bucket"],
+                "whenMatched": "replace",
+                "whenNotMatched": "insert",
+            }},
+        ]
+        async for _ in mongodb.get_collection(source_collection).aggregate(pipeline, allowDiskUse=True):
+            pass
+
+    async def rebuild(self, dashboard_id: Optional[str] = None) -> Dict[str, int]:
+        """
+        Recompute the rollups of one dashboard (or all of them) from the stored data points.
+        Where retention has already summarised and deleted raw data (summarized_until in
+        retention_state), the rollups are the only copy of that history: only buckets from
+        that point on are deleted and rebuilt, and older ones are kept as they are.
+        Points written while a rebuild runs may be counted twice; run it with ingest stopped.
+        """
+        await self.ensure_indexes()
+        # Imported here: retention imports this module
+        from app.services.retention import RETENTION_STATE_COLLECTION
+        state_query = {"summarized_until": {"$ne": None}}
+        if dashboard_id:
+            state_query["_id"] = dashboard_id
+        summarized_until = {
+            state["_id"]: state["summarized_until"]
+            async for state in mongodb.get_collection(RETENTION_STATE_COLLECTION).find(state_query, {"summarized_until": 1})
+        }
+
+        # Dashboards without expired raw data are rebuilt in full
+        if dashboard_id is None:
+            full_scope = {"dashboard_id": {"$nin": list(summarized_until)}}
+        else:
+            full_scope = None if dashboard_id in summarized_until else {"dashboard_id": dashboard_id}
+        if full_scope is not None:
+            for resolution in ROLLUP_RESOLUTIONS:
+                await mongodb.get_collection(rollup_collection_name(resolution)).delete_many(full_scope)
+                await self._merge_from_samples(resolution, full_scope)
+
+        # Up to the next IST day boundary, so the newest buckets are rebuilt complete
+        end_time = floor_to_bucket(datetime.now(timezone.utc), ROLLUP_RESOLUTIONS["1d"]) + timedelta(days=1)
+        for retained_id, start_time in summarized_until.items():
+            logger.info(f"Keeping the rollups of dashboard {retained_id} before {start_time}, whose raw data has expired")
+            for resolution in ROLLUP_RESOLUTIONS:
+                await mongodb.get_collection(rollup_collection_name(resolution)).delete_many(
+                    {"dashboard_id": retained_id, "bucket": {"$gte": start_time}}
+                )
+            await self.rebuild_range(retained_id, start_time, end_time)
+
+        count_scope = {"dashboard_id": dashboard_id} if dashboard_id else {}
+        rebuilt = {}
+        for resolution in ROLLUP_RESOLUTIONS:
+            rebuilt[resolution] = await mongodb.get_collection(rollup_collection_name(resolution)).count_documents(count_scope)
+            logger.info(f"Rebuilt {rebuilt[resolution]} {resolution} rollup buckets")
+        return rebuilt
+
+    async def rebuild_range(self, dashboard_id: str, start_time: datetime, end_time: datetime):
+        """
+        Recompute a dashboard's rollup buckets in [start_time, end_time) from its raw samples, replacing
+        the stored ones. Both bounds must be aligned to the coarsest resolution so every bucket is complete.
+        Buckets without raw samples in the range are left as they are.
+        """
+        match = {"dashboard_id": dashboard_id, "timestamp": {"$gte": start_time, "$lt": end_time}}
+        for resolution in ROLLUP_RESOLUTIONS:
+            await self._merge_from_samples(resolution, match)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "resolutions": list(ROLLUP_RESOLUTIONS),
+            "applied_points": self.applied_points,
+            "failed_points": self.failed_points,
+            "repaired_days": self.repaired_days,
+            "failed_repairs": self.failed_repairs,
+            "unrecorded_repairs": len(self._unrecorded_repairs),
+            "bucket_writes": self.writes,
+            "last_apply_latency_ms": round(self.last_apply_latency_ms, 2),
+        }
+
+# Global rollup service instance
+rollup_service = RollupService(enabled=settings.ROLLUPS_ENABLED, repair_interval_seconds=settings.ROLLUP_REPAIR_INTERVAL_SECONDS)
@@ -0,0 +1,340 @@
+import asyncio
+import base64
+import json
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Tuple
+from bson import ObjectId
+from app.core.config import settings
+from app.db.mongodb import mongodb
+
+# IST timezone (UTC+5:30)
+IST_TIMEZONE = timezone(timedelta(hours=5, minutes=30))
+
+# Buckets are aligned to IST wall-clock boundaries (e.g. 1d buckets start at IST midnight)
+IST_OFFSET_MS = 5 * 3600 * 1000 + 30 * 60 * 1000
+
+INTERVAL_UNITS_MS = {"s": 1000, "m": 60 * 1000, "h": 3600 * 1000, "d": 86400 * 1000}
+
+# Aggregations supported for time buckets
+AGGREGATIONS = ("avg", "min", "max", "last", "count")
+
+# Media type (Accept header) and format= value selecting the columnar series representation
+COLUMNAR_MEDIA_TYPE = "application/vnd.bluedrop.columnar+json"
+COLUMNAR_FORMAT = "columnar"
+
+# Upper bound on raw points loaded for downsampling; the newest points are kept
+MAX_DOWNSAMPLE_SOURCE_POINTS = 500000
+
+# Upper bound on buckets per series, so a tiny interval over a long range is rejected
+MAX_BUCKETS = 10000
+
+def parse_interval(interval: str) -> int:
+    """Parse an interval such as 30s, 5m, 1h or 1d into milliseconds"""
+    interval = interval.strip().lower()
+    unit = interval[-1:]
+    if unit not in INTERVAL_UNITS_MS or not interval[:-1].isdigit() or int(interval[:-1]) <= 0:
+        raise ValueError(f"Invalid interval '{interval}', expected a number followed by s, m, h or d (e.g. 5m)")
+    return int(interval[:-1]) * INTERVAL_UNITS_MS[unit]
+
+def validate_bucket_request(start_time: datetime, end_time: datetime, interval_ms: int, agg: str):
+    """Raise ValueError for an unknown aggregation or a range that would produce too many buckets"""
+    if agg not in AGGREGATIONS:
+        raise ValueError(f"Invalid aggregation '{agg}', expected one of {', '.join(AGGREGATIONS)}")
+    buckets = (end_time - start_time).total_seconds() * 1000 / interval_ms
+    if buckets > MAX_BUCKETS:
+        raise ValueError(f"Interval too small for the requested range ({int(buckets)} buckets, the maximum is {MAX_BUCKETS})")
+
+def to_ist(ts: datetime) -> datetime:
+    """Convert a BSON datetime (naive UTC) or aware datetime to IST"""
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    return ts.astimezone(IST_TIMEZONE)
+
+def epoch_ms(ts: datetime) -> int:
+    """Milliseconds since the epoch of a BSON datetime (naive UTC) or aware datetime"""
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    return int(ts.timestamp() * 1000)
+
+def columnar_series(timestamps_ms: List[int], values: List[float], delta: bool = False, counts: Optional[List[int]] = None) -> Dict[str, Any]:
+    """
+    Compact column-oriented series: {"t": [epoch_ms...], "v": [values...]}.
+    With delta, t holds the first timestamp followed by the difference to the previous one.
+    Aggregated series also carry the per-bucket sample counts in "n".
+    """
+    if delta and timestamps_ms:
+        timestamps_ms = [timestamps_ms[0]] + [current - previous for previous, current in zip(timestamps_ms, timestamps_ms[1:])]
+    series: Dict[str, Any] = {"t": timestamps_ms, "v": values}
+    if delta:
+        series["t_encoding"] = "delta"
+    if counts is not None:
+        series["n"] = counts
+    return series
+
+def bucket_start_expression(interval_ms: int, time_field: str = "$timestamp") -> Dict[str, Any]:
+    """Aggregation expression giving the epoch-ms start of the IST-aligned bucket holding time_field"""
+    epoch_ms = {"$toLong": time_field}
+    return {"$subtract": [epoch_ms, {"$mod": [{"$add": [epoch_ms, IST_OFFSET_MS]}, interval_ms]}]}
+
+def floor_to_bucket(ts: datetime, interval_ms: int) -> datetime:
+    """Start of the IST-aligned bucket holding ts"""
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    epoch_ms = int(ts.timestamp() * 1000)
+    return datetime.fromtimestamp((epoch_ms - (epoch_ms + IST_OFFSET_MS) % interval_ms) / 1000, tz=timezone.utc)
+
+def ceil_to_bucket(ts: datetime, interval_ms: int) -> datetime:
+    """First IST-aligned bucket boundary at or after ts"""
+    floor = floor_to_bucket(ts, interval_ms)
+    if floor < ts:
+        return floor + timedelta(milliseconds=interval_ms)
+    return floor
+
+# $group accumulators summarising raw data points; the input must be sorted by timestamp
+RAW_SUMMARY_GROUP = {
+    "count": {"$sum": 1},
+    "sum": {"$sum": "$value"},
+    "min": {"$min": "$value"},
+    "max": {"$max": "$value"},
+    "first": {"$first": "$value"},
+    "first_ts": {"$first": "$timestamp"},
+    "last": {"$last": "$value"},
+    "last_ts": {"$last": "$timestamp"},
+}
+
+def sample_source(match: Dict[str, Any]) -> Tuple[str, List[Dict[str, Any]]]:
+    """
+    Collection and leading aggregation stages producing the raw samples (dashboard_id, field_name,
+    timestamp, value) that match a data_points query, in whichever storage layout is configured
+    """
+    from app.services.bucket_storage import BUCKET_COLLECTION, bucket_storage
+    if bucket_storage.enabled:
+        return BUCKET_COLLECTION, bucket_storage.sample_stages(match)
+    return "data_points", [{"$match": match}]
+
+async def count_samples(match: Dict[str, Any]) -> int:
+    """Number of raw samples matching a data_points query on dashboard_id, field_name and timestamp"""
+    from app.services.bucket_storage import BUCKET_COLLECTION, bucket_storage
+    if not bucket_storage.enabled:
+        return await mongodb.get_collection("data_points").count_documents(match)
+    if "timestamp" in match:
+        stages = [*bucket_storage.sample_stages(match), {"$count": "count"}]
+    else:
+        # Whole buckets: add up their sample counts without unwinding them
+        stages = [{"$match": match}, {"$group": {"_id": None, "count": {"$sum": "$count"}}}]
+    result = await mongodb.get_collection(BUCKET_COLLECTION).aggregate(stages).to_list(length=1)
+    return result[0]["count"] if result else 0
+
+# Newest-sample lookups latest_timestamps runs at once
+LATEST_TIMESTAMP_CONCURRENCY = 16
+
+async def latest_timestamps(series: List[Tuple[str, str]]) -> Dict[Tuple[str, str], datetime]:
+    """
+    Timestamp of the newest sample of each (dashboard_id, field_name) series. Series without samples are left out.
+    Each series is one lookup reading a single entry of the (dashboard_id, field_name, time desc) index;
+    a grouped aggregation over all of them would read every matching sample instead.
+    """
+    from app.services.bucket_storage import BUCKET_COLLECTION, bucket_storage
+    wanted = sorted(set(series))
+    if not wanted:
+        return {}
+    limit = asyncio.Semaphore(LATEST_TIMESTAMP_CONCURRENCY)
+
+    async def newest(dashboard_id: str, field_name: str) -> Optional[datetime]:
+        query = {"dashboard_id": dashboard_id, "field_name": field_name}
+        async with limit:
+            if bucket_storage.enabled:
+                # Newest bucket only; its samples are not sorted, so take their maximum server-side
+                pipeline = [
+                    {"$match": query},
+                    {"$sort": {"start": -1}},
+                    {"$limit": 1},
+                    {"$project": {"_id": 0, "timestamp": {"$max": "$t"}}},
+                ]
+                docs = await mongodb.get_collection(BUCKET_COLLECTION).aggregate(pipeline).to_list(length=1)
+                return docs[0].get("timestamp") if docs else None
+            doc = await mongodb.get_collection("data_points").find_one(query, {"_id": 0, "timestamp": 1}, sort=[("timestamp", -1)])
+            return doc["timestamp"] if doc else None
+
+    timestamps = await asyncio.gather(*(newest(dashboard_id, field_name) for dashboard_id, field_name in wanted))
+    return {key: timestamp for key, timestamp in zip(wanted, timestamps) if timestamp is not None}
+
+async def summarize(collection_name: str, stages: List[Dict[str, Any]], time_field: str, interval_ms: int, group: Dict[str, Any]) -> Dict[int, Dict[str, Any]]:
+    """Group the documents produced by stages into IST-aligned buckets, keyed by bucket start in epoch ms"""
+    pipeline = [
+        *stages,
+        {"$sort": {time_field: 1}},
+        {"$group": {"_id": bucket_start_expression(interval_ms, f"${time_field}"), **group}},
+    ]
+    summaries = {}
+    async for doc in mongodb.get_collection(collection_name).aggregate(pipeline, allowDiskUse=True):
+        summaries[doc.pop("_id")] = doc
+    return summaries
+
+def merge_summaries(a: Dict[str, Any], b: Dict[str, Any]) -> Dict[str, Any]:
+    """Combine two summaries (count, sum, min, max, first, last) of the same bucket"""
+    first, first_ts = (a["first"], a["first_ts"]) if a["first_ts"] <= b["first_ts"] else (b["first"], b["first_ts"])
+    last, last_ts = (a["last"], a["last_ts"]) if a["last_ts"] >= b["last_ts"] else (b["last"], b["last_ts"])
+    return {
+        "count": a["count"] + b["count"],
+        "sum": a["sum"] + b["sum"],
+        "min": min(a["min"], b["min"]),
+        "max": max(a["max"], b["max"]),
+        "first": first,
+        "first_ts": first_ts,
+        "last": last,
+        "last_ts": last_ts,
+    }
+
+def finalize_summary(summary: Dict[str, Any], agg: str) -> float:
+    if agg == "avg":
+        return summary["sum"] / summary["count"]
+    return summary[agg]
+
+async def fetch_buckets(dashboard_id: str, field_name: str, start_time: datetime, end_time: datetime, interval_ms: int, agg: str) -> List[Dict[str, Any]]:
+    """
+    Aggregate a field's data points into time buckets inside MongoDB.
+    When rollups are enabled, the whole rollup buckets inside the range are read from the coarsest
+    rollup collection that fits the interval, and only the partial edges come from raw data points.
+    Returns one {"bucket_ms", "timestamp", "value", "count"} dict per non-empty bucket, oldest first.
+    """
+    series = {"dashboard_id": dashboard_id, "field_name": field_name}
+
+    def summarize_samples(time_range: Dict[str, Any]):
+        return summarize(*sample_source({**series, "timestamp": time_range}), "timestamp", interval_ms, RAW_SUMMARY_GROUP)
+
+    segments = []
+    if settings.ROLLUPS_ENABLED:
+        from app.services.rollups import rollup_service
+        resolution = rollup_service.choose_resolution(interval_ms)
+        if resolution is not None:
+            resolution_ms = rollup_service.resolution_ms(resolution)
+            head_end = ceil_to_bucket(start_time, resolution_ms)
+            tail_start = floor_to_bucket(end_time, resolution_ms)
+            if head_end < tail_start:
+                segments = [
+                    summarize_samples({"$gte": start_time, "$lt": head_end}),
+                    rollup_service.summarize(resolution, dashboard_id, field_name, head_end, tail_start, interval_ms),
+                    summarize_samples({"$gte": tail_start, "$lte": end_time}),
+                ]
+    if not segments:
+        segments = [summarize_samples({"$gte": start_time, "$lte": end_time})]
+
+    merged: Dict[int, Dict[str, Any]] = {}
+    for summaries in await asyncio.gather(*segments):
+        for bucket_ms, summary in summaries.items():
+            merged[bucket_ms] = merge_summaries(merged[bucket_ms], summary) if bucket_ms in merged else summary
+
+    return [
+        {
+            "bucket_ms": bucket_ms,
+            "timestamp": datetime.fromtimestamp(bucket_ms / 1000, tz=timezone.utc).astimezone(IST_TIMEZONE),
+            "value": finalize_summary(merged[bucket_ms], agg),
+            "count": merged[bucket_ms]["count"],
+        }
+        for bucket_ms in sorted(merged)
+    ]
+
+async def _newest_samples(dashboard_id: str, field_name: str, start_time: datetime, end_time: datetime, limit: int, before: Optional[Tuple[datetime, str]] = None) -> List[Dict[str, Any]]:
+    """Newest `limit` samples from the bucketed layout, newest first"""
+    from app.services.bucket_storage import bucket_storage
+    samples = []
+    if limit <= 0:
+        return samples
+    async for sample in bucket_storage.iter_samples(dashboard_id, field_name, start_time, end_time, newest_first=True, before=before):
+        samples.append(sample)
+        if len(samples) >= limit:
+            break
+    return samples
+
+async def fetch_raw_points(dashboard_id: str, field_name: str, start_time: datetime, end_time: datetime, limit: int, with_metadata: bool = False) -> List[Dict[str, Any]]:
+    """Newest `limit` raw points of a field in the range (_id, timestamp, value and optionally metadata), oldest first"""
+    from app.services.bucket_storage import bucket_storage
+    if bucket_storage.enabled:
+        # The bucketed layout keeps no metadata
+        points = await _newest_samples(dashboard_id, field_name, start_time, end_time, limit)
+        points.reverse()
+        return points
+    projection = {"timestamp": 1, "value": 1}
+    if with_metadata:
+        projection["metadata"] = 1
+    cursor = mongodb.get_collection("data_points").find(
+        {
+            "dashboard_id": dashboard_id,
+            "field_name": field_name,
+            "timestamp": {"$gte": start_time, "$lte": end_time}
+        },
+        projection
+    ).sort("timestamp", -1).limit(limit).batch_size(10000)
+    points = await cursor.to_list(length=None)
+    points.reverse()
+    return points
+
+def encode_cursor(timestamp: datetime, point_id, start_time: datetime) -> str:
+    """Opaque page cursor: the (timestamp, _id) of the last point returned plus the window start"""
+    payload = {
+        "t": int(to_ist(timestamp).timestamp() * 1000),
+        "id": str(point_id),
+        "s": int(to_ist(start_time).timestamp() * 1000),
+    }
+    return base64.urlsafe_b64encode(json.dumps(payload, separators=(",", ":")).encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> Tuple[datetime, str, datetime]:
+    """
+    Inverse of encode_cursor; raises ValueError for a malformed cursor or one issued for the other
+    storage layout (e.g. before migrate-buckets), whose point ids cannot be compared with this one's
+    """
+    from app.services.bucket_storage import bucket_storage
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        point_id = str(payload["id"])
+        before_ts = datetime.fromtimestamp(payload["t"] / 1000, tz=timezone.utc)
+        start_time = datetime.fromtimestamp(payload["s"] / 1000, tz=timezone.utc)
+    except Exception:
+        raise ValueError("Invalid cursor")
+    # Document ids are ObjectIds, bucketed sample ids are <bucket ObjectId>:<index>
+    bucket_id, _, index = point_id.rpartition(":")
+    is_sample_id = ObjectId.is_valid(bucket_id) and index.isdigit()
+    if not ObjectId.is_valid(point_id) and not is_sample_id:
+        raise ValueError("Invalid cursor")
+    if is_sample_id != bucket_storage.enabled:
+        raise ValueError("Cursor was issued for a different storage layout, request the first page again")
+    return before_ts, point_id, start_time
+
+async def fetch_page(dashboard_id: str, field_name: str, start_time: datetime, end_time: datetime, limit: int, cursor: Optional[str] = None, with_metadata: bool = True) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """
+    One page of raw points walking backwards in time from end_time (or from the cursor), oldest first.
+    Pages are keyset ranges on (timestamp, _id), so each one is an index range scan on
+    (dashboard_id, field_name, timestamp, _id) whatever its depth. Returns the points and the
+    cursor of the next (older) page, or None on the last page.
+    """
+    from app.services.bucket_storage import bucket_storage
+    before = None
+    if cursor:
+        before_ts, before_id, start_time = decode_cursor(cursor)
+        before = (before_ts, before_id)
+
+    if bucket_storage.enabled:
+        points = await _newest_samples(dashboard_id, field_name, start_time, end_time, limit + 1, before)
+    else:
+        match: Dict[str, Any] = {"dashboard_id": dashboard_id, "field_name": field_name}
+        if before:
+            match["timestamp"] = {"$gte": start_time, "$lte": before_ts}
+            match["$or"] = [{"timestamp": {"$lt": before_ts}}, {"timestamp": before_ts, "_id": {"$lt": ObjectId(before_id)}}]
+        else:
+            match["timestamp"] = {"$gte": start_time, "$lte": end_time}
+
+        projection = {"timestamp": 1, "value": 1}
+        if with_metadata:
+            projection["metadata"] = 1
+        points = await mongodb.get_collection("data_points").find(
+            match,
+            projection
+        ).sort([("timestamp", -1), ("_id", -1)]).limit(limit + 1).to_list(length=None)
+
+    next_cursor = None
+    if len(points) > limit:
+        points = points[:limit]
+        next_cursor = encode_cursor(points[-1]["timestamp"], points[-1]["_id"], start_time)
+    points.reverse()
+    return points, next_cursor
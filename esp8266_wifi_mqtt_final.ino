@@ -14,8 +14,8 @@ const char* dashboard_id = "685243c10325c40da1d4b468";  // Your testing dashboar
 const char* field_names[] = {"Temp", "Level", "ph", "Pressure"};
 const int num_fields = 4;
 
-// MQTT topics
-char mqtt_topics[4][100];
+// MQTT batch topic: all fields are published in one message
+char mqtt_batch_topic[100];
 
 WiFiClient espClient;
 PubSubClient client(espClient);
@@ -38,19 +38,17 @@ void setup() {
   client.setServer(mqtt_server, mqtt_port);
   client.setCallback(callback);
   
-  // Create MQTT topics for each field
-  for (int i = 0; i < num_fields; i++) {
-    sprintf(mqtt_topics[i], "tankmanage/%s/%s", dashboard_id, field_names[i]);
-  }
+  // Create the MQTT batch topic for this dashboard
+  sprintf(mqtt_batch_topic, "tankmanage/%s/batch", dashboard_id);
   
   Serial.print("Dashboard ID: ");
   Serial.println(dashboard_id);
+  Serial.print("Batch topic: ");
+  Serial.println(mqtt_batch_topic);
   Serial.println("Fields:");
   for (int i = 0; i < num_fields; i++) {
     Serial.print("  ");
-    Serial.print(field_names[i]);
-    Serial.print(": ");
-    Serial.println(mqtt_topics[i]);
+    Serial.println(field_names[i]);
   }
   
   Serial.print("MQTT Server: ");
@@ -145,24 +143,32 @@ void loop() {
     
     Serial.println("--- Publishing sensor data ---");
     
-    // Generate and publish data for each field
+    // Generate data for each field and publish them together as field=value pairs
+    String payload = "";
     for (int i = 0; i < num_fields; i++) {
       float sensorValue = generateSensorData(i);
       String valueString = String(sensorValue, 2);
       
       Serial.print(field_names[i]);
       Serial.print(": ");
-      Serial.print(valueString);
-      Serial.print(" -> ");
-      Serial.println(mqtt_topics[i]);
+      Serial.println(valueString);
       
-      if (client.publish(mqtt_topics[i], valueString.c_str())) {
-        Serial.println("  Published successfully");
-      } else {
-        Serial.println("  Failed to publish");
+      if (i > 0) {
+        payload += ",";
       }
-      
-      delay(100); // Small delay between publishes
+      payload += field_names[i];
+      payload += "=";
+      payload += valueString;
+    }
+    
+    Serial.print(payload);
+    Serial.print(" -> ");
+    Serial.println(mqtt_batch_topic);
+    
+    if (client.publish(mqtt_batch_topic, payload.c_str())) {
+      Serial.println("  Published successfully");
+    } else {
+      Serial.println("  Failed to publish");
     }
     
     Serial.println("--- Data publishing complete ---");
@@ -13,16 +13,7 @@ db.createUser({
   ]
 });
 
-// Create collections with indexes
-db.createCollection('users');
-db.createCollection('dashboards');
-db.createCollection('data');
-
-// Create indexes for better performance
-db.users.createIndex({ "username": 1 }, { unique: true });
-db.users.createIndex({ "email": 1 }, { unique: true });
-db.dashboards.createIndex({ "api_key": 1 }, { unique: true });
-db.data.createIndex({ "dashboard_id": 1, "timestamp": -1 });
-db.data.createIndex({ "timestamp": -1 });
+// Collections are created on first write. Indexes are declared in app/db/indexes.py and
+// created by the backend at startup (or with `python -m app.cli ensure-indexes`).
 
 print('MongoDB initialization completed'); 
\ No newline at end of file